@@ -0,0 +1,157 @@
+import argparse
+import bisect
+import datetime
+import itertools
+import json
+import os
+import random
+import zipfile
+
+REVIEWS_FILE = "yelp_academic_dataset_review.json.zip"
+BUSINESS_FILE = "yelp_academic_dataset_business.json.zip"
+CITIES = [
+    "Las Vegas", "Phoenix", "Toronto", "Charlotte", "Scottsdale", "Pittsburgh",
+    "Montreal", "Mesa", "Henderson", "Tempe", "Chandler", "Cleveland",
+    "Madison", "Glendale", "Gilbert", "Mississauga", "Calgary", "Peoria",
+]
+WORDS = (
+    "good great food service place time back really just like love best "
+    "order staff friendly nice pizza chicken menu restaurant definitely "
+    "delicious amazing little pretty went came experience table bar"
+).split()
+# a few canned texts, repeated comments are what the comment stage looks for
+CANNED = 16
+START = datetime.datetime(2010, 1, 1)
+
+
+class Zipf:
+    # ids 0..n-1 with p(k) ~ 1/(k+1)^skew, skew 0 is uniform
+    def __init__(self, n, skew, rng) -> None:
+        self.rng = rng
+        weights = [1 / (k + 1) ** skew for k in range(n)]
+        self.cumulative = list(itertools.accumulate(weights))
+
+    def sample(self):
+        x = self.rng.random() * self.cumulative[-1]
+        return bisect.bisect_left(self.cumulative, x)
+
+
+class Dataset:
+    def __init__(
+        self,
+        users=10000,
+        businesses=2000,
+        user_skew=1.0,
+        business_skew=0.8,
+        text_length=100,
+        seed=0,
+    ) -> None:
+        self.users = users
+        self.businesses = businesses
+        self.user_skew = user_skew
+        self.business_skew = business_skew
+        self.text_length = text_length
+        self.seed = seed
+
+    def business(self, count=None):
+        rng = random.Random(self.seed)
+        for i in range(count or self.businesses):
+            yield {
+                "business_id": f"b{i:08d}",
+                "name": f"Business {i}",
+                "city": CITIES[rng.randrange(len(CITIES))],
+                "stars": rng.randint(2, 10) / 2,
+                "review_count": rng.randint(1, 500),
+                "is_open": rng.randint(0, 1),
+            }
+
+    def text(self, rng):
+        length = max(1, int(rng.expovariate(1 / self.text_length)))
+        words = []
+        size = 0
+        while size < length:
+            word = WORDS[rng.randrange(len(WORDS))]
+            words.append(word)
+            size += len(word) + 1
+        return " ".join(words)
+
+    def reviews(self, count):
+        rng = random.Random(self.seed + 1)
+        users = Zipf(self.users, self.user_skew, rng)
+        businesses = Zipf(self.businesses, self.business_skew, rng)
+        canned = [self.text(rng) for _ in range(CANNED)]
+        for i in range(count):
+            user = users.sample()
+            # heavy users tend to repeat themselves
+            if rng.random() < 0.05:
+                text = canned[user % CANNED]
+            else:
+                text = self.text(rng)
+            date = START + datetime.timedelta(seconds=rng.randrange(10 * 365 * 86400))
+            yield {
+                "review_id": f"r{i:010d}",
+                "user_id": f"u{user:08d}",
+                "business_id": f"b{businesses.sample():08d}",
+                "stars": float(rng.choices([1, 2, 3, 4, 5], [1, 1, 2, 3, 4])[0]),
+                "useful": rng.randint(0, 3),
+                "funny": rng.choices([0, 1, 2], [8, 1, 1])[0],
+                "cool": rng.randint(0, 3),
+                "text": text,
+                "date": date.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+
+
+def chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_zip(path, name, items):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        with z.open(name, "w") as f:
+            for item in items:
+                f.write((json.dumps(item) + "\n").encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Deterministic synthetic Yelp review and business zips"
+    )
+    parser.add_argument("--out", default="data")
+    parser.add_argument("--reviews", type=int, default=100000)
+    parser.add_argument("--businesses", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--user-skew", type=float, default=1.0)
+    parser.add_argument("--business-skew", type=float, default=0.8)
+    parser.add_argument("--text-length", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    dataset = Dataset(
+        users=args.users,
+        businesses=args.businesses,
+        user_skew=args.user_skew,
+        business_skew=args.business_skew,
+        text_length=args.text_length,
+        seed=args.seed,
+    )
+    os.makedirs(args.out, exist_ok=True)
+    write_zip(
+        os.path.join(args.out, BUSINESS_FILE),
+        BUSINESS_FILE[: -len(".zip")],
+        dataset.business(),
+    )
+    write_zip(
+        os.path.join(args.out, REVIEWS_FILE),
+        REVIEWS_FILE[: -len(".zip")],
+        dataset.reviews(args.reviews),
+    )
+    print(f"{args.reviews} reviews and {args.businesses} businesses in {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+from flask import Flask
+from werkzeug.serving import make_server
+
+from kevasto import Client, KeyValueVM, add_raft_routes
+from raft import Raft
+from raft_log import Durability
+
+logging.basicConfig(level=logging.ERROR)
+logging.getLogger("raft").setLevel(logging.CRITICAL)
+logging.getLogger("kevasto").setLevel(logging.CRITICAL)
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+HTTP_PORT = 9501
+OPS = ["put", "get", "log_append", "log_fetch", "log_drop"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def serve(args):
+    # a single node, run as its own process so it can be killed for real
+    raft = Raft(
+        args.serve,
+        args.replicas.split(","),
+        KeyValueVM(),
+        base_path=f"{args.directory}/raft",
+        durability=Durability(args.durability),
+    )
+    app = Flask(args.serve)
+    add_raft_routes(app, raft)
+    (host, port) = args.serve.rsplit(":", 1)
+    make_server(host, int(port), app, threaded=True).serve_forever()
+
+
+class Cluster:
+    def __init__(self, nodes, directory, durability, env) -> None:
+        self.names = [f"127.0.0.1:{HTTP_PORT + i}" for i in range(nodes)]
+        self.directory = directory
+        self.durability = durability
+        self.env = env
+        self.processes = {}
+        self.stopped = False
+        self.session = requests.session()
+
+    def start(self, name):
+        if self.stopped:
+            return
+        path = os.path.join(self.directory, name.replace(":", "_"))
+        os.makedirs(path, exist_ok=True)
+        self.processes[name] = subprocess.Popen(
+            [
+                sys.executable, "-m", "bench.kevasto_load",
+                "--serve", name,
+                "--replicas", ",".join(self.names),
+                "--directory", path,
+                "--durability", self.durability,
+            ],
+            cwd=ROOT,
+            env=self.env,
+        )
+
+    def kill(self, name):
+        process = self.processes.pop(name)
+        process.kill()
+        process.wait()
+
+    def stop(self):
+        self.stopped = True
+        for name in list(self.processes):
+            self.kill(name)
+
+    def leader(self):
+        for name in list(self.processes):
+            try:
+                show = self.session.get(f"http://{name}/show", timeout=1).json()
+            except requests.exceptions.RequestException:
+                continue
+            if show["state"] == "Leader":
+                return name
+        return None
+
+    def wait_leader(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            leader = self.leader()
+            if leader is not None:
+                return leader
+            time.sleep(0.1)
+        raise Exception("no leader elected")
+
+
+class Worker(threading.Thread):
+    def __init__(self, index, hosts, mix, args, deadline) -> None:
+        super().__init__(daemon=True)
+        self.client = Client(hosts, groups=1)
+        self.rng = random.Random(args.seed + index)
+        (self.ops, self.weights) = zip(*mix.items())
+        self.keys = args.keys
+        self.payload = {"val": "x" * args.payload}
+        self.fetch_limit = args.fetch_limit
+        self.keep = args.keep
+        self.deadline = deadline
+        # every worker owns its log so appended and dropped stay exact
+        self.log = f"load{index}"
+        self.appended = 0
+        self.dropped = 0
+        self.latencies = {op: [] for op in OPS}
+        self.errors = {op: 0 for op in OPS}
+        # (start, end) of every completed operation, to measure unavailability
+        self.completed = []
+
+    def call(self, op):
+        key = str(self.rng.randrange(self.keys))
+        if op == "put":
+            self.client.put("load", key, self.payload)
+        elif op == "get":
+            self.client.get("load", key)
+        elif op == "log_append":
+            self.client.log_append(self.log, self.payload)
+            self.appended += 1
+        elif op == "log_fetch":
+            self.client.log_fetch(self.log, self.dropped, self.fetch_limit)
+        elif op == "log_drop":
+            # moved first, a drop that fails after applying must not leave
+            # fetches below the log base
+            self.dropped = max(self.dropped, self.appended - self.keep)
+            self.client.log_drop(self.log, self.dropped)
+
+    def run(self):
+        self.client.log_append(self.log, self.payload)
+        self.appended = 1
+        while time.monotonic() < self.deadline:
+            op = self.rng.choices(self.ops, self.weights)[0]
+            start = time.monotonic()
+            try:
+                self.call(op)
+            except Exception:
+                self.errors[op] += 1
+                continue
+            end = time.monotonic()
+            self.latencies[op].append(end - start)
+            self.completed.append((start, end))
+
+
+def killer(cluster, interval, down, deadline, kills):
+    # SIGKILLs whoever leads every interval seconds, restarts it down seconds later
+    while time.monotonic() + interval < deadline:
+        time.sleep(interval)
+        try:
+            leader = cluster.wait_leader(interval)
+        except Exception:
+            continue
+        killed = time.monotonic()
+        cluster.kill(leader)
+        kills.append({"node": leader, "at": killed})
+        time.sleep(down)
+        cluster.start(leader)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def unavailability(kills, completed):
+    # time from every kill to the first operation started after it completing
+    for kill in kills:
+        after = [end for (start, end) in completed if start > kill["at"]]
+        kill["recovered_s"] = round(min(after) - kill["at"], 3) if after else None
+    return kills
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        (op, weight) = part.split("=")
+        if op not in OPS:
+            raise ValueError(f"unknown op {op}, expected one of {OPS}")
+        weights[op] = float(weight)
+    return weights
+
+
+def run(args):
+    env = dict(os.environ)
+    if args.election_timeout:
+        env["ELECTION_TIMEOUT"] = str(args.election_timeout)
+        env["HEARBEAT_TIMEOUT"] = str(max(args.election_timeout // 5, 1))
+    with tempfile.TemporaryDirectory() as directory:
+        cluster = Cluster(args.nodes, directory, args.durability, env)
+        for name in cluster.names:
+            cluster.start(name)
+        try:
+            cluster.wait_leader()
+            hosts = ",".join(cluster.names)
+            deadline = time.monotonic() + args.seconds
+            workers = [
+                Worker(i, hosts, parse_mix(args.mix), args, deadline)
+                for i in range(args.workers)
+            ]
+            kills = []
+            if args.kill_every:
+                threading.Thread(
+                    target=killer,
+                    args=(cluster, args.kill_every, args.down, deadline, kills),
+                    daemon=True,
+                ).start()
+            start = time.monotonic()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                # a worker stuck in the client retries is cut off with the run
+                worker.join(max(deadline - time.monotonic(), 0) + args.grace)
+            elapsed = time.monotonic() - start
+        finally:
+            cluster.stop()
+
+    ops = {}
+    for op in OPS:
+        latencies = [latency for worker in workers for latency in worker.latencies[op]]
+        errors = sum(worker.errors[op] for worker in workers)
+        if not latencies and not errors:
+            continue
+        ops[op] = {
+            "count": len(latencies),
+            "errors": errors,
+            "ops_per_sec": round(len(latencies) / elapsed, 1),
+        }
+        if latencies:
+            for (label, p) in [("p50", 0.5), ("p99", 0.99), ("p999", 0.999)]:
+                ops[op][f"{label}_ms"] = round(percentile(latencies, p) * 1000, 2)
+    completed = [t for worker in workers for t in worker.completed]
+    return {
+        "nodes": args.nodes,
+        "workers": args.workers,
+        "mix": args.mix,
+        "seconds": round(elapsed, 2),
+        "ops_per_sec": round(len(completed) / elapsed, 1),
+        "ops": ops,
+        "kills": unavailability(kills, completed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Throughput and latency of a local kevasto cluster under load and leader kills"
+    )
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument(
+        "--mix",
+        default="put=30,get=40,log_append=20,log_fetch=8,log_drop=2",
+        help="op=weight pairs separated by commas",
+    )
+    parser.add_argument("--keys", type=int, default=1000)
+    parser.add_argument("--payload", type=int, default=256)
+    parser.add_argument("--fetch-limit", type=int, default=100)
+    parser.add_argument("--keep", type=int, default=100, help="entries log_drop leaves")
+    parser.add_argument("--durability", default="none")
+    parser.add_argument("--kill-every", type=float, default=0, help="seconds between leader kills")
+    parser.add_argument("--down", type=float, default=2, help="seconds a killed leader stays down")
+    parser.add_argument("--election-timeout", type=int, help="ms, passed to the nodes")
+    parser.add_argument("--grace", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    parser.add_argument("--replicas", help=argparse.SUPPRESS)
+    parser.add_argument("--directory", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    result = run(args)
+    print(
+        f"{result['nodes']} nodes {result['workers']} workers "
+        f"{result['ops_per_sec']} ops/s over {result['seconds']}s"
+    )
+    for (op, stats) in result["ops"].items():
+        print(
+            f"{op:<12}{stats['ops_per_sec']:>10} ops/s "
+            f"p50={stats.get('p50_ms')}ms p99={stats.get('p99_ms')}ms "
+            f"p999={stats.get('p999_ms')}ms errors={stats['errors']}"
+        )
+    for kill in result["kills"]:
+        print(f"killed leader {kill['node']}, next op completed after {kill['recovered_s']}s")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
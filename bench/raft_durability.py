@@ -0,0 +1,92 @@
+import argparse
+import json
+import logging
+import tempfile
+import time
+from threading import Thread
+
+from raft import Leader, NopVM, Raft
+from raft_log import Durability
+
+logging.basicConfig(level=logging.ERROR)
+logging.getLogger("raft").setLevel(logging.ERROR)
+
+POLICIES = [("none", 0), ("batch", 0), ("batch", 10), ("always", 0)]
+
+
+def wait_leader(raft, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not isinstance(raft.state, Leader):
+        if time.monotonic() > deadline:
+            raise Exception("no leader elected")
+        time.sleep(0.05)
+
+
+def run(policy, interval, writers, seconds, payload_size):
+    payload = {"op": "+", "store": "keyvalue", "bucket": "bench", "val": "x" * payload_size}
+    with tempfile.TemporaryDirectory() as directory:
+        raft = Raft(
+            "bench",
+            ["bench"],
+            NopVM(),
+            base_path=directory + "/raft",
+            durability=Durability(policy, interval),
+        )
+        try:
+            wait_leader(raft)
+            commits = [0] * writers
+            deadline = time.monotonic() + seconds
+
+            def writer(i):
+                while time.monotonic() < deadline:
+                    if raft.append_entry({**payload, "key": str(i)})["success"]:
+                        commits[i] += 1
+
+            start = time.monotonic()
+            threads = [Thread(target=writer, args=(i,)) for i in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - start
+            stats = raft.get_stats()
+        finally:
+            raft.close()
+    return {
+        "policy": policy,
+        "interval_ms": interval,
+        "writers": writers,
+        "commits_per_sec": round(sum(commits) / elapsed, 1),
+        "fsyncs_per_sec": round(stats["fsyncs"] / elapsed, 1),
+        "batch_size": stats["batch_size"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Commits per second of a single Raft node under each durability policy"
+    )
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--payload", type=int, default=256)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for (policy, interval) in POLICIES:
+        for writers in args.writers:
+            result = run(policy, interval, writers, args.seconds, args.payload)
+            print(
+                f"{policy:>6} {interval:>4}ms writers={writers:<3} "
+                f"{result['commits_per_sec']:>9} commits/s "
+                f"{result['fsyncs_per_sec']:>8} fsyncs/s "
+                f"batch={result['batch_size']}"
+            )
+            results.append(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import argparse
+import json
+import logging
+import tempfile
+import threading
+import time
+
+from flask import Flask
+from werkzeug.serving import make_server
+
+from kevasto import add_raft_routes
+from peer import PeerServer, PeerTransport
+from raft import Leader, NopVM, Raft
+from raft_log import Durability
+
+logging.basicConfig(level=logging.ERROR)
+logging.getLogger("raft").setLevel(logging.CRITICAL)
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+HTTP_PORT = 9301
+PEER_PORT = 9401
+
+
+def start_cluster(mode, nodes, directory, durability):
+    names = [f"127.0.0.1:{HTTP_PORT + i}" for i in range(nodes)]
+    peers = {name: ("127.0.0.1", PEER_PORT + i) for (i, name) in enumerate(names)}
+    transport = PeerTransport(resolve=peers.get) if mode == "peer" else None
+    rafts = []
+    servers = []
+    for (i, name) in enumerate(names):
+        raft = Raft(
+            name,
+            names,
+            NopVM(),
+            base_path=f"{directory}/raft{i}",
+            durability=Durability(durability),
+            transport=transport,
+        )
+        app = Flask(name)
+        add_raft_routes(app, raft)
+        server = make_server("127.0.0.1", HTTP_PORT + i, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        if mode == "peer":
+            servers.append(PeerServer([raft], port=PEER_PORT + i, host="127.0.0.1"))
+        rafts.append(raft)
+    return (rafts, servers, transport)
+
+
+def stop_cluster(rafts, servers, transport):
+    for raft in rafts:
+        raft.close()
+    for server in servers:
+        server.shutdown()
+    if transport is not None:
+        transport.close()
+
+
+def wait_leader(rafts, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for raft in rafts:
+            if isinstance(raft.state, Leader):
+                return raft
+        time.sleep(0.05)
+    raise Exception("no leader elected")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def run(mode, nodes, writers, seconds, payload_size, durability):
+    payload = {"val": "x" * payload_size}
+    with tempfile.TemporaryDirectory() as directory:
+        (rafts, servers, transport) = start_cluster(mode, nodes, directory, durability)
+        try:
+            leader = wait_leader(rafts)
+            # first round trip opens the connections
+            leader.append_entry(payload)
+            latencies = [[] for _ in range(writers)]
+            deadline = time.monotonic() + seconds
+
+            def writer(i):
+                while time.monotonic() < deadline:
+                    start = time.monotonic()
+                    if leader.append_entry(payload)["success"]:
+                        latencies[i].append(time.monotonic() - start)
+
+            start = time.monotonic()
+            threads = [threading.Thread(target=writer, args=(i,)) for i in range(writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - start
+        finally:
+            stop_cluster(rafts, servers, transport)
+    latencies = [latency for values in latencies for latency in values]
+    return {
+        "mode": mode,
+        "writers": writers,
+        "commits_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replication latency of a Raft cluster over HTTP and the peer transport"
+    )
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--writers", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--payload", type=int, default=256)
+    parser.add_argument("--durability", default="none")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    for mode in ["http", "peer"]:
+        for writers in args.writers:
+            result = run(
+                mode, args.nodes, writers, args.seconds, args.payload, args.durability
+            )
+            print(
+                f"{mode:>5} writers={writers:<3} "
+                f"{result['commits_per_sec']:>8} commits/s "
+                f"p50={result['p50_ms']}ms p99={result['p99_ms']}ms"
+            )
+            results.append(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bench.dataset import Dataset, chunks
+from factory import count_key
+import business.main
+import comment.main
+import comment.mapper_main
+import funny.main
+import funny.mapper_main
+import histogram.mapper_main
+import router.main
+import stars5.main
+import stars5.mapper_main
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def mapped(fn, inputs):
+    return [fn(chunk) for chunk in inputs]
+
+
+def reduced(step_fn, inputs):
+    acc = {}
+    for chunk in inputs:
+        acc = step_fn(acc, chunk)
+    return acc
+
+
+class Inputs:
+    # every stage input derived from the same synthetic dataset, built lazily
+    def __init__(self, args) -> None:
+        self.args = args
+        self.cache = {}
+        self.dataset = Dataset(
+            users=args.users,
+            businesses=args.businesses,
+            user_skew=args.user_skew,
+            business_skew=args.business_skew,
+            text_length=args.text_length,
+            seed=args.seed,
+        )
+
+    def get(self, name):
+        if name not in self.cache:
+            self.cache[name] = getattr(self, name)()
+        return self.cache[name]
+
+    def reviews(self):
+        return list(chunks(self.dataset.reviews(self.args.reviews), self.args.chunk))
+
+    def business(self):
+        return list(chunks(self.dataset.business(), self.args.chunk))
+
+    def routed_users(self):
+        return mapped(router.main.users, self.get("reviews"))
+
+    def routed_funny(self):
+        return mapped(router.main.funny, self.get("reviews"))
+
+    def routed_histogram(self):
+        return mapped(router.main.histogram, self.get("reviews"))
+
+    def routed_business(self):
+        return mapped(router.main.route_business, self.get("business"))
+
+    def business_city(self):
+        return reduced(business.main.build_business_city_dict, self.get("routed_business"))
+
+    def user_text(self):
+        return mapped(comment.mapper_main.map_user_text, self.get("reviews"))
+
+    def stars(self):
+        return mapped(stars5.mapper_main.map_stars, self.get("reviews"))
+
+    def weekdays(self):
+        return mapped(histogram.mapper_main.map_histogram, self.get("routed_histogram"))
+
+    def funny_cities(self):
+        city = self.get("business_city")
+        return [
+            funny.mapper_main.map_business(city, chunk)
+            for chunk in self.get("routed_funny")
+        ]
+
+    def user_count(self):
+        return reduced(count_key("user_id"), self.get("routed_users"))
+
+    def stars_count(self):
+        return reduced(count_key("user_id"), self.get("stars"))
+
+    def comment_count(self):
+        return reduced(comment.main.user_comment_counter, self.get("user_text"))
+
+    def funny_count(self):
+        return reduced(count_key("city"), self.get("funny_cities"))
+
+
+def rows(inputs):
+    return sum(len(chunk) for chunk in inputs)
+
+
+def map_case(fn, source):
+    def case(inputs):
+        data = inputs.get(source)
+        return (rows(data), lambda: mapped(fn, data))
+
+    return case
+
+
+def step_case(step_fn, source):
+    def case(inputs):
+        data = inputs.get(source)
+        return (rows(data), lambda: reduced(step_fn, data))
+
+    return case
+
+
+def join_case(join_fn, left, right):
+    def case(inputs):
+        (left_acc, right_acc) = (inputs.get(left), inputs.get(right))
+        return (len(left_acc), lambda: join_fn(left_acc, right_acc))
+
+    return case
+
+
+def funny_case(inputs):
+    city = inputs.get("business_city")
+    data = inputs.get("routed_funny")
+    return (
+        rows(data),
+        lambda: [funny.mapper_main.map_business(city, chunk) for chunk in data],
+    )
+
+
+def top_funny_case(inputs):
+    acc = inputs.get("funny_count")
+    return (len(acc), lambda: funny.main.topTenFunnyPerCity(acc))
+
+
+CASES = {
+    "router.funny": map_case(router.main.funny, "reviews"),
+    "router.comment": map_case(router.main.comment, "reviews"),
+    "router.users": map_case(router.main.users, "reviews"),
+    "router.stars5": map_case(router.main.stars5, "reviews"),
+    "router.histogram": map_case(router.main.histogram, "reviews"),
+    "router.route_business": map_case(router.main.route_business, "business"),
+    "stars5_mapper.map_stars": map_case(stars5.mapper_main.map_stars, "reviews"),
+    "comment_mapper.map_user_text": map_case(
+        comment.mapper_main.map_user_text, "reviews"
+    ),
+    "histogram_mapper.map_histogram": map_case(
+        histogram.mapper_main.map_histogram, "routed_histogram"
+    ),
+    "funny_mapper.map_business": funny_case,
+    "business.build_business_city_dict": step_case(
+        business.main.build_business_city_dict, "routed_business"
+    ),
+    "users.count_key": step_case(count_key("user_id"), "routed_users"),
+    "histogram.count_key": step_case(count_key("weekday"), "weekdays"),
+    "funny.count_key": step_case(count_key("city"), "funny_cities"),
+    "stars5.count_key": step_case(count_key("user_id"), "stars"),
+    "comment.user_comment_counter": step_case(
+        comment.main.user_comment_counter, "user_text"
+    ),
+    "stars5.join": join_case(stars5.main.join, "stars_count", "user_count"),
+    "comment.join": join_case(comment.main.join, "comment_count", "user_count"),
+    "funny.topTenFunnyPerCity": top_funny_case,
+}
+
+
+def run_case(name, args):
+    # runs in its own process so the peak RSS belongs to this case only
+    inputs = Inputs(args)
+    (count, run) = CASES[name](inputs)
+    baseline_rss = peak_rss_kb()
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        "case": name,
+        "rows": count,
+        "rows_per_sec": round(count / best, 1) if best else None,
+        "seconds": round(best, 6),
+        "peak_rss_kb": peak_rss_kb(),
+        "case_rss_kb": peak_rss_kb() - baseline_rss,
+    }
+
+
+def compare(results, baseline, tolerance):
+    previous = {result["case"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result["case"])
+        if before is None or not before["rows_per_sec"]:
+            continue
+        change = result["rows_per_sec"] / before["rows_per_sec"] - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  REGRESSION"
+            regressions.append(result["case"])
+        print(f"{result['case']:<36}{change * 100:>+8.1f}%{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="In-process throughput of every stage map/step function"
+    )
+    parser.add_argument("--reviews", type=int, default=100000)
+    parser.add_argument("--businesses", type=int, default=2000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--user-skew", type=float, default=1.0)
+    parser.add_argument("--business-skew", type=float, default=0.8)
+    parser.add_argument("--text-length", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk", type=int, default=1000, help="rows per chunk")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", nargs="+", default=list(CASES))
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON to compare rows/sec against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    results = []
+    context = multiprocessing.get_context("fork")
+    for name in args.cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_case, name, args).result()
+        print(
+            f"{name:<36}{result['rows_per_sec']:>14} rows/s "
+            f"peak_rss={result['peak_rss_kb'] // 1024}MB"
+        )
+        results.append(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = [
+    "router.main",
+    "business.main",
+    "users.main",
+    "histogram.main",
+    "histogram.mapper_main",
+    "stars5.main",
+    "stars5.mapper_main",
+    "comment.main",
+    "comment.mapper_main",
+    "funny.main",
+    "funny.mapper_main",
+    "control_server",
+]
+
+
+def child(stage, queue):
+    # what a restarted stage does before it can consume: start the
+    # interpreter, import its modules, resolve who it is, reach its queue
+    spawned = float(os.environ["STARTUP_SPAWNED"])
+    result = {"stage": stage, "interpreter": time.time() - spawned}
+    start = time.perf_counter()
+    importlib.import_module(stage)
+    result["import"] = time.perf_counter() - start
+
+    from node import node_name
+
+    start = time.perf_counter()
+    try:
+        node_name()
+        result["identity"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(100):
+            node_name()
+        result["identity_cached"] = (time.perf_counter() - start) / 100
+    except Exception as e:
+        result["identity"] = None
+        result["identity_error"] = repr(e)
+
+    if queue:
+        from pipe import Pipe
+
+        start = time.perf_counter()
+        pipe = Pipe(exchange="", routing_key="", queue=queue)
+        for (payload, ack) in pipe.recv(inactivity_timeout=1):
+            if payload is not None:
+                ack()
+                break
+        result["first_message"] = time.perf_counter() - start
+    result["total"] = time.time() - spawned
+    print(json.dumps(result))
+
+
+def publish(queue):
+    import pika
+
+    connection = pika.BlockingConnection(pika.URLParameters(os.environ["AMQP_URL"]))
+    channel = connection.channel()
+    channel.queue_declare(queue=queue, durable=True)
+    channel.basic_publish(
+        exchange="",
+        routing_key=queue,
+        body=json.dumps({"session_id": "bench", "data": []}),
+    )
+    return (connection, channel)
+
+
+def run(stage, env):
+    queue = None
+    connection = None
+    if os.environ.get("AMQP_URL"):
+        queue = f"bench_startup_{os.getpid()}"
+        (connection, channel) = publish(queue)
+    env = {**env, "STARTUP_SPAWNED": repr(time.time())}
+    try:
+        out = subprocess.run(
+            [sys.executable, "-m", "bench.startup", "--child", stage, "--queue", queue or ""],
+            cwd=ROOT,
+            env=env,
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+    finally:
+        if connection is not None:
+            channel.queue_delete(queue=queue)
+            connection.close()
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def ms(value):
+    return "-" if value is None else f"{value * 1000:.1f}ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time from spawn to first message for freshly started stages"
+    )
+    parser.add_argument("--stages", nargs="+", default=STAGES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--node-name",
+        help="set NODE_NAME for the stages, otherwise docker is asked once",
+    )
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--queue", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.queue)
+        return
+    env = dict(os.environ)
+    if args.node_name:
+        env["NODE_NAME"] = args.node_name
+    results = []
+    for stage in args.stages:
+        # best of repeat, the first run also pays for a cold page cache
+        runs = [run(stage, env) for _ in range(args.repeat)]
+        result = min(runs, key=lambda r: r["total"])
+        print(
+            f"{stage:<24}interpreter={ms(result['interpreter'])} "
+            f"import={ms(result['import'])} identity={ms(result.get('identity'))} "
+            f"first_message={ms(result.get('first_message'))} total={ms(result['total'])}"
+        )
+        results.append(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
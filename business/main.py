@@ -1,42 +1,46 @@
 from health_server import HealthServer, get_my_ip
 import pipe
 import logging
-from factory import reducer
+from factory import drop_state, reducer_sessions, session_name, sessions
 from dedup import AggregatorDedup
 from control_server import ControlClient
 
 logger = logging.getLogger(__name__)
 
 
-def main():
-    def build_business_city_dict(acc, data):
-        for elem in data:
-            acc[elem["business_id"]] = elem["city"]
-        return acc
+def build_business_city_dict(acc, data):
+    for elem in data:
+        acc[elem["business_id"]] = elem["city"]
+    return acc
+
 
+def main():
     with HealthServer():
         dedup = AggregatorDedup("business")
         controlClient = ControlClient()
         control = pipe.pub_sub_control()
-        for payload, ack in control.recv():
-            if not dedup.is_batch_processed(payload["session_id"]):
-                logger.info("batch %s", payload)
-                reducer(
-                    pipe_in=pipe.business_cities_summary(),
-                    pipe_out=pipe.pub_funny_business_cities(),
-                    step_fn=build_business_city_dict,
-                    batch_id=payload["session_id"],
-                    dedup=dedup,
+        bucket_name = get_my_ip()
+
+        def done(session_id):
+            drop_state(dedup.db, session_name(bucket_name, session_id))
+            controlClient.batch_done(session_id, bucket_name)
+
+        sessions(
+            control,
+            [
+                (
+                    pipe.business_cities_summary(),
+                    dedup,
+                    reducer_sessions(
+                        make_pipe_out=pipe.pub_funny_business_cities,
+                        step_fn=build_business_city_dict,
+                        dedup=dedup,
+                        name=bucket_name,
+                    ),
                 )
-            bucket_name = get_my_ip()
-            dedup.db.log_drop(bucket_name + "_processed", None)
-            dedup.db.log_drop(bucket_name, None)
-            dedup.db.delete(
-                bucket_name,
-                "state",
-            )
-            controlClient.batch_done(payload["session_id"], bucket_name)
-            ack()
+            ],
+            done,
+        )
 
 
 if __name__ == "__main__":
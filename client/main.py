@@ -5,6 +5,7 @@ import pprint
 import logging
 import pipe
 from control_server import ControlClient
+from tracing import tracer
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger("client")
@@ -35,6 +36,7 @@ def publish_file(
                             "data": chunk,
                             "session_id": session_id,
                             "id": item_count,
+                            "trace": tracer.origin(session_id, f"{pipe_out.queue}:{item_count}"),
                         }
                     )
                     if pause is not None and item_count > pause:
@@ -51,9 +53,10 @@ def publish_file(
 
 
 def main():
-    session_id = 1
+    # session ids travel as str, the control server gets them from its URLs
+    session_id = "1"
     if len(sys.argv) > 1:
-        session_id = int(sys.argv[1])
+        session_id = str(int(sys.argv[1]))
 
     res = ControlClient().request(session_id)
     if res.status_code == 500:
@@ -77,6 +80,7 @@ def main():
             "id": items + 1,
             "data": None,
             "session_id": session_id,
+            "trace": tracer.origin(session_id, "business:eof"),
         }
     )
 
@@ -95,12 +99,14 @@ def main():
             "data": None,
             "reply": "reports",
             "session_id": session_id,
+            "trace": tracer.origin(session_id, "review:eof"),
         }
     )
 
     logger.info("waiting report")
     report = {}
     for payload, ack in reports.recv():
+        tracer.finish(tracer.start(payload, "report"))
         ack()
         if payload["session_id"] != session_id:
             continue
@@ -114,7 +120,10 @@ def main():
         for key, val in report.items():
             text_file.write(f"{key} = {pprint.pformat(val)}\n")
 
+    logger.info("waiting for every stage to finish the session")
+    ControlClient().wait(session_id)
 
+    tracer.flush()
     logger.info("end session %s", session_id)
     reports.close()
     business.close()
@@ -1,7 +1,11 @@
 from typing import Dict, cast
-from flask import Flask, make_response, jsonify
+from flask import Flask, make_response, jsonify, request
+from werkzeug.serving import make_server
 import requests
 import logging
+import os
+import threading
+import time
 from kevasto import Client
 from health_server import HealthServer
 import pipe
@@ -11,76 +15,162 @@ logging.basicConfig()
 logger = logging.getLogger("Control")
 logger.setLevel(logging.INFO)
 
+# seconds, retries back off exponentially up to the max
+RETRY_BACKOFF = float(os.environ.get("CONTROL_RETRY_BACKOFF", 0.1))
+RETRY_BACKOFF_MAX = float(os.environ.get("CONTROL_RETRY_BACKOFF_MAX", 5))
+WAIT_TIMEOUT = float(os.environ.get("CONTROL_WAIT_TIMEOUT", 30))
+MAX_SESSIONS = int(os.environ.get("CONTROL_MAX_SESSIONS", 4))
+
+
+def with_backoff(fn):
+    delay = RETRY_BACKOFF
+    while True:
+        try:
+            return fn()
+        except requests.exceptions.RequestException as e:
+            logger.info(f"control server unreachable ({e}), retrying in {delay}s")
+        time.sleep(delay)
+        delay = min(delay * 2, RETRY_BACKOFF_MAX)
+
 
 class ControlClient:
     def __init__(self):
         self.baseUrl = "http://tp3_control_1:80"
+        self.done = None
 
     def request(self, requestId):
-        answer = False
-        while not answer:
-            try:
-                res = requests.post(f"{self.baseUrl}/request/{requestId}")
-                answer = True
-            except:
-                pass
-        return res
+        return with_backoff(
+            lambda: requests.post(f"{self.baseUrl}/request/{requestId}")
+        )
 
     def batch_done(self, batchId, pid):
-        answer = False
-        while not answer:
-            try:
-                res = requests.post(f"{self.baseUrl}/batch/{batchId}/{pid}")
-                answer = True
-            except:
-                pass
-        return res
+        # consumed by the control server, the stage does not wait for it
+        if self.done is None:
+            self.done = pipe.control_done()
+        self.done.send({"session_id": batchId, "pid": pid})
+
+    def wait(self, requestId, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            poll = WAIT_TIMEOUT
+            if deadline is not None:
+                poll = min(poll, max(deadline - time.monotonic(), 0))
+            res = with_backoff(
+                lambda: requests.get(
+                    f"{self.baseUrl}/request/{requestId}/wait",
+                    params={"timeout": poll},
+                    timeout=poll + 10,
+                )
+            )
+            if res.status_code == 404:
+                return False
+            if res.ok and res.json().get("done"):
+                return True
+        return False
 
 
 class ControlServer(HealthServer):
     def __init__(self):
         self.batchControlChannel = pipe.pub_sub_control()
+        # pika channels are not thread-safe, request threads publish through
+        # this one thread and its own connection
+        self.publisher = pipe.Publisher(MAX_SESSIONS)
         self.controlDedup = ControlDedup("control")
+        # guards controlDedup, notified whenever a batch completes
+        self.completed = threading.Condition()
         self.app = Flask(__name__)
         log = logging.getLogger("werkzeug")
         log.setLevel(logging.ERROR)
         self.__route_control_endpoints()
+        self.consumer = threading.Thread(target=self.consume_done, daemon=True)
+        self.consumer.start()
         super().run_server()
 
+    def serve(self):
+        # threaded, waiting clients hold a connection for up to WAIT_TIMEOUT
+        make_server("0.0.0.0", 80, self.app, threaded=True).serve_forever()
+
+    def consume_done(self):
+        while True:
+            try:
+                with pipe.control_done() as done:
+                    for payload, ack in done.recv():
+                        self.batch_done(str(payload["session_id"]), payload["pid"])
+                        ack()
+            except Exception:
+                logger.exception("control done queue failed, reconnecting")
+                time.sleep(RETRY_BACKOFF_MAX)
+
+    def batch_done(self, batchId, pid):
+        logger.info(f"new done batch id {batchId} signal from {pid}")
+        with self.completed:
+            if not self.controlDedup.is_batch_processed(
+                batchId
+            ) and self.controlDedup.is_request_attended(batchId):
+                self.controlDedup.set_pid_done(batchId, pid)
+                if self.controlDedup.are_all_pids_done(batchId):
+                    self.controlDedup.set_processed_batch(batchId)
+                    self.controlDedup.clear_pids_done(batchId)
+                    logger.info(f"batch {batchId} completed")
+                    self.completed.notify_all()
+                self.controlDedup.persist_state()
+
+    def publish(self, data):
+        # returns once data is out, called with self.completed held
+        if self.publisher.error is not None:
+            logger.info(f"control publisher failed ({self.publisher.error}), restarting")
+            self.publisher = pipe.Publisher(MAX_SESSIONS)
+        publisher = self.publisher
+        published = threading.Event()
+        publisher.send_to(
+            self.batchControlChannel.exchange, self.batchControlChannel.routing_key, data
+        )
+        publisher.ack(published.set)
+        while not published.wait(1):
+            if publisher.error is not None:
+                raise publisher.error
+
         # Assumption: requestId is unique
 
     def __route_control_endpoints(self):
         @self.app.route("/request/<requestId>", methods=["POST"])
         def client_request_handler(requestId):
             logger.info(f"New client request with id={requestId}")
-            if self.controlDedup.is_batch_processed(requestId):
-                return make_response({"error": "duplicated request id"}, 500)
-            if self.controlDedup.is_request_attended(requestId):
-                return make_response({"ok": "request alredy attended"}, 200)
-            if self.controlDedup.are_all_pids_done():
-                self.batchControlChannel.send({"session_id": requestId})
-                self.controlDedup.clear_pids_done()
-                self.controlDedup.set_request_attended(requestId)
-                self.controlDedup.persist_state()
-                return make_response({"ok": "properly received request"}, 200)
+            with self.completed:
+                if self.controlDedup.is_batch_processed(requestId):
+                    return make_response({"error": "duplicated request id"}, 500)
+                if self.controlDedup.is_request_attended(requestId):
+                    return make_response({"ok": "request alredy attended"}, 200)
+                if self.controlDedup.sessions_in_flight() < MAX_SESSIONS:
+                    self.publish({"session_id": requestId})
+                    self.controlDedup.set_request_attended(requestId)
+                    self.controlDedup.persist_state()
+                    return make_response({"ok": "properly received request"}, 200)
             return make_response(
-                {"error": "server unavailable to attend requests"}, 500
+                {"error": "too many sessions in flight"}, 500
             )
 
+        @self.app.route("/request/<requestId>/wait", methods=["GET"])
+        def wait_request_handler(requestId):
+            timeout = min(request.args.get("timeout", WAIT_TIMEOUT, type=float), WAIT_TIMEOUT)
+            with self.completed:
+                if not self.controlDedup.is_request_attended(requestId):
+                    return make_response({"error": "unknown request id"}, 404)
+                done = self.completed.wait_for(
+                    lambda: self.controlDedup.is_batch_processed(requestId), timeout
+                )
+            return make_response({"done": done}, 200)
+
         @self.app.route("/batch/<batchId>/<pid>", methods=["POST"])
         def batch_done_handler(batchId, pid):
-            logger.info(f"new done batch id {batchId} signal from {pid}")
-            if not self.controlDedup.is_batch_processed(
-                batchId
-            ) and self.controlDedup.is_request_attended(batchId):
-                self.controlDedup.set_pid_done(pid)
-                if self.controlDedup.are_all_pids_done():
-                    self.controlDedup.set_processed_batch(batchId)
-                    logger.info(f"batch {batchId} completed")
-                self.controlDedup.persist_state()
+            self.batch_done(batchId, pid)
             return make_response({}, 200)
 
     def stop(self):
+        try:
+            self.publisher.close()
+        except Exception:
+            logger.exception("on close")
         self.batchControlChannel.close()
         exit(0)
 
@@ -1,8 +1,223 @@
-import signal, faulthandler
+import cProfile
+import faulthandler
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from itertools import islice
+
+# profiles land here, mounted from the host in docker-compose
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+# sample (all threads, low overhead) or cprofile (every call, all threads on 3.12+)
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "sample")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+# frames kept per allocation, tracemalloc starts with the process when > 0
+MEMORY_TRACE = int(os.environ.get("MEMORY_TRACE", 0))
+MEMORY_TOP = int(os.environ.get("MEMORY_TOP", 25))
+# entries looked at to estimate the size of a container
+SIZE_SAMPLE = int(os.environ.get("SIZE_SAMPLE", 64))
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profiler:
+    def __init__(self, directory=PROFILE_DIR, mode=PROFILE_MODE, interval=PROFILE_INTERVAL):
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = None
+        self.started = None
+        self.profile = None
+        self.stacks = None
+        self.sampler = None
+
+    def start(self, mode=None, interval=None):
+        with self.lock:
+            if self.running is not None:
+                return False
+            mode = mode or self.mode
+            if mode not in ("sample", "cprofile"):
+                raise ValueError(f"unknown profile mode {mode}")
+            self.running = mode
+            self.started = time.time()
+            if mode == "cprofile":
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+            else:
+                self.stacks = Counter()
+                self.sampler = threading.Thread(
+                    target=self.sample, args=(interval or self.interval,), daemon=True
+                )
+                self.sampler.start()
+            return True
+
+    def sample(self, interval):
+        me = threading.get_ident()
+        while self.running == "sample":
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for (ident, frame) in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+
+    def stop(self):
+        # returns the written file, None when nothing was running
+        with self.lock:
+            mode, self.running = self.running, None
+            if mode is None:
+                return None
+            os.makedirs(self.directory, exist_ok=True)
+            name = f"{socket.gethostname()}-{os.getpid()}-{int(self.started)}"
+            if mode == "cprofile":
+                self.profile.disable()
+                path = os.path.join(self.directory, name + ".pstats")
+                self.profile.dump_stats(path)
+                self.profile = None
+            else:
+                self.sampler.join()
+                # collapsed stacks, input for flamegraph.pl or speedscope
+                path = os.path.join(self.directory, name + ".collapsed")
+                with open(path, "w") as f:
+                    for (stack, count) in self.stacks.most_common():
+                        f.write(f"{stack} {count}\n")
+                self.stacks = None
+            return path
+
+    def toggle(self):
+        if self.running is None:
+            self.start()
+            return None
+        return self.stop()
+
+    def status(self):
+        return {
+            "running": self.running,
+            "started": self.started if self.running else None,
+            "directory": self.directory,
+        }
+
+
+profiler = Profiler()
+
+
+class Memory:
+    def __init__(self, directory=PROFILE_DIR, frames=MEMORY_TRACE) -> None:
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.last = None
+        if frames > 0:
+            tracemalloc.start(frames)
+
+    def start(self, frames=1):
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(frames)
+        return True
+
+    def stop(self):
+        if not tracemalloc.is_tracing():
+            return False
+        tracemalloc.stop()
+        with self.lock:
+            self.last = None
+        return True
+
+    def snapshot(self, top=MEMORY_TOP, key="lineno", compare=False, dump=False):
+        # top allocation sites, or the growth since the previous snapshot
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+        )
+        (current, peak) = tracemalloc.get_traced_memory()
+        result = {"current": current, "peak": peak}
+        with self.lock:
+            previous, self.last = self.last, snapshot
+        if compare and previous is not None:
+            stats = snapshot.compare_to(previous, key)
+            result["top"] = [
+                {
+                    "where": str(stat.traceback),
+                    "size": stat.size,
+                    "size_diff": stat.size_diff,
+                    "count": stat.count,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats[:top]
+            ]
+        else:
+            result["top"] = [
+                {"where": str(stat.traceback), "size": stat.size, "count": stat.count}
+                for stat in snapshot.statistics(key)[:top]
+            ]
+        if dump:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(
+                self.directory,
+                f"{socket.gethostname()}-{os.getpid()}-{int(time.time())}.tracemalloc",
+            )
+            snapshot.dump(path)
+            result["path"] = path
+        return result
+
+
+memory = Memory()
+
+
+def approx_size(obj, sample=SIZE_SAMPLE, depth=3, seen=None):
+    # bytes of obj and what it holds, extrapolated from its first entries;
+    # objects shared between entries (keys, small ints) count once
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if depth == 0:
+        return size
+    if isinstance(obj, dict):
+        entries = [
+            approx_size(key, sample, depth - 1, seen)
+            + approx_size(value, sample, depth - 1, seen)
+            for (key, value) in islice(obj.items(), sample)
+        ]
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        entries = [
+            approx_size(value, sample, depth - 1, seen) for value in islice(obj, sample)
+        ]
+    else:
+        return size
+    if entries:
+        size += sum(entries) * len(obj) // len(entries)
+    return size
 
 
 def dump_traceback(sig, frame):
     faulthandler.dump_traceback()
 
 
+def toggle_profile(sig, frame):
+    # the handler runs on the main thread, the profile is written from a
+    # thread so a stage stuck in I/O is not kept waiting
+    threading.Thread(target=profiler.toggle, daemon=True).start()
+
+
 signal.signal(signal.SIGUSR1, dump_traceback)  # Register handler
+signal.signal(signal.SIGUSR2, toggle_profile)
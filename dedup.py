@@ -2,44 +2,110 @@ from kevasto import Client
 from typing import cast, Dict
 import os
 
-def serialize_set(set):
-    return ','.join([str(i) for i in list(set)])
+DEDUP_COMPACT_DELTAS = int(os.environ.get("DEDUP_COMPACT_DELTAS", 100))
+
+
+# A set stored as a snapshot document plus a kevasto log of deltas, a persist
+# only appends the ids added (or a clear) since the previous one. Ids are kept
+# as strings so they compare the same before and after a restart.
+class DeltaSet:
+
+    def __init__(self, db, name, initial=()):
+        self.db = db
+        self.name = name
+        self.ids = set(str(i) for i in initial)
+        self.added = list(self.ids)
+        self.removed = []
+        self.cleared = False
+        self.seq = 0
+        self.deltas = 0
+
+    def load(self):
+        snapshot = cast(Dict, self.db.get(self.name, "snapshot"))
+        start = 0
+        if snapshot:
+            self.ids = set(snapshot["ids"])
+            self.added = []
+            start = snapshot["seq"]
+        deltas = self.db.log_fetch(self.name, start) or []
+        for delta in deltas:
+            if delta.get("clear"):
+                self.ids = set()
+            self.ids.difference_update(delta.get("remove", []))
+            self.ids.update(delta["add"])
+        if deltas:
+            self.added = []
+        self.seq = start + len(deltas)
+        self.deltas = len(deltas)
+        return bool(snapshot) or len(deltas) > 0
+
+    def persist(self):
+        if not self.added and not self.removed and not self.cleared:
+            return
+        delta = {"add": self.added}
+        if self.cleared:
+            delta["clear"] = True
+        if self.removed:
+            delta["remove"] = self.removed
+        self.db.log_append(self.name, delta)
+        self.added = []
+        self.removed = []
+        self.cleared = False
+        self.seq += 1
+        self.deltas += 1
+        if self.deltas >= DEDUP_COMPACT_DELTAS:
+            self.compact()
+
+    def compact(self):
+        self.db.put(self.name, "snapshot", {"ids": list(self.ids), "seq": self.seq})
+        self.db.log_drop(self.name, self.seq)
+        self.deltas = 0
+
+    def add(self, i):
+        i = str(i)
+        if i not in self.ids:
+            self.ids.add(i)
+            self.added.append(i)
+
+    def discard(self, i):
+        i = str(i)
+        if i in self.ids:
+            self.ids.discard(i)
+            if i in self.added:
+                self.added.remove(i)
+            else:
+                self.removed.append(i)
+
+    def clear(self):
+        self.ids = set()
+        self.added = []
+        self.removed = []
+        self.cleared = True
+
+    def __contains__(self, i):
+        return str(i) in self.ids
 
-def deserialize_set(str):
-    return set([i for i in str.split(',')])
 
 class Dedup:
 
     def __init__(self, stageName):
-        self.processedBatches = set()
         self.db = Client()
         self.name = stageName + "_dedup"
+        self.processedBatches = DeltaSet(self.db, self.name + "_processed_batches")
+        self.sets = [self.processedBatches] + self.extension_sets()
         self.retrieve_initial_state()
 
     def retrieve_initial_state(self):
-        self.state = cast(Dict, self.db.get(self.name, "processed"))
-        if self.state:
-            self.processedBatches = deserialize_set(self.state.get("processed_batches"))
-            self.retrieve_extension()
-        else:
+        found = [deltaSet.load() for deltaSet in self.sets]
+        if not any(found):
             self.persist_state()
 
     def persist_state(self):
-        processed = {
-            "processed_batches" : serialize_set(self.processedBatches),
-        }
-        processed = self.persist_extension(processed)
-        self.db.put(
-            self.name,
-            "processed",
-            processed,
-        )
-
-    def retrieve_extension(self):
-        return
-
-    def persist_extension(self, processed):
-        return processed
+        for deltaSet in self.sets:
+            deltaSet.persist()
+
+    def extension_sets(self):
+        return []
 
     def set_processed_batch(self, batchId):
         self.processedBatches.add(batchId)
@@ -49,16 +115,9 @@ class Dedup:
 
 
 class BusinessDedup(Dedup):
-    def __init__(self, stageName):
-        self.processedBussinessBatches = set()
-        super().__init__(stageName)
-
-    def retrieve_extension(self):
-        self.processedBussinessBatches = deserialize_set(self.state.get("processed_bussiness_batches"))
-
-    def persist_extension(self, processed):
-        processed["processed_bussiness_batches"] = serialize_set(self.processedBussinessBatches)
-        return processed
+    def extension_sets(self):
+        self.processedBussinessBatches = DeltaSet(self.db, self.name + "_processed_bussiness_batches")
+        return [self.processedBussinessBatches]
 
     def is_bussiness_batch_processed(self, bussinessBatchId):
         return bussinessBatchId in self.processedBussinessBatches
@@ -68,16 +127,9 @@ class BusinessDedup(Dedup):
 
 
 class AggregatorDedup(Dedup):
-    def __init__(self, stageName):
-        self.processedMessages = set()
-        super().__init__(stageName)
-
-    def retrieve_extension(self):
-        self.processedMessages = deserialize_set(self.state.get("processed_messages"))
-
-    def persist_extension(self, processed):
-        processed["processed_messages"] = serialize_set(self.processedMessages)
-        return processed
+    def extension_sets(self):
+        self.processedMessages = DeltaSet(self.db, self.name + "_processed_messages")
+        return [self.processedMessages]
 
     def set_processed_message(self, messageId):
         self.processedMessages.add(messageId)
@@ -86,32 +138,26 @@ class AggregatorDedup(Dedup):
         return messageId in self.processedMessages
 
     def clear_processed_messages(self):
-        self.processedMessages = set()
+        self.processedMessages.clear()
 
 class ControlDedup(Dedup):
-    def __init__(self, stageName):
-        self.donePids = self.__get_all_pids()
-        self.attendedRequests = set()
-        super().__init__(stageName)
-
-    def retrieve_extension(self):
-        self.donePids = deserialize_set(self.state.get("done_pids"))
-        self.attendedRequests = deserialize_set(self.state.get("attended_requests"))
+    # pids that finished a session are kept as "<session>/<pid>" until every
+    # pid is done with it, several sessions can be in flight
+    def extension_sets(self):
+        self.allPids = self.__get_all_pids()
+        self.donePids = DeltaSet(self.db, self.name + "_session_pids")
+        self.attendedRequests = DeltaSet(self.db, self.name + "_attended_requests")
+        return [self.donePids, self.attendedRequests]
 
-    def persist_extension(self, processed):
-        processed["done_pids"] = serialize_set(self.donePids)
-        processed["attended_requests"] = serialize_set(self.attendedRequests)
-        return processed
+    def set_pid_done(self, requestId, pid):
+        self.donePids.add(f"{requestId}/{pid}")
 
-    def set_pid_done(self, pid):
-        self.donePids.add(pid)
+    def clear_pids_done(self, requestId):
+        for pid in self.allPids:
+            self.donePids.discard(f"{requestId}/{pid}")
 
-    def clear_pids_done(self):
-        self.donePids = set()
-
-    def are_all_pids_done(self):
-        print(f"pids done {self.donePids}")
-        return self.donePids == self.__get_all_pids()
+    def are_all_pids_done(self, requestId):
+        return all(f"{requestId}/{pid}" in self.donePids for pid in self.allPids)
 
     def set_request_attended(self, requestId):
         self.attendedRequests.add(requestId)
@@ -119,6 +165,9 @@ class ControlDedup(Dedup):
     def is_request_attended(self, requestId):
         return requestId in self.attendedRequests
 
+    def sessions_in_flight(self):
+        return len(self.attendedRequests.ids - self.processedBatches.ids)
+
     def __get_all_pids(self):
         pids = set()
         for processKey in [
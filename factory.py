@@ -1,23 +1,26 @@
 import os
-from threading import Thread
+from threading import Condition, Event, Lock, Thread
 
 from kevasto import Client
-from filters import Filter, Join, Keep, Mapper, Notify, Persistent, Reducer
+from filters import (
+    SESSION_POLL,
+    Await,
+    Filter,
+    Join,
+    Keep,
+    Mapper,
+    Notify,
+    Persistent,
+    Reducer,
+    Sessions,
+)
 import logging
-import docker
+from node import node_name
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def node_name():
-    client = docker.from_env()
-    container = client.containers.get(os.environ["HOSTNAME"])
-    host_name = container.name
-    client.close()
-    return host_name
-
-
 def count_key(key):
     def key_counter(acc, data):
         for elem in data:
@@ -159,4 +162,166 @@ def joiner(
     thread.join()
 
 
+def session_name(name, session_id):
+    return f"{name}_{session_id}"
+
+
+def drop_state(db, name):
+    db.log_drop(name + "_processed", None)
+    db.log_drop(name, None)
+    db.delete(name, "state")
+
+
+def mapper_sessions(make_pipe_out, map_fn, dedup, workers=0, ready=None):
+    # ready(session_id) holds the messages of a session back until it is true
+    def make_cursor(session_id):
+        cursor = Mapper(map_fn=map_fn, pipe_out=make_pipe_out(), workers=workers)
+        if ready is not None:
+            cursor = Await(cursor, lambda: ready(session_id))
+        return Keep(cursor, session_id, dedup)
+
+    return make_cursor
+
+
+def reducer_sessions(make_pipe_out, step_fn, dedup, name):
+    def make_cursor(session_id):
+        return tolerant(
+            Reducer(step_fn=step_fn, pipe_out=make_pipe_out()),
+            session_id,
+            dedup,
+            session_name(name, session_id),
+        )
+
+    return make_cursor
+
+
+def sink_sessions(observer, dedup, name):
+    def make_cursor(session_id):
+        return tolerant(
+            Notify(
+                observer=lambda acc: observer(session_id, acc),
+                dedup=dedup,
+                batch_id=session_id,
+            ),
+            session_id,
+            dedup,
+            session_name(name, session_id),
+        )
+
+    return make_cursor
+
+
+class JoinSessions:
+    def __init__(self, left_fn, right_fn, make_pipe_out, join_fn, dedup_left, dedup_right, name):
+        self.left_fn = left_fn
+        self.right_fn = right_fn
+        self.make_pipe_out = make_pipe_out
+        self.join_fn = join_fn
+        self.dedup_left = dedup_left
+        self.dedup_right = dedup_right
+        self.left_name = name + "_left"
+        self.right_name = name + "_right"
+        self.joins = {}
+        self.lock = Lock()
+
+    def join(self, session_id):
+        with self.lock:
+            if session_id not in self.joins:
+                self.joins[session_id] = Join(self.join_fn, self.make_pipe_out())
+            return self.joins[session_id]
+
+    def left(self, session_id):
+        return tolerant(
+            self.join(session_id).left(self.left_fn),
+            session_id,
+            self.dedup_left,
+            session_name(self.left_name, session_id),
+        )
+
+    def right(self, session_id):
+        return tolerant(
+            self.join(session_id).right(self.right_fn),
+            session_id,
+            self.dedup_right,
+            session_name(self.right_name, session_id),
+        )
+
+    def forget(self, session_id):
+        with self.lock:
+            self.joins.pop(session_id, None)
+        drop_state(self.dedup_left.db, session_name(self.left_name, session_id))
+        drop_state(self.dedup_right.db, session_name(self.right_name, session_id))
+
+
+class SessionValues:
+    # values produced by one consumer of a session and used by another one
+    def __init__(self) -> None:
+        self.values = {}
+        self.events = {}
+        self.lock = Lock()
+
+    def event(self, session_id):
+        with self.lock:
+            return self.events.setdefault(session_id, Event())
+
+    def set(self, session_id, value):
+        self.values[session_id] = value
+        self.event(session_id).set()
+
+    def get(self, session_id):
+        self.event(session_id).wait()
+        return self.values[session_id]
+
+    def ready(self, session_id):
+        return self.event(session_id).is_set()
+
+    def forget(self, session_id):
+        with self.lock:
+            self.events.pop(session_id, None)
+            self.values.pop(session_id, None)
+
+
+def consume_sessions(pipe_in, mux):
+    try:
+        with Filter(pipe_in) as consumer:
+            consumer.run(mux)
+    except Exception as e:
+        logger.exception(str(e))
+        os._exit(1)
+
+
+def sessions(control, consumers, on_done):
+    # consumers are (pipe_in, dedup, make_cursor), each queue is consumed by
+    # its own thread for every session at once. The control announcements are
+    # acked, and on_done called, in order once a session is done everywhere.
+    finished = Condition()
+
+    def notify(session_id):
+        with finished:
+            finished.notify_all()
+
+    muxes = []
+    for (pipe_in, dedup, make_cursor) in consumers:
+        mux = Sessions(make_cursor, dedup, notify)
+        Thread(target=consume_sessions, args=(pipe_in, mux), daemon=True).start()
+        muxes.append(mux)
+
+    def processed(session_id):
+        return all(mux.dedup.is_batch_processed(session_id) for mux in muxes)
+
+    for payload, ack in control.recv():
+        session_id = str(payload["session_id"])
+        if not processed(session_id):
+            logger.info("session %s", session_id)
+            for mux in muxes:
+                mux.open(session_id)
+            with finished:
+                while not finished.wait_for(
+                    lambda: processed(session_id), SESSION_POLL
+                ):
+                    control.keepalive()
+        on_done(session_id)
+        ack()
+
+
 import debug
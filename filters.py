@@ -1,16 +1,43 @@
 from kevasto import Client
 import os
 import logging
-from threading import Barrier, Event
+import heapq
+import multiprocessing
+import time
+from collections import deque
+from itertools import count
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty, Full, Queue, SimpleQueue
+from threading import Event, Lock, Thread
 from typing import Dict, cast
-from pipe import Pipe, Send
+from pipe import Pipe, Publisher, Send, connection
+from debug import approx_size
+from metrics import registry
+from tracing import tracer
 
 logger = logging.getLogger("filter")
 logger.setLevel(logging.INFO)
 
+# seconds between estimates of the accumulator size in bytes
+ACC_SIZE_INTERVAL = float(os.environ.get("ACC_SIZE_INTERVAL", 10))
+# processes running map_fn for the mappers that use them, 0 maps on the consumer thread
+MAP_WORKERS = int(os.environ.get("MAP_WORKERS", 0))
+# chunks in flight per worker before the consumer waits for the oldest one
+MAP_AHEAD = int(os.environ.get("MAP_AHEAD", 2))
+# messages buffered between the receiver, cursor and publisher threads of a
+# filter, 0 runs all of it on the consuming thread
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", 0))
+PIPELINE_POLL = float(os.environ.get("PIPELINE_POLL", 0.5))
+
+
+def queue_name(pipe_in):
+    return getattr(pipe_in, "queue", str(pipe_in))
+
 
 class Cursor:
     is_done = False
+    # seconds without messages before idle is called, None never calls it
+    idle_timeout = None
 
     def setup(self, caller):
         return
@@ -21,33 +48,137 @@ class Cursor:
     def step(self, acc, payload) -> object:
         return None
 
+    def idle(self, acc) -> object:
+        return acc
+
+    def submit(self, acc, payload, ack) -> object:
+        # cursors that finish a step later also ack it later
+        acc = self.step(acc, payload)
+        ack()
+        return acc
+
     def end(self, acc, context):
         pass
 
+    def submit_end(self, acc, context, ack):
+        # same as submit, for the EOF
+        self.end(acc, context)
+        ack()
+
     def close(self):
         pass
 
 
 class Filter:
-    def __init__(self, pipe_in: Pipe):
+    def __init__(self, pipe_in: Pipe, depth=None):
         self.pipe_in = pipe_in
+        self.depth = PIPELINE_DEPTH if depth is None else depth
 
     def run(self, cursor: Cursor):
         cursor.setup(self)
         acc = cursor.start()
         if not cursor.is_done:
             logger.info("start consuming %s", self.pipe_in)
-            for payload, ack in self.pipe_in.recv(auto_ack=False):
-                if payload.get("data"):
-                    acc = cursor.step(acc, payload)
-                    ack()
-                else:
-                    cursor.end(acc, payload)
-                    ack()
-                    break
+            if self.depth > 0:
+                self.pipelined(cursor, acc)
+            else:
+                for payload, ack in self.pipe_in.recv(
+                    auto_ack=False, inactivity_timeout=cursor.idle_timeout
+                ):
+                    acc = self.handle(cursor, acc, payload, ack, time.monotonic())
+                    if cursor.is_done:
+                        break
             logger.info("done consuming %s", self.pipe_in)
         cursor.close()
 
+    def handle(self, cursor, acc, payload, ack, received, defer=None):
+        # defer hands the ack to whoever publishes, so it runs after the outputs
+        if payload is None:
+            return cursor.idle(acc)
+        queue = queue_name(self.pipe_in)
+        span = tracer.start(payload, queue)
+
+        def acked():
+            ack()
+            registry.observe(
+                "filter_ack_latency_seconds", time.monotonic() - received, queue=queue
+            )
+
+        done = acked if defer is None else lambda: defer(acked)
+        if payload.get("data"):
+            if isinstance(payload["data"], list):
+                registry.inc("filter_records_in_total", len(payload["data"]), queue=queue)
+            acc = cursor.submit(acc, payload, done)
+        else:
+            cursor.submit_end(acc, payload, done)
+        tracer.finish(span)
+        return acc
+
+    def pipelined(self, cursor, acc):
+        # a receiver thread consumes and decodes, this thread runs the cursor
+        # and a publisher thread encodes and sends, all three overlap
+        inbox = Queue(self.depth)
+        stop = Event()
+        publisher = Publisher(self.depth)
+
+        def receive():
+            try:
+                for payload, ack in self.pipe_in.recv(
+                    auto_ack=False,
+                    inactivity_timeout=cursor.idle_timeout or PIPELINE_POLL,
+                ):
+                    if stop.is_set():
+                        # acks handed over by the publisher run before leaving
+                        self.pipe_in.keepalive()
+                        break
+                    if payload is None:
+                        if cursor.idle_timeout is not None:
+                            try:
+                                inbox.put_nowait((None, None, None))
+                            except Full:
+                                pass
+                        continue
+                    item = (payload, ack, time.monotonic())
+                    while not stop.is_set():
+                        try:
+                            inbox.put(item, timeout=PIPELINE_POLL)
+                            break
+                        except Full:
+                            self.pipe_in.keepalive()
+            except Exception as e:
+                inbox.put(e)
+                return
+            finally:
+                # the consuming connection was opened by this thread
+                self.pipe_in.channel = None
+                connection.close()
+            inbox.put(StopIteration())
+
+        receiver = Thread(target=receive, daemon=True)
+        receiver.start()
+        publisher.attach()
+        try:
+            while not cursor.is_done:
+                item = inbox.get()
+                if isinstance(item, StopIteration):
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                (payload, ack, received) = item
+                acc = self.handle(cursor, acc, payload, ack, received, publisher.ack)
+        finally:
+            publisher.detach()
+            try:
+                publisher.close()
+            finally:
+                stop.set()
+                # the receiver may be blocked handing over an item
+                while receiver.is_alive():
+                    try:
+                        inbox.get(timeout=PIPELINE_POLL)
+                    except Empty:
+                        pass
+
     def close(self):
         self.pipe_in.close()
 
@@ -63,6 +194,7 @@ class Filter:
 
 class EndOnce(Cursor):
     replicas = int(os.environ.get("N_REPLICAS", 1))
+    sized_at = float("-inf")
 
     def setup(self, caller) -> object:
         self.pipe_in = caller.pipe_in
@@ -90,26 +222,105 @@ class EndOnce(Cursor):
     def done(self, acc, payload):
         return
 
+    def apply_step(self, acc, data):
+        queue = queue_name(self.pipe_in)
+        with registry.timed("filter_step_seconds", queue=queue):
+            acc = self.step_fn(acc, data)
+        if hasattr(acc, "__len__"):
+            registry.set("filter_accumulator_size", len(acc), queue=queue)
+            now = time.monotonic()
+            if now - self.sized_at >= ACC_SIZE_INTERVAL:
+                self.sized_at = now
+                registry.set("filter_accumulator_bytes", approx_size(acc), queue=queue)
+        return acc
+
+
+map_pools = {}
+map_pools_lock = Lock()
+
+
+def map_pool(workers):
+    # one pool per process, shared by the mappers of every session; spawned
+    # since forking copies the locks held by the pika and flask threads
+    with map_pools_lock:
+        if workers not in map_pools:
+            map_pools[workers] = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return map_pools[workers]
+
+
+def timed_map(map_fn, data):
+    start = time.monotonic()
+    data = map_fn(data)
+    return (data, time.monotonic() - start)
+
 
 class Mapper(EndOnce):
-    def __init__(self, map_fn, pipe_out: Send, start_fn=lambda: None) -> None:
+    def __init__(
+        self, map_fn, pipe_out: Send, start_fn=lambda: None, workers=0
+    ) -> None:
         self.pipe_out = pipe_out
         self.map_fn = map_fn
         self.start_fn = start_fn
         self.replicas = int(os.environ.get("N_REPLICAS", 1))
+        # with workers map_fn must be picklable, a module level function
+        self.workers = workers
+        self.pending = deque()
 
     def start(self) -> object:
         return self.start_fn()
 
     def step(self, acc, payload) -> object:
         data = payload["data"]
-        self.pipe_out.send({**payload, "data": self.map_fn(data)})
+        queue = queue_name(self.pipe_in)
+        with registry.timed("filter_map_seconds", queue=queue):
+            data = self.map_fn(data)
+        self.send(payload, data)
+        return acc
+
+    def submit(self, acc, payload, ack) -> object:
+        if not self.workers:
+            return super().submit(acc, payload, ack)
+        future = map_pool(self.workers).submit(timed_map, self.map_fn, payload["data"])
+        self.pending.append((future, payload, ack))
+        self.publish(self.workers * MAP_AHEAD)
+        return acc
+
+    def publish(self, keep):
+        # outputs leave in arrival order, every chunk is acked once its
+        # output is sent; waits while more than keep chunks are in flight
+        queue = queue_name(self.pipe_in)
+        while self.pending and (len(self.pending) > keep or self.pending[0][0].done()):
+            (future, payload, ack) = self.pending.popleft()
+            (data, elapsed) = future.result()
+            registry.observe("filter_map_seconds", elapsed, queue=queue)
+            self.send(payload, data)
+            ack()
+
+    def send(self, payload, data):
+        if isinstance(data, list):
+            registry.inc(
+                "filter_records_out_total", len(data), queue=queue_name(self.pipe_in)
+            )
+        self.pipe_out.send({**payload, "data": data})
+
+    def idle(self, acc) -> object:
+        self.publish(len(self.pending))
         return acc
 
+    def end(self, acc, payload):
+        self.publish(0)
+        super().end(acc, payload)
+
     def end_once(self, acc, payload):
         self.pipe_out.send({**payload, "data": None})
 
     def close(self):
+        # unpublished chunks were never acked, the broker delivers them again
+        for (future, _, _) in self.pending:
+            future.cancel()
+        self.pending.clear()
         self.pipe_out.close()
 
 
@@ -119,7 +330,7 @@ class Reducer(EndOnce):
         self.step_fn = step_fn
 
     def step(self, acc, payload) -> object:
-        return self.step_fn(acc, payload["data"])
+        return self.apply_step(acc, payload["data"])
 
     def done(self, acc, payload):
         self.pipe_out.send({**payload, "data": acc})
@@ -131,12 +342,24 @@ class Reducer(EndOnce):
         self.pipe_out.close()
 
 
+# Whichever side ends last joins both accumulators and sends the result, so
+# neither side blocks waiting for the other
 class Join:
     def __init__(self, join_fn, pipe_out: Send) -> None:
-        self.barrier = Barrier(2)
+        self.lock = Lock()
         self.join_fn = join_fn
         self.pipe_out = pipe_out
-        self.send_done = Event()
+        self.accs = {}
+
+    def arrive(self, side, acc, payload):
+        with self.lock:
+            self.accs[side] = acc
+            if len(self.accs) < 2:
+                return
+        acc = self.join_fn(self.accs["left"], self.accs["right"])
+        self.pipe_out.send({**payload, "data": acc})
+        self.pipe_out.send({**payload, "data": None})
+        self.pipe_out.close()
 
     class Left(EndOnce):
         def __init__(self, parent, step_fn) -> None:
@@ -147,17 +370,10 @@ class Join:
             return {}
 
         def step(self, acc, payload) -> object:
-            return self.step_fn(
-                acc,
-                payload["data"],
-            )
+            return self.apply_step(acc, payload["data"])
 
         def end_once(self, left_acc, payload):
-            self.parent.barrier.wait()
-            acc = self.parent.join_fn(left_acc, self.parent.right_acc)
-            self.parent.send_done.set()
-            self.parent.pipe_out.send({**payload, "data": acc})
-            self.parent.pipe_out.send({**payload, "data": None})
+            self.parent.arrive("left", left_acc, payload)
 
         def close(self):
             pass
@@ -171,16 +387,10 @@ class Join:
             return {}
 
         def step(self, acc, payload) -> object:
-            return self.step_fn(
-                acc,
-                payload["data"],
-            )
+            return self.apply_step(acc, payload["data"])
 
         def end_once(self, right_acc, payload):
-            self.parent.right_acc = right_acc
-            self.parent.barrier.wait()
-            self.parent.send_done.wait()
-            self.parent.send_done.clear()
+            self.parent.arrive("right", right_acc, payload)
 
         def close(self):
             pass
@@ -309,6 +519,7 @@ class Persistent(Cursor):
     def end(self, acc, payload):
         self.db.log_append(self.name, payload)
         self.cursor.end(acc, payload)
+        self.is_done = self.cursor.is_done
         self.commit_step(payload)
         self.db.put(
             self.name,
@@ -341,7 +552,9 @@ class Keep(Cursor):
         return self.cursor.setup(caller)
 
     def start(self) -> object:
-        return self.cursor.start()
+        acc = self.cursor.start()
+        self.is_done = self.cursor.is_done
+        return acc
 
     def step(self, acc, payload) -> object:
         if not self.dedup.is_batch_processed(payload["session_id"]):
@@ -349,11 +562,234 @@ class Keep(Cursor):
         logger.info("skip")
         return acc
 
+    def submit(self, acc, payload, ack) -> object:
+        if not self.dedup.is_batch_processed(payload["session_id"]):
+            return self.cursor.submit(acc, payload, ack)
+        logger.info("skip")
+        ack()
+        return acc
+
+    def idle(self, acc) -> object:
+        return self.cursor.idle(acc)
+
     def end(self, acc, context):
         self.cursor.end(acc, context)
+        self.ended()
+
+    def submit_end(self, acc, context, ack):
+        def ended():
+            self.ended()
+            ack()
+
+        self.cursor.submit_end(acc, context, ended)
+
+    def ended(self):
         self.dedup.set_processed_batch(self.batch_id)
         self.dedup.persist_state()
         self.is_done = self.cursor.is_done
 
     def close(self):
         self.cursor.close()
+
+
+# Holds the messages of a session back, unacked, until ready() says the cursor
+# can take them, a session waiting on another queue does not stall the others
+class Await(Cursor):
+    def __init__(self, cursor, ready) -> None:
+        self.cursor = cursor
+        self.ready = ready
+        self.held = deque()
+
+    @property
+    def is_done(self):
+        return self.cursor.is_done
+
+    def setup(self, caller):
+        return self.cursor.setup(caller)
+
+    def start(self) -> object:
+        return self.cursor.start()
+
+    def release(self, acc):
+        while self.held and not self.cursor.is_done and self.ready():
+            (payload, ack) = self.held.popleft()
+            if payload.get("data"):
+                acc = self.cursor.submit(acc, payload, ack)
+            else:
+                self.cursor.submit_end(acc, payload, ack)
+        return acc
+
+    def step(self, acc, payload) -> object:
+        return self.submit(acc, payload, lambda: None)
+
+    def submit(self, acc, payload, ack) -> object:
+        self.held.append((payload, ack))
+        return self.release(acc)
+
+    def idle(self, acc) -> object:
+        return self.cursor.idle(self.release(acc))
+
+    def end(self, acc, context):
+        self.submit_end(acc, context, lambda: None)
+
+    def submit_end(self, acc, context, ack):
+        self.held.append((context, ack))
+        self.release(acc)
+
+    def close(self):
+        # held messages were never acked, the broker delivers them again
+        self.held.clear()
+        self.cursor.close()
+
+
+SESSION_POLL = float(os.environ.get("SESSION_POLL", 1))
+
+
+def session_key(payload):
+    # ids are str, as announced by the control server; the payload is
+    # normalized in place so whatever it reaches downstream agrees
+    payload["session_id"] = str(payload["session_id"])
+    return payload["session_id"]
+# seconds, EOFs bounced more than once per replica come back with a growing delay
+BOUNCE_BACKOFF_MAX = float(os.environ.get("BOUNCE_BACKOFF_MAX", 30))
+# times an EOF goes around every replica before it is taken for a duplicate
+BOUNCE_ROUNDS = int(os.environ.get("BOUNCE_ROUNDS", 10))
+
+
+# Several sessions share the same queues, each session gets its own cursor
+# (built by make_cursor) and accumulator and ends with its own EOF. Never done.
+class Sessions(Cursor):
+    idle_timeout = SESSION_POLL
+
+    def __init__(self, make_cursor, dedup, on_done=lambda session_id: None) -> None:
+        self.make_cursor = make_cursor
+        self.dedup = dedup
+        self.on_done = on_done
+        self.replicas = int(os.environ.get("N_REPLICAS", 1))
+        self.cursors = {}
+        self.opening = SimpleQueue()
+        # (due, seq, payload, ack) of EOFs waiting to be bounced
+        self.bouncing = []
+        self.bounced = count()
+
+    def setup(self, caller):
+        self.caller = caller
+
+    def start(self) -> object:
+        return {}
+
+    def open(self, session_id):
+        # from any thread, sessions are opened by the consuming thread so
+        # checkpoints are recovered even if no message of theirs is left
+        self.opening.put(str(session_id))
+
+    def idle(self, accs) -> object:
+        now = time.monotonic()
+        while self.bouncing and self.bouncing[0][0] <= now:
+            (_, _, payload, ack) = heapq.heappop(self.bouncing)
+            self.caller.pipe_in.send(payload)
+            ack()
+        while not self.opening.empty():
+            session_id = self.opening.get()
+            if session_id in self.cursors:
+                continue
+            self.session(accs, session_id)
+            if session_id in self.cursors and self.dedup.is_batch_processed(session_id):
+                self.finish(accs, session_id)
+        for (session_id, cursor) in self.cursors.items():
+            accs[session_id] = cursor.idle(accs[session_id])
+        # sessions whose EOF was held back end once it is let through
+        for session_id in [s for (s, cursor) in self.cursors.items() if cursor.is_done]:
+            self.finish(accs, session_id)
+        return accs
+
+    def session(self, accs, session_id):
+        if session_id not in self.cursors:
+            logger.info("open session %s %s", session_id, self.caller.pipe_in)
+            cursor = self.make_cursor(session_id)
+            cursor.setup(self.caller)
+            self.cursors[session_id] = cursor
+            accs[session_id] = cursor.start()
+            if cursor.is_done:
+                self.finish(accs, session_id)
+                return None
+        return self.cursors[session_id]
+
+    def finish(self, accs, session_id):
+        self.cursors.pop(session_id).close()
+        accs.pop(session_id, None)
+        logger.info("close session %s %s", session_id, self.caller.pipe_in)
+        self.on_done(session_id)
+
+    def ended(self, session_id):
+        return session_id not in self.cursors and self.dedup.is_batch_processed(
+            session_id
+        )
+
+    def step(self, accs, payload) -> object:
+        return self.submit(accs, payload, lambda: None)
+
+    def submit(self, accs, payload, ack) -> object:
+        self.idle(accs)
+        session_id = session_key(payload)
+        if self.ended(session_id):
+            logger.info("skip message of ended session %s", session_id)
+            ack()
+            return accs
+        cursor = self.session(accs, session_id)
+        if cursor is None:
+            ack()
+            return accs
+        accs[session_id] = cursor.submit(accs[session_id], payload, ack)
+        return accs
+
+    def end(self, accs, payload):
+        self.submit_end(accs, payload, lambda: None)
+
+    def submit_end(self, accs, payload, ack):
+        self.idle(accs)
+        session_id = session_key(payload)
+        if self.ended(session_id):
+            self.forward(payload, ack)
+            return
+        payload.pop("bounces", None)
+        cursor = self.session(accs, session_id)
+        if cursor is None:
+            ack()
+            return
+        cursor.submit_end(accs[session_id], payload, ack)
+        if cursor.is_done:
+            self.finish(accs, session_id)
+
+    def forward(self, payload, ack):
+        # an EOF counting down the replicas reached one that already ended the
+        # session, pass it along to the others. Once it went around every
+        # replica it is sent back later and later, unacked meanwhile; after
+        # BOUNCE_ROUNDS rounds every replica ended the session without it, it
+        # is a redelivered duplicate. So is an EOF without count_down, the
+        # upstream one this replica already consumed
+        bounces = payload.get("bounces", 0)
+        if "count_down" not in payload or bounces >= self.replicas * BOUNCE_ROUNDS:
+            logger.info("drop duplicate EOF of ended session %s", payload["session_id"])
+            ack()
+            return
+        payload = {**payload, "bounces": bounces + 1}
+        if bounces < self.replicas:
+            self.caller.pipe_in.send(payload)
+            ack()
+            return
+        delay = min(
+            SESSION_POLL * 2 ** min(bounces - self.replicas, 16), BOUNCE_BACKOFF_MAX
+        )
+        logger.info(
+            "bounce EOF of ended session %s in %ss", payload["session_id"], delay
+        )
+        heapq.heappush(
+            self.bouncing, (time.monotonic() + delay, next(self.bounced), payload, ack)
+        )
+
+    def close(self):
+        # bounced EOFs still waiting were never acked, the broker delivers them again
+        self.bouncing.clear()
+        for session_id in list(self.cursors):
+            self.cursors.pop(session_id).close()
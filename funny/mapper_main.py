@@ -1,7 +1,14 @@
 from health_server import HealthServer, get_my_ip
 import pipe
 import logging
-from factory import mapper, sink
+from factory import (
+    SessionValues,
+    drop_state,
+    mapper_sessions,
+    session_name,
+    sessions,
+    sink_sessions,
+)
 from dedup import Dedup
 from control_server import ControlClient
 
@@ -9,62 +16,56 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def main():
-    def funny(business_city, batch_id, dedup):
-        logger.info("start mapping funny business")
-
-        def map_business(reviews):
-            return [
-                {"city": business_city.get(r["business_id"], "Unknown")}
-                for r in reviews
-                if r["funny"] != 0
-            ]
+def map_business(business_city, reviews):
+    return [
+        {"city": business_city.get(r["business_id"], "Unknown")}
+        for r in reviews
+        if r["funny"] != 0
+    ]
 
-        if not dedup.is_batch_processed(batch_id):
-            mapper(
-                pipe_in=pipe.map_funny(),
-                map_fn=map_business,
-                pipe_out=pipe.funny_summary(),
-                batch_id=batch_id,
-                dedup=dedup,
-            )
 
+def main():
     with HealthServer():
         dedup = Dedup(get_my_ip())
         controlClient = ControlClient()
         dedupBusiness = Dedup(get_my_ip() + "_business")
         control = pipe.pub_sub_control()
-        for payload, ack in control.recv():
-            if not (
-                dedup.is_batch_processed(payload["session_id"])
-                and dedupBusiness.is_batch_processed(payload["session_id"])
-            ):
-                logger.info("batch %s", payload)
-                sink(
-                    pipe_in=pipe.sub_funny_business_cities(),
-                    observer=lambda business: funny(
-                        business_city=business,
-                        batch_id=payload["session_id"],
-                        dedup=dedup,
+        bucket_name = get_my_ip()
+        # reviews of a session are held back until its business cities arrive
+        business_cities = SessionValues()
+
+        def funny(session_id):
+            logger.info("start mapping funny business %s", session_id)
+            return mapper_sessions(
+                make_pipe_out=pipe.funny_summary,
+                map_fn=lambda reviews: map_business(
+                    business_cities.get(session_id), reviews
+                ),
+                dedup=dedup,
+                ready=business_cities.ready,
+            )(session_id)
+
+        def done(session_id):
+            business_cities.forget(session_id)
+            drop_state(dedup.db, session_name(bucket_name + "_sink", session_id))
+            controlClient.batch_done(session_id, bucket_name)
+
+        sessions(
+            control,
+            [
+                (
+                    pipe.sub_funny_business_cities(),
+                    dedupBusiness,
+                    sink_sessions(
+                        observer=business_cities.set,
+                        dedup=dedupBusiness,
+                        name=bucket_name + "_sink",
                     ),
-                    batch_id=payload["session_id"],
-                    dedup=dedupBusiness,
-                )
-            # elif not dedup.is_batch_processed(payload["session_id"]):
-            #     funny(
-            #         business_city=business,
-            #         batch_id=payload["session_id"],
-            #         dedup=dedup,
-            #     )
-            bucket_name = get_my_ip()
-            dedup.db.log_drop(bucket_name + "_sink", None)
-            dedup.db.log_drop(bucket_name + "_processed", None)
-            dedup.db.delete(
-                bucket_name + "_sink",
-                "state",
-            )
-            controlClient.batch_done(payload["session_id"], bucket_name)
-            ack()
+                ),
+                (pipe.map_funny(), dedup, funny),
+            ],
+            done,
+        )
 
 
 if __name__ == "__main__":
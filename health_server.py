@@ -1,11 +1,15 @@
+import json
 import threading
-from flask import Flask, make_response, jsonify
+from flask import Flask, make_response, jsonify, request
 import requests
 import os
 import logging
-import bjoern
-import docker
 import subprocess
+from debug import MEMORY_TOP, memory, profiler
+from node import node_name
+from prober import Prober
+from metrics import registry
+from tracing import tracer
 
 logging.basicConfig()
 logger = logging.getLogger("WatchdogSideCar")
@@ -13,9 +17,7 @@ logger.setLevel(logging.INFO)
 
 
 def get_my_ip():
-    client = docker.from_env()
-    container = client.containers.get(os.environ["HOSTNAME"])
-    return container.name
+    return node_name()
 
 
 def revive(ip):
@@ -49,6 +51,11 @@ class HealthServer:
 
     def run_server(self):
         self.__route_health_endpoint()
+        self.serve()
+
+    def serve(self):
+        import bjoern
+
         bjoern.run(self.app, "0.0.0.0", 80)
 
     def __route_health_endpoint(self):
@@ -56,6 +63,69 @@ class HealthServer:
         def healthcheck():
             return ("", 204)
 
+        @self.app.route("/metrics", methods=["GET"])
+        def metrics():
+            return (registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4"})
+
+        @self.app.route("/traces", methods=["GET"])
+        def traces():
+            # JSON lines, input for python -m tracing
+            spans = "".join(json.dumps(span) + "\n" for span in tracer.dump())
+            return (spans, 200, {"Content-Type": "application/x-ndjson"})
+
+        @self.app.route("/profile", methods=["GET"])
+        def profile_status():
+            return jsonify(profiler.status())
+
+        @self.app.route("/profile/start", methods=["POST"])
+        def profile_start():
+            try:
+                started = profiler.start(
+                    request.args.get("mode"), request.args.get("interval", type=float)
+                )
+            except ValueError as e:
+                return (str(e), 400)
+            return (jsonify(profiler.status()), 200 if started else 409)
+
+        @self.app.route("/profile/stop", methods=["POST"])
+        def profile_stop():
+            path = profiler.stop()
+            if path is None:
+                return ("not profiling", 409)
+            return jsonify({"path": path})
+
+        @self.app.route("/memory", methods=["GET"])
+        def memory_snapshot():
+            # accumulators are always there, allocation sites only while tracing
+            result = {
+                "accumulators": [
+                    {**labels, "entries": entries}
+                    for (labels, entries) in registry.series("filter_accumulator_size")
+                ],
+                "accumulator_bytes": [
+                    {**labels, "bytes": size}
+                    for (labels, size) in registry.series("filter_accumulator_bytes")
+                ],
+            }
+            snapshot = memory.snapshot(
+                request.args.get("top", MEMORY_TOP, type=int),
+                request.args.get("key", "lineno"),
+                request.args.get("compare", 0, type=int) > 0,
+                request.args.get("dump", 0, type=int) > 0,
+            )
+            if snapshot is not None:
+                result["tracemalloc"] = snapshot
+            return jsonify(result)
+
+        @self.app.route("/memory/start", methods=["POST"])
+        def memory_start():
+            started = memory.start(request.args.get("frames", 1, type=int))
+            return ("", 204 if started else 409)
+
+        @self.app.route("/memory/stop", methods=["POST"])
+        def memory_stop():
+            return ("", 204 if memory.stop() else 409)
+
     def stop(self):
         exit(0)
 
@@ -73,6 +143,7 @@ class LeaderServer(HealthServer):
         self.requested = threading.Event()
         self.poolId = poolId
         self.myIp = get_my_ip()
+        self.prober = Prober()
         self.app = Flask(__name__)
         log = logging.getLogger("werkzeug")
         log.setLevel(logging.INFO)
@@ -136,18 +207,11 @@ class LeaderServer(HealthServer):
 
     def healthcheck_workers(self):
         logger.info("[LEADER] Checking processes health...")
-        for ip in self.get_worker_ips():
-            try:
-                requests.get(f"http://{ip}:80/health")
-            except:
-                revive(ip)
+        self.prober.probe(self.get_worker_ips(), on_failure=revive)
 
     def healthcheck_leader(self):
         logger.info("[WORKER] Checking leader health...")
-        try:
-            requests.get(f"http://{self.get_leader_ip()}:80/health")
-            # logger.info('http://' + leaderIp + ':' + port + '/health')
-        except:
+        if self.prober.probe([self.get_leader_ip()]):
             logger.info("Leader has died. Running leader election")
             self.trigger_election()
 
@@ -2,7 +2,7 @@ from health_server import HealthServer, get_my_ip
 import pipe
 from pipe import Formatted
 import logging
-from factory import reducer, count_key
+from factory import count_key, drop_state, reducer_sessions, session_name, sessions
 from dedup import AggregatorDedup
 from control_server import ControlClient
 
@@ -14,28 +14,31 @@ def main():
         dedup = AggregatorDedup("histogram")
         controlClient = ControlClient()
         control = pipe.pub_sub_control()
-        for payload, ack in control.recv():
-            if not dedup.is_batch_processed(payload["session_id"]):
-                logger.info("batch %s", payload)
-                reducer(
-                    pipe_in=pipe.histogram_summary(),
-                    step_fn=count_key("weekday"),
-                    pipe_out=Formatted(
-                        pipe.reports(),
-                        lambda histogram: ("histogram", histogram),
+        bucket_name = get_my_ip()
+
+        def done(session_id):
+            drop_state(dedup.db, session_name(bucket_name, session_id))
+            controlClient.batch_done(session_id, bucket_name)
+
+        sessions(
+            control,
+            [
+                (
+                    pipe.histogram_summary(),
+                    dedup,
+                    reducer_sessions(
+                        make_pipe_out=lambda: Formatted(
+                            pipe.reports(),
+                            lambda histogram: ("histogram", histogram),
+                        ),
+                        step_fn=count_key("weekday"),
+                        dedup=dedup,
+                        name=bucket_name,
                     ),
-                    batch_id=payload["session_id"],
-                    dedup=dedup,
                 )
-            bucket_name = get_my_ip()
-            dedup.db.log_drop(bucket_name + "_processed", None)
-            dedup.db.log_drop(bucket_name, None)
-            dedup.db.delete(
-                bucket_name,
-                "state",
-            )
-            controlClient.batch_done(payload["session_id"], bucket_name)
-            ack()
+            ],
+            done,
+        )
 
 
 if __name__ == "__main__":
@@ -2,40 +2,50 @@ from datetime import datetime
 from health_server import HealthServer, get_my_ip
 import pipe
 import logging
-from factory import mapper
+from factory import mapper_sessions, sessions
+from filters import MAP_WORKERS
 from dedup import Dedup
 from control_server import ControlClient
 
 logger = logging.getLogger(__name__)
 
 
-def main():
-    def map_histogram(dates):
-        return [
-            {
-                "weekday": datetime.strptime(d["date"], "%Y-%m-%d %H:%M:%S").strftime(
-                    "%A"
-                )
-            }
-            for d in dates
-        ]
+def map_histogram(dates):
+    return [
+        {
+            "weekday": datetime.strptime(d["date"], "%Y-%m-%d %H:%M:%S").strftime(
+                "%A"
+            )
+        }
+        for d in dates
+    ]
+
 
+def main():
     with HealthServer():
         dedup = Dedup(get_my_ip())
         controlClient = ControlClient()
         control = pipe.pub_sub_control()
-        for payload, ack in control.recv():
-            if not dedup.is_batch_processed(payload["session_id"]):
-                logger.info("batch %s", payload)
-                mapper(
-                    pipe_in=pipe.map_histogram(),
-                    map_fn=map_histogram,
-                    pipe_out=pipe.histogram_summary(),
-                    batch_id=payload["session_id"],
-                    dedup=dedup,
+
+        def done(session_id):
+            controlClient.batch_done(session_id, get_my_ip())
+
+        sessions(
+            control,
+            [
+                (
+                    pipe.map_histogram(),
+                    dedup,
+                    mapper_sessions(
+                        make_pipe_out=pipe.histogram_summary,
+                        map_fn=map_histogram,
+                        dedup=dedup,
+                        workers=MAP_WORKERS,
+                    ),
                 )
-            controlClient.batch_done(payload["session_id"], get_my_ip())
-            ack()
+            ],
+            done,
+        )
 
 
 if __name__ == "__main__":
@@ -1,10 +1,16 @@
+import base64
+import bisect
+import hashlib
+import os
 from random import random
 import time
+from threading import Lock
 from typing import Any, Dict, Union
 import requests
 import logging
-from flask import request
+from flask import Blueprint, request
 import debug
+from metrics import registry
 from raft import Follower, Leader, NopVM, Raft
 import logging
 
@@ -12,16 +18,56 @@ logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger("kevasto")
 logger.setLevel(logging.INFO)
 
+LOG_CHUNK_SIZE = int(os.environ.get("LOG_CHUNK_SIZE", 1024))
+KEVASTO_GROUPS = int(os.environ.get("KEVASTO_GROUPS", 1))
+RING_POINTS = int(os.environ.get("RING_POINTS", 64))
 
+
+def ring_hash(key):
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+# Buckets are assigned to Raft groups by consistent hashing, every group owns
+# RING_POINTS points of the ring
+class HashRing:
+    def __init__(self, groups, points=RING_POINTS):
+        self.ring = sorted(
+            (ring_hash(f"{group}:{point}"), group)
+            for group in range(groups)
+            for point in range(points)
+        )
+        self.keys = [key for (key, _) in self.ring]
+
+    def group(self, bucket):
+        pos = bisect.bisect(self.keys, ring_hash(bucket)) % len(self.ring)
+        return self.ring[pos][1]
+
+
+# Entries live in fixed size chunks so appends never copy and drops release
+# whole chunks; head is the position of entry `base` inside the first chunk.
 class Log:
     def __init__(self, data):
         self.data = data
-        if not data.get("entries"):
-            self.data["entries"] = []
+        if "entries" in data:
+            entries = data.pop("entries")
+            data["chunks"] = [
+                entries[i : i + LOG_CHUNK_SIZE]
+                for i in range(0, len(entries), LOG_CHUNK_SIZE)
+            ]
+            data["head"] = 0
+        elif "chunks" not in data:
+            self.data["chunks"] = []
+            self.data["head"] = 0
             self.data["base"] = 0
 
+    def size(self):
+        chunks = self.data["chunks"]
+        if not chunks:
+            return 0
+        return (len(chunks) - 1) * LOG_CHUNK_SIZE + len(chunks[-1]) - self.data["head"]
+
     def translate(self, i, accesible):
-        virtual_size = self.data["base"] + len(self.data["entries"])
+        virtual_size = self.data["base"] + self.size()
         if i > virtual_size:
             raise Exception(f"Illegal index {i} > {virtual_size}")
         index = i - self.data["base"]
@@ -29,87 +75,147 @@ class Log:
             raise Exception(f"Illegal index {i} < {self.data['base']}")
         return index
 
-    def list(self, start):
-        return self.data["entries"][self.translate(start, True) :]
+    def list(self, start, limit=None):
+        position = self.translate(start, True) + self.data["head"]
+        remaining = self.size() - (position - self.data["head"])
+        if limit is not None:
+            remaining = min(remaining, limit)
+        chunks = self.data["chunks"]
+        result = []
+        chunk, offset = divmod(position, LOG_CHUNK_SIZE)
+        while remaining > 0:
+            page = chunks[chunk][offset : offset + remaining]
+            result.extend(page)
+            remaining -= len(page)
+            chunk += 1
+            offset = 0
+        return result
 
     def drop(self, i):
         if i is None:
             self.data["base"] = 0
-            self.data["entries"] = []
+            self.data["head"] = 0
+            self.data["chunks"] = []
         else:
             index = self.translate(i, False)
+            if index <= 0:
+                return
+            chunk, self.data["head"] = divmod(
+                index + self.data["head"], LOG_CHUNK_SIZE
+            )
+            del self.data["chunks"][:chunk]
             self.data["base"] = i
-            self.data["entries"] = self.data["entries"][index:]
 
     def concat(self, values):
-        self.data["entries"].extend(values)
+        for value in values:
+            self.append(value)
+
+    def copy(self):
+        # only the last chunk is ever written to, the rest can be shared
+        data = dict(self.data)
+        chunks = self.data["chunks"]
+        data["chunks"] = chunks[:-1] + [list(chunks[-1])] if chunks else []
+        return data
 
     def append(self, value):
-        self.data["entries"].append(value)
+        chunks = self.data["chunks"]
+        if not chunks or len(chunks[-1]) >= LOG_CHUNK_SIZE:
+            chunks.append([])
+        chunks[-1].append(value)
 
 
 class KeyValueVM(NopVM):
-    data = {"keyvalue": {}, "log": {}}
+    def __init__(self):
+        self.data = {"keyvalue": {}, "log": {}}
+        self.frozen = None
+        # reads are served off the raft lock on the server's threads, a log
+        # drop moves chunks, head and base in separate steps
+        self.lock = Lock()
 
     def reset(self, context, snapshot):
-        self.data = snapshot
+        for bucket in snapshot.get("log", {}).values():
+            Log(bucket)
+        with self.lock:
+            self.data = snapshot
 
     def snapshot(self):
         return self.data
 
+    def freeze(self):
+        # buckets are shared with the frozen view until the first write copies them
+        self.frozen = {store: dict(buckets) for (store, buckets) in self.data.items()}
+        return self.frozen
+
+    def thaw(self):
+        self.frozen = None
+
+    def writable(self, store, bucket_key):
+        bucket = self.data[store].get(bucket_key)
+        if bucket is None:
+            bucket = {}
+            self.data[store][bucket_key] = bucket
+        elif self.frozen is not None and self.frozen[store].get(bucket_key) is bucket:
+            bucket = Log(bucket).copy() if store == "log" else dict(bucket)
+            self.data[store][bucket_key] = bucket
+        return bucket
+
     def run(self, commands):
-        for command in commands:
-            command = command["data"]
-            bucket_key = command["bucket"]
-            bucket = self.data[command["store"]].get(bucket_key)
-            if bucket is None:
-                bucket = {}
-                self.data[command["store"]][bucket_key] = bucket
-
-            op = command["op"]
-            if command["store"] == "log":
-                log = Log(bucket)
-                if op == "drop":
-                    log.drop(command["start"])
-                elif op == "append":
-                    log.append(command["val"])
-            else:
-                if op == "+":
-                    bucket[command["key"]] = command["val"]
-                elif op == "-":
-                    bucket.pop(command["key"], None)
+        with self.lock:
+            for command in commands:
+                command = command["data"]
+                bucket = self.writable(command["store"], command["bucket"])
+
+                op = command["op"]
+                if command["store"] == "log":
+                    log = Log(bucket)
+                    if op == "drop":
+                        log.drop(command["start"])
+                    elif op == "append":
+                        log.append(command["val"])
+                else:
+                    if op == "+":
+                        bucket[command["key"]] = command["val"]
+                    elif op == "-":
+                        bucket.pop(command["key"], None)
         return None
 
     def results(self, query):
-        bucket = self.data[query["store"]].get(query["bucket"])
-        if bucket:
-            if query["store"] == "log":
-                return Log(bucket).list(query["start"])
-            else:
-                if query.get("key"):
-                    return bucket.get(query["key"])
-                elif query.get("keys"):
-                    return [bucket.get(key) for key in query["keys"]]
+        with self.lock:
+            bucket = self.data[query["store"]].get(query["bucket"])
+            if bucket:
+                if query["store"] == "log":
+                    return Log(bucket).list(query["start"], query.get("limit"))
+                else:
+                    if query.get("key"):
+                        return bucket.get(query["key"])
+                    elif query.get("keys"):
+                        return [bucket.get(key) for key in query["keys"]]
         return None
 
 
 def add_raft_routes(app, raft: Raft):
-    @app.route("/request_vote", methods=["POST"])
+    blueprint = Blueprint(f"raft{raft.group}", __name__)
+    @blueprint.route("/request_vote", methods=["POST"])
     def request_vote():
         data = request.get_json()
         return raft.request_vote(data)
 
-    @app.route("/append_entries", methods=["POST"])
+    @blueprint.route("/append_entries", methods=["POST"])
     def append_entries():
         data = request.get_json()
         return raft.append_entries(data)
 
-    @app.route("/append_entry", methods=["POST"])
+    @blueprint.route("/install_snapshot", methods=["POST"])
+    def install_snapshot():
+        data = request.get_json()
+        return raft.install_snapshot({**data, "data": base64.b64decode(data["data"])})
+
+    @blueprint.route("/append_entry", methods=["POST"])
     def append_entry():
         data = request.get_json()
         return raft.append_entry(data)
 
-    @app.route("/show")
+    @blueprint.route("/show")
     def show():
         leader = {}
         if isinstance(raft.state, Leader):
@@ -127,12 +233,14 @@ def add_raft_routes(app, raft: Raft):
             "voted_for": raft.voted_for,
             "current_term": raft.current_term,
             "commit_index": raft.commit_index,
+            "last_applied": raft.last_applied,
+            "checkpoints": [index for (index, _) in raft.checkpoints()],
             "replicas": raft.replicas,
             "name": raft.name,
             "snapshot_version": raft.snapshot_version,
             "state": raft.state.__class__.__name__,
             "index": leader,
-            "log": raft.log.tell(),
+            "log": raft.entries.size(),
             "machine": len(raft.machine.data),
             "stats": raft.get_stats(),
         }
@@ -144,11 +252,11 @@ def add_raft_routes(app, raft: Raft):
         else:
             return (data, 500)
 
-    @app.route("/snapshot")
+    @blueprint.route("/snapshot")
     def snapshot():
         return response(raft.snapshot())
 
-    @app.route("/keyvalue/<bucket>/<key>", methods=["DELETE", "GET"])
+    @blueprint.route("/keyvalue/<bucket>/<key>", methods=["DELETE", "GET"])
     def get_key(bucket, key):
         if request.method == "DELETE":
             return response(
@@ -172,7 +280,7 @@ def add_raft_routes(app, raft: Raft):
                 )
             )
 
-    @app.route("/keyvalue/<bucket>/<key>", methods=["PUT"])
+    @blueprint.route("/keyvalue/<bucket>/<key>", methods=["PUT"])
     def put_key(bucket, key):
         return response(
             raft.append_entry(
@@ -186,7 +294,7 @@ def add_raft_routes(app, raft: Raft):
             )
         )
 
-    @app.route("/log/<bucket>/", methods=["POST"])
+    @blueprint.route("/log/<bucket>/", methods=["POST"])
     def log_post(bucket):
         return response(
             raft.append_entry(
@@ -199,7 +307,7 @@ def add_raft_routes(app, raft: Raft):
             )
         )
 
-    @app.route("/log/<bucket>/<start>", methods=["DELETE", "GET"])
+    @blueprint.route("/log/<bucket>/<start>", methods=["DELETE", "GET"])
     def log_get(bucket, start):
         if request.method == "DELETE":
             return response(
@@ -218,19 +326,21 @@ def add_raft_routes(app, raft: Raft):
                     {
                         "bucket": bucket,
                         "start": int(start),
+                        "limit": request.args.get("limit", type=int),
                         "store": "log",
                     }
                 )
             )
 
-    @app.route("/health", methods=["GET"])
+    @blueprint.route("/health", methods=["GET"])
     def healthcheck():
         return ("", 204)
 
-    @app.errorhandler(Exception)
+    @blueprint.errorhandler(Exception)
     def handle_error(e):
         return (str(e), 500)
 
+    app.register_blueprint(blueprint, url_prefix=raft.path or None)
     return raft
 
 
@@ -259,103 +369,125 @@ def retry(times, func) -> Union[Dict, None]:
 
 
 class Client:
-    def __init__(self, hosts="tp3_kevasto_1,tp3_kevasto_2,tp3_kevasto_3") -> None:
+    def __init__(
+        self, hosts="tp3_kevasto_1,tp3_kevasto_2,tp3_kevasto_3", groups=KEVASTO_GROUPS
+    ) -> None:
         self.fallbacks = hosts.split(",")
         self.session = requests.session()
-        self.host = self.fallbacks[0]
-
-    def with_fallback(self, func):
-        def wrapper(*args, **kwargs):
-            for fallback in self.fallbacks:
-                try:
-                    return func(*args, **kwargs)
-                except ConnectionError:
-                    self.host = fallback
-
-        return wrapper
-
+        self.groups = groups
+        self.ring = HashRing(groups)
+        # every group has its own leader
+        self.hosts = [self.fallbacks[0]] * groups
+
+    def url(self, bucket, path):
+        group = self.ring.group(bucket)
+        prefix = f"/{group}" if self.groups > 1 else ""
+        # hosts are names on port 80 or host:port
+        host = self.hosts[group]
+        if ":" not in host:
+            host += ":80"
+        return f"http://{host}{prefix}{path}"
+
+    def redirect(self, bucket, host):
+        self.hosts[self.ring.group(bucket)] = host
+
+    def with_fallback(self, bucket):
+        # the url is rebuilt for every attempt so a fallback is actually used
+        def decorator(func):
+            def wrapper(path, *args, **kwargs):
+                for fallback in self.fallbacks:
+                    try:
+                        return func(self.url(bucket, path), *args, **kwargs)
+                    except requests.exceptions.ConnectionError:
+                        self.redirect(bucket, fallback)
+
+            return wrapper
+
+        return decorator
+
+    @registry.timed("kevasto_call_seconds", op="delete")
     def delete(self, bucket, key):
-        @self.with_fallback
+        @self.with_fallback(bucket)
         def __delete__(url):
             res = self.session.delete(url)
             content = res.json()
             if res.status_code == 200:
                 return (True, None)
             elif content.get("redirect"):
-                self.host = content["redirect"]
+                self.redirect(bucket, content["redirect"])
             return (False, res.text)
 
-        return retry(
-            10, lambda: __delete__(f"http://{self.host}:80/keyvalue/{bucket}/{key}")
-        )
+        return retry(10, lambda: __delete__(f"/keyvalue/{bucket}/{key}"))
 
+    @registry.timed("kevasto_call_seconds", op="get")
     def get(self, bucket, key) -> Union[None, Any]:
-        @self.with_fallback
+        @self.with_fallback(bucket)
         def __get__(url):
             res = self.session.get(url)
             content = res.json()
             if res.status_code == 200:
                 return (True, content["data"])
             elif content.get("redirect"):
-                self.host = content["redirect"]
+                self.redirect(bucket, content["redirect"])
             return (False, res.text)
 
-        return retry(
-            10, lambda: __get__(f"http://{self.host}:80/keyvalue/{bucket}/{key}")
-        )
+        return retry(10, lambda: __get__(f"/keyvalue/{bucket}/{key}"))
 
+    @registry.timed("kevasto_call_seconds", op="put")
     def put(self, bucket, key, data):
-        @self.with_fallback
+        @self.with_fallback(bucket)
         def __put__(url, data):
             res = self.session.put(url, json=data)
             content = res.json()
             if res.status_code == 200:
                 return (True, None)
             elif content.get("redirect"):
-                self.host = content["redirect"]
+                self.redirect(bucket, content["redirect"])
             return (False, res.text)
 
-        return retry(
-            10, lambda: __put__(f"http://{self.host}:80/keyvalue/{bucket}/{key}", data)
-        )
+        return retry(10, lambda: __put__(f"/keyvalue/{bucket}/{key}", data))
 
+    @registry.timed("kevasto_call_seconds", op="log_append")
     def log_append(self, bucket, data):
-        @self.with_fallback
+        @self.with_fallback(bucket)
         def __post__(url, data):
             res = self.session.post(url, json=data)
             content = res.json()
             if res.status_code == 200:
                 return (True, None)
             if content.get("redirect"):
-                self.host = content["redirect"]
+                self.redirect(bucket, content["redirect"])
             return (False, res.text)
 
-        return retry(10, lambda: __post__(f"http://{self.host}:80/log/{bucket}/", data))
+        return retry(10, lambda: __post__(f"/log/{bucket}/", data))
 
+    @registry.timed("kevasto_call_seconds", op="log_drop")
     def log_drop(self, bucket, start):
-        @self.with_fallback
+        @self.with_fallback(bucket)
         def __delete__(url):
             res = self.session.delete(url)
             content = res.json()
             if res.status_code == 200:
                 return (True, None)
             elif content.get("redirect"):
-                self.host = content["redirect"]
+                self.redirect(bucket, content["redirect"])
             return (False, res.text)
 
-        return retry(
-            10, lambda: __delete__(f"http://{self.host}:80/log/{bucket}/{start}")
-        )
+        return retry(10, lambda: __delete__(f"/log/{bucket}/{start}"))
 
-    def log_fetch(self, bucket, start):
-        @self.with_fallback
+    @registry.timed("kevasto_call_seconds", op="log_fetch")
+    def log_fetch(self, bucket, start, limit=None):
+        @self.with_fallback(bucket)
         def __get__(url):
             res = self.session.get(url)
             content = res.json()
             if res.status_code == 200:
                 return (True, content["data"])
             elif content.get("redirect"):
-                self.host = content["redirect"]
+                self.redirect(bucket, content["redirect"])
             return (False, res.text)
 
-        return retry(10, lambda: __get__(f"http://{self.host}:80/log/{bucket}/{start}"))
+        path = f"/log/{bucket}/{start}"
+        if limit is not None:
+            path += f"?limit={limit}"
+        return retry(10, lambda: __get__(path))
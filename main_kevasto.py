@@ -5,7 +5,8 @@ import docker
 from flask import Flask
 
 from kevasto import *
-import bjoern
+from peer import PEER_PORT, PeerServer, PeerTransport
+from werkzeug.serving import make_server
 
 # def manual_test():
 #     response = requests.post("http://localhost:8083/append_entry", json={"a": "a"})
@@ -43,15 +44,39 @@ def main():
     logging.basicConfig(level=logging.INFO)
     logging.getLogger("werkzeug").setLevel(logging.ERROR)
     app = Flask(__name__)
-    raft = Raft(
-        name,
-        replicas,
-        KeyValueVM(),
-        housekeep=True,
-    )
-    add_raft_routes(app, raft)
-
-    bjoern.run(app, "0.0.0.0", 80)
+    # peer traffic goes over the binary transport, clients keep the HTTP API
+    transport = PeerTransport() if PEER_PORT else None
+    rafts = []
+    if KEVASTO_GROUPS == 1:
+        rafts.append(
+            Raft(name, replicas, KeyValueVM(), housekeep=True, transport=transport)
+        )
+    else:
+        for group in range(KEVASTO_GROUPS):
+            rafts.append(
+                Raft(
+                    name,
+                    replicas,
+                    KeyValueVM(),
+                    base_path=f"/tmp/raft.{group}",
+                    housekeep=True,
+                    group=group,
+                    transport=transport,
+                )
+            )
+
+        @app.route("/health", methods=["GET"])
+        def healthcheck():
+            return ("", 204)
+
+    for raft in rafts:
+        add_raft_routes(app, raft)
+    if PEER_PORT:
+        PeerServer(rafts)
+
+    # threaded, writes wait for their commit together and a slow commit
+    # does not hold up other groups or /health
+    make_server("0.0.0.0", 80, app, threaded=True).serve_forever()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,106 @@
+import time
+from contextlib import ContextDecorator
+from threading import Lock
+
+# name: (type, help), every metric a process may report
+METRICS = {
+    "pipe_messages_in_total": ("counter", "Messages received per queue"),
+    "pipe_messages_out_total": ("counter", "Messages published per exchange and routing key"),
+    "pipe_bytes_decoded_total": ("counter", "Message bytes decoded per queue"),
+    "pipe_bytes_encoded_total": ("counter", "Message bytes encoded per exchange and routing key"),
+    "filter_records_in_total": ("counter", "Records consumed per queue"),
+    "filter_records_out_total": ("counter", "Records produced by map functions per queue"),
+    "filter_ack_latency_seconds": ("summary", "Time from receiving a message to acking it"),
+    "filter_map_seconds": ("summary", "Time spent in map_fn"),
+    "filter_step_seconds": ("summary", "Time spent in step_fn"),
+    "filter_accumulator_size": ("gauge", "Entries in the accumulator of the last step"),
+    "filter_accumulator_bytes": ("gauge", "Approximate bytes held by the accumulator of the last step"),
+    "kevasto_call_seconds": ("summary", "Time spent in kevasto client calls, retries included"),
+}
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for (name, value) in pairs
+    ]
+    return "{" + ",".join(f'{name}="{value}"' for (name, value) in escaped) + "}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        # name -> labels -> value, summaries keep [sum, count]
+        self.values = {name: {} for name in METRICS}
+
+    def inc(self, name, value=1, **labels):
+        key = labels_key(labels)
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][labels_key(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = labels_key(labels)
+        with self.lock:
+            series = self.values[name]
+            if key not in series:
+                series[key] = [0, 0]
+            series[key][0] += value
+            series[key][1] += 1
+
+    def series(self, name):
+        with self.lock:
+            return [(dict(key), value) for (key, value) in self.values[name].items()]
+
+    def timed(self, name, **labels):
+        return Timed(self, name, labels)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for (name, (kind, description)) in METRICS.items():
+                series = self.values[name]
+                if not series:
+                    continue
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (key, value) in series.items():
+                    if kind == "summary":
+                        lines.append(f"{name}_sum{format_labels(key)} {value[0]}")
+                        lines.append(f"{name}_count{format_labels(key)} {value[1]}")
+                    else:
+                        lines.append(f"{name}{format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class Timed(ContextDecorator):
+    def __init__(self, registry, name, labels) -> None:
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def _recreate_cm(self):
+        # a fresh timer per call when used as a decorator from several threads
+        return Timed(self.registry, self.name, self.labels)
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, ex_type, ex, trace):
+        self.registry.observe(self.name, time.monotonic() - self.start, **self.labels)
+        return False
+
+
+registry = Registry()
@@ -0,0 +1,20 @@
+import functools
+import os
+
+# the container name when known up front, skips asking the docker daemon
+NODE_NAME = os.environ.get("NODE_NAME")
+
+
+@functools.lru_cache(maxsize=None)
+def node_name():
+    # replicas address each other and name their state by the container
+    # name, it never changes for the life of the process
+    if NODE_NAME:
+        return NODE_NAME
+    import docker
+
+    client = docker.from_env()
+    try:
+        return client.containers.get(os.environ["HOSTNAME"]).name
+    finally:
+        client.close()
@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+import socket
+import struct
+from concurrent.futures import Future, TimeoutError
+from threading import Lock, RLock, Thread
+
+PEER_PORT = int(os.environ.get("PEER_PORT", 8090))
+PEER_TIMEOUT = int(os.environ.get("PEER_TIMEOUT", 9000))
+CONNECT_TIMEOUT = int(os.environ.get("PEER_CONNECT_TIMEOUT", 3000))
+
+SERVICES = ["append_entries", "request_vote", "install_snapshot"]
+# body length, request id, raft group, service (status in responses)
+FRAME = struct.Struct("<IQHB")
+OK = 0
+ERROR = 1
+# bodies of the bulk requests, the rest and every response are JSON
+# term, prev_log_index, prev_log_term, leader_commit, snapshot_version, entries
+APPEND_ENTRIES = struct.Struct("<QqQqQI")
+# term and data length of an entry, its data follows as JSON
+ENTRY = struct.Struct("<QI")
+# term, snapshot_version, snapshot_term, offset, done; the raw chunk follows
+INSTALL_SNAPSHOT = struct.Struct("<QQQQ?")
+NAME = struct.Struct("<H")
+
+logger = logging.getLogger("raft")
+
+
+def encode_name(name):
+    name = name.encode("utf-8")
+    return NAME.pack(len(name)) + name
+
+
+def decode_name(body, offset):
+    (length,) = NAME.unpack_from(body, offset)
+    offset += NAME.size
+    return (body[offset : offset + length].decode("utf-8"), offset + length)
+
+
+def encode_append_entries(req):
+    parts = [
+        APPEND_ENTRIES.pack(
+            req["term"],
+            req["prev_log_index"],
+            req["prev_log_term"],
+            req["leader_commit"],
+            req["snapshot_version"],
+            len(req["entries"]),
+        ),
+        encode_name(req["leader_id"]),
+    ]
+    for entry in req["entries"]:
+        data = json.dumps(entry["data"]).encode("utf-8")
+        parts.append(ENTRY.pack(entry["term"], len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_append_entries(body):
+    (
+        term,
+        prev_log_index,
+        prev_log_term,
+        leader_commit,
+        snapshot_version,
+        count,
+    ) = APPEND_ENTRIES.unpack_from(body)
+    (leader_id, offset) = decode_name(body, APPEND_ENTRIES.size)
+    entries = []
+    for _ in range(count):
+        (entry_term, length) = ENTRY.unpack_from(body, offset)
+        offset += ENTRY.size
+        entries.append(
+            {"term": entry_term, "data": json.loads(body[offset : offset + length])}
+        )
+        offset += length
+    return {
+        "term": term,
+        "leader_id": leader_id,
+        "prev_log_index": prev_log_index,
+        "prev_log_term": prev_log_term,
+        "entries": entries,
+        "leader_commit": leader_commit,
+        "snapshot_version": snapshot_version,
+    }
+
+
+def encode_install_snapshot(req):
+    return (
+        INSTALL_SNAPSHOT.pack(
+            req["term"],
+            req["snapshot_version"],
+            req["snapshot_term"],
+            req["offset"],
+            req["done"],
+        )
+        + encode_name(req["leader_id"])
+        + req["data"]
+    )
+
+
+def decode_install_snapshot(body):
+    (term, snapshot_version, snapshot_term, offset, done) = INSTALL_SNAPSHOT.unpack_from(
+        body
+    )
+    (leader_id, start) = decode_name(body, INSTALL_SNAPSHOT.size)
+    return {
+        "term": term,
+        "leader_id": leader_id,
+        "snapshot_version": snapshot_version,
+        "snapshot_term": snapshot_term,
+        "offset": offset,
+        "data": body[start:],
+        "done": done,
+    }
+
+
+def encode_json(data):
+    return json.dumps(data).encode("utf-8")
+
+
+# (encode, decode) of the request body, by service
+CODECS = {
+    "append_entries": (encode_append_entries, decode_append_entries),
+    "request_vote": (encode_json, json.loads),
+    "install_snapshot": (encode_install_snapshot, decode_install_snapshot),
+}
+
+
+def encode_frame(request_id, group, code, body):
+    return FRAME.pack(len(body), request_id, group, code) + body
+
+
+def read_frame(reader):
+    header = reader.read(FRAME.size)
+    if len(header) < FRAME.size:
+        raise ConnectionError("peer connection closed")
+    length, request_id, group, code = FRAME.unpack(header)
+    body = reader.read(length)
+    if len(body) < length:
+        raise ConnectionError("peer connection closed")
+    return (request_id, group, code, body)
+
+
+# Leader to follower traffic of every group hosted by the node, over
+# persistent connections, one per group; requests of a connection are
+# answered in order, a slow group does not hold the others back
+class PeerServer:
+    def __init__(self, rafts, port=PEER_PORT, host="0.0.0.0"):
+        self.rafts = {raft.group: raft for raft in rafts}
+        self.socket = socket.create_server((host, port))
+        self.port = self.socket.getsockname()[1]
+        self.is_shutdown = False
+        self.thread = Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while not self.is_shutdown:
+            try:
+                conn, _ = self.socket.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        reader = conn.makefile("rb")
+        try:
+            while not self.is_shutdown:
+                (request_id, group, service, body) = read_frame(reader)
+                try:
+                    raft = self.rafts[group]
+                    (_, decode) = CODECS[SERVICES[service]]
+                    res = getattr(raft, SERVICES[service])(decode(body))
+                    frame = encode_frame(request_id, group, OK, encode_json(res))
+                except Exception as e:
+                    logger.exception(f"Serving {group}/{service}")
+                    frame = encode_frame(request_id, group, ERROR, encode_json(str(e)))
+                conn.sendall(frame)
+        except OSError:
+            pass
+        finally:
+            reader.close()
+            conn.close()
+
+    def shutdown(self):
+        self.is_shutdown = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+
+
+class PeerConnection:
+    def __init__(self, address):
+        self.address = address
+        self.lock = RLock()
+        self.socket = None
+        self.pending = {}
+        self.next_id = 0
+
+    def connect(self):
+        sock = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT / 1000)
+        # a follower that stops reading fails the send instead of blocking every
+        # caller queued on the lock; the connection is dropped and made again
+        sock.settimeout(PEER_TIMEOUT / 1000)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = sock
+        Thread(target=self.receive, args=(sock,), daemon=True).start()
+
+    def call(self, group, service, data, timeout):
+        future = Future()
+        (encode, _) = CODECS[service]
+        body = encode(data)
+        with self.lock:
+            if self.socket is None:
+                self.connect()
+            self.next_id += 1
+            request_id = self.next_id
+            self.pending[request_id] = future
+            frame = encode_frame(request_id, group, SERVICES.index(service), body)
+            try:
+                self.socket.sendall(frame)
+            except OSError:
+                self.close(self.socket)
+                raise
+        try:
+            return future.result(timeout)
+        finally:
+            with self.lock:
+                self.pending.pop(request_id, None)
+
+    def receive(self, sock):
+        reader = sock.makefile("rb")
+        try:
+            while True:
+                (request_id, _, status, body) = read_frame(reader)
+                res = json.loads(body)
+                with self.lock:
+                    future = self.pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if status == OK:
+                    future.set_result(res)
+                else:
+                    future.set_exception(Exception(res))
+        except (OSError, ValueError):
+            pass
+        finally:
+            reader.close()
+            self.close(sock)
+
+    def close(self, sock):
+        with self.lock:
+            if self.socket is not sock:
+                return
+            self.socket = None
+            pending, self.pending = self.pending, {}
+        sock.close()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("peer connection closed"))
+
+
+class PeerTransport:
+    def __init__(self, port=PEER_PORT, resolve=None):
+        # replicas are named by their HTTP host, the peer port is the same everywhere
+        self.resolve = resolve or (lambda replica: (replica.split(":")[0], port))
+        self.connections = {}
+        self.lock = Lock()
+
+    def call(self, replica, group, service, data):
+        with self.lock:
+            conn = self.connections.get((replica, group))
+            if conn is None:
+                conn = PeerConnection(self.resolve(replica))
+                self.connections[(replica, group)] = conn
+        try:
+            return conn.call(group, service, data, PEER_TIMEOUT / 1000)
+        except TimeoutError:
+            logger.error(f"Calling {replica}/{service} timed out")
+        except Exception as e:
+            logger.error(f"Calling {replica}/{service} " + str(e))
+        return None
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections.values():
+                if conn.socket is not None:
+                    conn.close(conn.socket)
+            self.connections = {}
@@ -2,6 +2,7 @@ import json
 import logging
 import threading
 import atexit
+from queue import Empty, Full, Queue
 from typing import List
 
 import pika
@@ -9,11 +10,15 @@ import os
 from pika.exceptions import AMQPConnectionError, ChannelClosed
 
 from contextlib import contextmanager
+from metrics import registry
+from node import node_name
 
 logging.basicConfig(level=logging.ERROR)
 logger = logging.getLogger("pipe")
 logger.setLevel(logging.INFO)
 RETRIES = 3
+# seconds an idle publisher waits before servicing heartbeats
+HEARTBEAT_POLL = float(os.environ.get("HEARTBEAT_POLL", 1))
 
 
 def open_connection():
@@ -23,19 +28,19 @@ def open_connection():
 
 
 class Connection:
+    # opened on the first channel, importing pipe does not connect; one per
+    # thread, threads that open one close it themselves, the main thread's at exit
     def __init__(self) -> None:
         self.local = threading.local()
-        self.local.connection = open_connection()
-        atexit.register(self.local.connection.close)
+        atexit.register(self.close)
 
     def close(self):
-        if hasattr(self.local, "connection"):
+        if hasattr(self.local, "connection") and self.local.connection.is_open:
             self.local.connection.close()
 
     def channel(self):
         if not hasattr(self.local, "connection"):
             self.local.connection = open_connection()
-            atexit.register(self.local.connection.close)
         i = 0
         while i < RETRIES:
             try:
@@ -63,6 +68,89 @@ def lease_channel():
         channel.close()
 
 
+def publish(channel, exchange, routing_key, data):
+    body = json.dumps(data)
+    registry.inc("pipe_messages_out_total", exchange=exchange, routing_key=routing_key)
+    registry.inc(
+        "pipe_bytes_encoded_total",
+        len(body),
+        exchange=exchange,
+        routing_key=routing_key,
+    )
+    return channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body)
+
+
+# Encodes and publishes, on its own thread and connection, whatever the
+# thread it is attached to sends. Acks queued in between run once everything
+# sent before them is out, so outputs are published before their input is acked
+class Publisher:
+    local = threading.local()
+
+    def __init__(self, depth) -> None:
+        self.queue = Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def current(cls):
+        return getattr(cls.local, "publisher", None)
+
+    def attach(self):
+        Publisher.local.publisher = self
+
+    def detach(self):
+        Publisher.local.publisher = None
+
+    def put(self, item):
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                return self.queue.put(item, timeout=1)
+            except Full:
+                pass
+
+    def send_to(self, exchange, routing_key, data):
+        self.put((exchange, routing_key, data))
+
+    def ack(self, ack):
+        self.put(ack)
+
+    def run(self):
+        channel = None
+        try:
+            channel = connection.channel()
+            while True:
+                try:
+                    item = self.queue.get(timeout=HEARTBEAT_POLL)
+                except Empty:
+                    # nothing to publish between sessions, keep the connection alive
+                    channel.connection.process_data_events(time_limit=0)
+                    continue
+                if item is None:
+                    break
+                if callable(item):
+                    item()
+                else:
+                    publish(channel, *item)
+        except Exception as e:
+            logger.exception(str(e))
+            self.error = e
+        finally:
+            if channel is not None and channel.is_open:
+                channel.close()
+            connection.close()
+
+    def close(self):
+        # waits until everything queued is published and acked
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
 class Close:
     def close(self):
         pass
@@ -83,14 +171,13 @@ class Exchange(Send):
         self.send_to(self.exchange, self.routing_key, data)
 
     def send_to(self, exchange, routing_key, data):
+        publisher = Publisher.current()
+        if publisher is not None:
+            return publisher.send_to(exchange, routing_key, data)
         try:
             if self.channel is None:
                 self.channel = connection.channel()
-            return self.channel.basic_publish(
-                exchange=exchange,
-                routing_key=routing_key,
-                body=json.dumps(data),
-            )
+            return publish(self.channel, exchange, routing_key, data)
         except (AMQPConnectionError, ChannelClosed) as e:
             logger.exception(str(e))
             self.channel = None
@@ -134,7 +221,7 @@ class Scatter(Send):
 
 
 class Recv(Close):
-    def recv(self, auto_ack=False):
+    def recv(self, auto_ack=False, inactivity_timeout=None):
         return
 
 
@@ -165,12 +252,35 @@ class Pipe(Recv, Exchange):
     def __str__(self) -> str:
         return f"Pipe[{self.exchange},{self.routing_key},{self.queue}]"
 
-    def recv(self, auto_ack=False):
+    def recv(self, auto_ack=False, inactivity_timeout=None):
+        # with an inactivity_timeout (None, None) is yielded whenever the queue is idle
         try:
             if self.channel is None or self.channel.is_closed:
                 self.channel = connection.channel()
-            for method, _, body in self.channel.consume(self.queue, auto_ack=False):
-                ack = lambda: self.channel.basic_ack(method.delivery_tag)
+            channel = self.channel
+            consumer = threading.get_ident()
+
+            def acker(tag):
+                # other threads hand the ack to the consuming connection
+                def ack():
+                    if threading.get_ident() == consumer:
+                        channel.basic_ack(tag)
+                    else:
+                        channel.connection.add_callback_threadsafe(
+                            lambda: channel.basic_ack(tag)
+                        )
+
+                return ack
+
+            for method, _, body in channel.consume(
+                self.queue, auto_ack=False, inactivity_timeout=inactivity_timeout
+            ):
+                if method is None:
+                    yield (None, None)
+                    continue
+                ack = acker(method.delivery_tag)
+                registry.inc("pipe_messages_in_total", queue=self.queue)
+                registry.inc("pipe_bytes_decoded_total", len(body), queue=self.queue)
                 yield (
                     json.loads(body.decode("utf-8")),
                     ack,
@@ -185,6 +295,11 @@ class Pipe(Recv, Exchange):
             if self.channel and self.channel.is_open:
                 self.channel.cancel()
 
+    def keepalive(self):
+        # services heartbeats while the consuming thread is busy elsewhere
+        if self.channel and self.channel.is_open:
+            self.channel.connection.process_data_events(time_limit=0)
+
     def close(self):
         if self.channel and self.channel.is_open:
             try:
@@ -354,15 +469,17 @@ def reports():
     )
 
 
-import docker
+def control_done():
+    return Pipe(
+        exchange="control",
+        routing_key="control.done",
+        queue="control.done",
+    )
 
 
 def pub_sub_control():
     try:
-        client = docker.from_env()
-        container = client.containers.get(os.environ["HOSTNAME"])
-        name = container.name
-        client.close()
+        name = node_name()
     except:
         name = ""
     return Pipe(
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import os
+import time
+from threading import Thread
+
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", 2))
+PROBE_PORT = int(os.environ.get("PROBE_PORT", 80))
+
+logger = logging.getLogger("WatchdogSideCar")
+
+
+class Target:
+    def __init__(self, host) -> None:
+        self.host = host
+        self.reader = None
+        self.writer = None
+        self.healthy = None
+        self.last_ok = None
+        self.rtt = None
+        self.failures = 0
+        self.detected = None
+        # seconds from the last healthy probe to the probe that noticed the failure
+        self.detection_latency = None
+
+    def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    def stats(self):
+        return {
+            "healthy": self.healthy,
+            "rtt": self.rtt,
+            "failures": self.failures,
+            "detection_latency": self.detection_latency,
+        }
+
+
+# Probes every target at once on its own event loop, over keep-alive
+# connections, so a hung target only costs its own timeout
+class Prober:
+    def __init__(self, timeout=PROBE_TIMEOUT, port=PROBE_PORT) -> None:
+        self.timeout = timeout
+        self.port = port
+        self.targets = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def target(self, host):
+        if host not in self.targets:
+            self.targets[host] = Target(host)
+        return self.targets[host]
+
+    def probe(self, hosts, on_failure=None):
+        # blocks until every host answered or timed out, on_failure runs in
+        # parallel for all the failed ones; returns the hosts that failed
+        return asyncio.run_coroutine_threadsafe(
+            self.probe_all(hosts, on_failure), self.loop
+        ).result()
+
+    async def probe_all(self, hosts, on_failure):
+        targets = [self.target(host) for host in hosts]
+        results = await asyncio.gather(*[self.check(target) for target in targets])
+        failed = [target.host for (target, ok) in zip(targets, results) if not ok]
+        if on_failure is not None and failed:
+            await asyncio.gather(
+                *[self.loop.run_in_executor(None, on_failure, host) for host in failed],
+                return_exceptions=True,
+            )
+        return failed
+
+    async def check(self, target):
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(self.request(target), self.timeout)
+        except Exception as e:
+            target.disconnect()
+            self.failed(target, start, e)
+            return False
+        target.rtt = time.monotonic() - start
+        target.healthy = True
+        target.last_ok = start
+        target.failures = 0
+        return True
+
+    def failed(self, target, start, error):
+        target.failures += 1
+        if target.healthy is not False:
+            target.detected = time.monotonic()
+            if target.last_ok is not None:
+                target.detection_latency = target.detected - target.last_ok
+            if target.last_ok is None:
+                logger.info("Process %s is down (%r), never healthy", target.host, error)
+            else:
+                logger.info(
+                    "Process %s is down (%r), detected %.2fs after its last healthy probe",
+                    target.host,
+                    error,
+                    target.detection_latency,
+                )
+        target.healthy = False
+
+    async def request(self, target):
+        if target.writer is None or target.writer.is_closing():
+            target.reader, target.writer = await asyncio.open_connection(
+                target.host, self.port
+            )
+        target.writer.write(
+            f"GET /health HTTP/1.1\r\nHost: {target.host}\r\n"
+            "Connection: keep-alive\r\n\r\n".encode()
+        )
+        await target.writer.drain()
+        status = await target.reader.readline()
+        if not status:
+            raise ConnectionError("connection closed")
+        (version, code) = status.decode().split()[:2]
+        headers = {}
+        while True:
+            line = await target.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            (name, _, value) = line.decode().partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length:
+            await target.reader.readexactly(length)
+        if version == "HTTP/1.0" or headers.get("connection", "").lower() == "close":
+            target.disconnect()
+        if not 200 <= int(code) < 300:
+            raise ConnectionError(f"status {code}")
+
+    def stats(self):
+        return {host: target.stats() for (host, target) in self.targets.items()}
+
+    def close(self):
+        for target in self.targets.values():
+            self.loop.call_soon_threadsafe(target.disconnect)
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -1,10 +1,16 @@
+import base64
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
 import contextlib
+import copy
 from datetime import datetime, timedelta
+import glob
 import json
 import os
 import random
-from threading import RLock
+import time
+from threading import Event, Lock, RLock, Thread
 
+from raft_log import Durability, SegmentedLog
 from scheduler import Scheduler
 import requests
 import logging
@@ -13,6 +19,11 @@ HEARBEAT_TIMEOUT = int(os.environ.get("HEARBEAT_TIMEOUT", 2000))
 FINAL_ELECTION_TIMEOUT = int(os.environ.get("ELECTION_TIMEOUT", 10000))
 HOUSEKEEPING_TIMEOUT = int(os.environ.get("HOUSEKEEPING_TIMEOUT", 30000))
 HOUSEKEEPING_MAX_SIZE = int(os.environ.get("HOUSEKEEPING_MAX_SIZE", 100)) * 1024 * 1024
+COMMIT_TIMEOUT = int(os.environ.get("COMMIT_TIMEOUT", 10000))
+SNAPSHOT_CHUNK_SIZE = int(os.environ.get("SNAPSHOT_CHUNK_SIZE", 1024)) * 1024
+MAX_BATCH_BYTES = int(os.environ.get("MAX_BATCH_BYTES", 1024)) * 1024
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 4))
+CHECKPOINT_ENTRIES = int(os.environ.get("CHECKPOINT_ENTRIES", 10000))
 
 logger = logging.getLogger("raft")
 logger.setLevel(logging.INFO)
@@ -45,22 +56,30 @@ def write_json_line(f, data):
     f.write(json.dumps(data) + "\n")
 
 
-ELECTION_TIMEOUT = 100
+FIRST_ELECTION_TIMEOUT = 100
 
 
-def generate_election_timeout():
-    global ELECTION_TIMEOUT
-    timeout = random.randint(10, 20) / 10 * ELECTION_TIMEOUT
-    ELECTION_TIMEOUT = FINAL_ELECTION_TIMEOUT
-    return timeout
+def generate_election_timeout(context):
+    if not context.first_election:
+        return random.randint(10, 20) / 10 * FINAL_ELECTION_TIMEOUT
+    # the first election is quick and staggered by the rank of the node in the
+    # group, so groups sharing the same nodes start with different leaders
+    context.first_election = False
+    rank = 0
+    if context.name in context.replicas:
+        replicas = sorted(context.replicas)
+        rank = (replicas.index(context.name) - context.group) % len(replicas)
+    return random.randint(10, 20) / 10 * FIRST_ELECTION_TIMEOUT * (1 + 2 * rank)
 
 
 class Follower:
     def __init__(self, context):
         self.context = context
-        self.election_timeout = generate_election_timeout()
+        self.election_timeout = generate_election_timeout(self.context)
         self.last_message_time = datetime.now()
-        self.context.schedule(self.election_timeout, self.on_election_timeout)
+        self.timer = self.context.schedule(
+            self.election_timeout, self.on_election_timeout, True
+        )
 
     def on_election_timeout(self):
         if self.context.state != self:
@@ -69,7 +88,11 @@ class Follower:
         if elapsed_time.total_seconds() * 1000 >= self.election_timeout:
             self.context.as_candidate()
         else:
-            self.context.schedule(self.election_timeout, self.on_election_timeout)
+            # once a leader is heard of only the full timeout applies
+            self.election_timeout = generate_election_timeout(self.context)
+            self.timer = self.context.schedule(
+                self.election_timeout, self.on_election_timeout, True
+            )
 
     def append_entries(self, req):
         logger.debug("append_entries %s", self.last_message_time)
@@ -86,6 +109,20 @@ class Follower:
             "term": self.context.current_term,
         }
 
+    def install_snapshot(self, req):
+        if self.context.voted_for is None:
+            self.context.voted_for = req["leader_id"]
+
+        if req["leader_id"] == self.context.voted_for:
+            self.last_message_time = datetime.now()
+            return self.context.__install_snapshot__(req)
+
+        return {
+            "success": False,
+            "snapshot_version": self.context.snapshot_version,
+            "term": self.context.current_term,
+        }
+
     def request_vote(self, req):
         self.last_message_time = datetime.now()
         return self.context.__request_vote__(req)
@@ -121,7 +158,7 @@ class Candidate:
                     "term": self.context.current_term,
                     "candidate_id": self.context.name,
                     "last_log_index": len(self.context.entries) - 1,
-                    "last_log_term": self.context.entries[-1]["term"],
+                    "last_log_term": self.context.entries.term(-1),
                     "snapshot_version": self.context.snapshot_version,
                 },
             )
@@ -131,12 +168,17 @@ class Candidate:
                     votes += 1
                 max_term = max(max_term, res["term"])
         logger.info(f"votes {votes} {self.context.replicas}")
-        if votes >= int(len(self.context.replicas) / 2) + 1:
-            self.context.as_leader()
-        else:
-            logger.info("step down as follower")
-            self.context.__vote__(None, max(max_term, self.context.current_term))
-            self.context.as_follower()
+        # the votes are asked off the lock, the outcome is applied under it
+        # unless the node moved on meanwhile
+        with self.context.lock:
+            if self.context.state is not self:
+                return
+            if votes >= int(len(self.context.replicas) / 2) + 1:
+                self.context.as_leader()
+            else:
+                logger.info("step down as follower")
+                self.context.__vote__(None, max(max_term, self.context.current_term))
+                self.context.as_follower()
 
     def append_entries(self, req):
         logger.info("candidate append_entries")
@@ -146,6 +188,9 @@ class Candidate:
             "snapshot_version": self.context.snapshot_version,
         }
 
+    def install_snapshot(self, req):
+        return self.append_entries(req)
+
     def request_vote(self, req):
         return {
             "term": self.context.current_term,
@@ -190,7 +235,7 @@ class HouseKeeper(Scheduler):
         self.schedule(timedelta(milliseconds=HOUSEKEEPING_TIMEOUT), self.housekeeping)
 
     def housekeeping_needed(self):
-        return self.owner.context.log.tell() > HOUSEKEEPING_MAX_SIZE
+        return self.owner.context.entries.size() > HOUSEKEEPING_MAX_SIZE
 
     def housekeeping(self):
         logger.info("housekeeping start")
@@ -215,35 +260,126 @@ class Leader:
         self.snapshot_index = {
             replica: self.context.snapshot_version for replica in self.context.replicas
         }
+        self.snapshot_offset = {replica: 0 for replica in self.context.replicas}
         self.match_index = {replica: 0 for replica in self.context.replicas}
-        self.context.schedule(self.heartbeat_timeout, self.heartbeat, True)
+        # next_index runs ahead of match_index by the batches in flight, after a
+        # mismatch a replica is probed one request at a time until it matches
+        self.in_flight = {replica: 0 for replica in self.context.replicas}
+        self.probing = {replica: True for replica in self.context.replicas}
+        self.pool = ThreadPoolExecutor(
+            max_workers=max(len(self.context.replicas) - 1, 1) * MAX_IN_FLIGHT
+        )
         self.last_timestamp = datetime.now()
+        # group commit: writers enqueue and wait, the replicator ships them together
+        self.queue = []
+        self.waiting = {}
+        # errors of entries the machine rejected, by absolute index
+        self.failed = {}
+        self.queue_lock = Lock()
+        self.queue_event = Event()
+        self.is_shutdown = False
         self.house_keeper = HouseKeeper(self)
+        self.replicator = Thread(target=self.replicate, daemon=True)
+        # the first heartbeat goes out right away to stop other elections
+        self.queue_event.set()
+        self.replicator.start()
+
+    def replicate(self):
+        while not self.is_shutdown:
+            self.queue_event.wait(self.heartbeat_timeout / 1000)
+            self.queue_event.clear()
+            with self.context.lock:
+                if self.is_shutdown:
+                    return
+                # the loop outlives any failed round, the next one retries
+                try:
+                    self.heartbeat()
+                except Exception:
+                    logger.exception("heartbeat")
 
     def heartbeat(self):
         logger.debug("heartbeat %s", self.last_timestamp)
-        if self.context.state != self:
-            return
         if self.context.voted_for == self.context.name:
             with append_measure("heartbeat_time", self.context.stats):
+                self.flush_queue()
                 commited = self.update_replicas()
-            if commited > self.context.commit_index:
-                self.context.__update_commit_index__(commited)
-            elapsed_time = datetime.now() - self.last_timestamp
-            if elapsed_time.total_seconds() * 1000 < self.heartbeat_timeout - 50:
-                self.context.schedule(self.heartbeat_timeout, self.heartbeat, True)
+            self.commit(commited)
+
+    def commit(self, commited):
+        if commited > self.context.commit_index:
+            failed = self.context.__update_commit_index__(commited)
+            self.failed.update(
+                (index, error)
+                for (index, error) in failed.items()
+                if index in self.waiting
+            )
+        self.notify_commited()
+
+    def flush_queue(self):
+        with self.queue_lock:
+            queue, self.queue = self.queue, []
+        if not queue:
+            return
+        entry_index = len(self.context.entries)
+        try:
+            self.context.__append_entry__(
+                entry_index,
+                [{"term": self.context.current_term, "data": req} for (req, _) in queue],
+            )
+        except Exception as e:
+            for (_, future) in queue:
+                future.set_result({"success": False, "error": str(e)})
+            raise
+        # keyed by absolute index, a snapshot re-bases the local ones
+        for (i, (_, future)) in enumerate(queue):
+            self.waiting[self.context.snapshot_version + entry_index + i] = future
+        self.context.stats["batches"] += 1
+        self.context.stats["batched_entries"] += len(queue)
+
+    def notify_commited(self):
+        commited = self.context.snapshot_version + self.context.commit_index
+        done = []
+        for index in self.waiting:
+            if index > commited:
+                break
+            done.append(index)
+        for index in done:
+            result = {"success": True, "id": index - self.context.snapshot_version}
+            if index in self.failed:
+                result = {**result, "success": False, "error": self.failed.pop(index)}
+            self.waiting.pop(index).set_result(result)
+
+    def shutdown(self):
+        with self.queue_lock:
+            self.is_shutdown = True
+            pending = [future for (_, future) in self.queue]
+            pending.extend(self.waiting.values())
+            self.queue = []
+            self.waiting = {}
+        self.queue_event.set()
+        self.house_keeper.shutdown()
+        self.pool.shutdown(wait=False)
+        for future in pending:
+            future.set_result({"success": False, "redirect": self.context.voted_for})
 
     def append_entries(self, req):
         if req["term"] > self.context.current_term:
             self.context.__vote__(req["leader_id"], req["term"])
-            self.house_keeper.shutdown()
+            self.shutdown()
             self.context.as_follower()
         return self.context.__append_entries__(req)
 
+    def install_snapshot(self, req):
+        if req["term"] > self.context.current_term:
+            self.context.__vote__(req["leader_id"], req["term"])
+            self.shutdown()
+            self.context.as_follower()
+        return self.context.__install_snapshot__(req)
+
     def request_vote(self, req):
         voted = self.context.__request_vote__(req)
         if voted["vote_granted"]:
-            self.house_keeper.shutdown()
+            self.shutdown()
             self.context.as_follower()
         return voted
 
@@ -254,101 +390,167 @@ class Leader:
                 self.match_index[replica] = len(self.context.entries) - 1
                 self.next_index[replica] = len(self.context.entries)
                 continue
-            res = None
-            try:
-                if self.snapshot_index[replica] != self.context.snapshot_version:
+            if self.snapshot_index[replica] != self.context.snapshot_version:
+                # a slow replica keeps its request in flight, the rest go on without it
+                if self.in_flight[replica] == 0:
                     logger.debug(f"snapshot update to {replica}")
-                    res = self.context.fetch(
-                        replica,
-                        "append_entries",
-                        {
-                            "term": self.context.current_term,
-                            "leader_id": self.context.name,
-                            "snapshot": self.context.machine.snapshot(),
-                            "snapshot_version": self.context.snapshot_version,
-                        },
-                    )
-                    if res:
-                        if res["success"] == True:
-                            self.next_index[replica] = 1
-                            self.match_index[replica] = 0
-                            self.snapshot_index[replica] = res["snapshot_version"]
-                    continue
+                    self.submit(replica, "install_snapshot", self.snapshot_chunk(replica))
+                continue
+            window = 1 if self.probing[replica] else MAX_IN_FLIGHT
+            while self.in_flight[replica] < window:
+                logger.debug(
+                    f"heartbeat/update data to {replica} {self.next_index[replica]}"
+                )
+                prev_log_index = self.next_index[replica] - 1
+                entries = self.context.entries.batch(prev_log_index + 1, MAX_BATCH_BYTES)
+                # only full batches are pipelined, the tail waits for the request
+                # in flight so it ships together with the writes queued meanwhile
+                if self.in_flight[replica] > 0 and (
+                    prev_log_index + len(entries) + 1 >= len(self.context.entries)
+                ):
+                    break
+                self.submit(
+                    replica,
+                    "append_entries",
+                    {
+                        "term": self.context.current_term,
+                        "leader_id": self.context.name,
+                        "prev_log_index": prev_log_index,
+                        "prev_log_term": self.context.entries.term(prev_log_index),
+                        "entries": entries,
+                        "leader_commit": self.context.commit_index,
+                        "snapshot_version": self.context.snapshot_version,
+                    },
+                )
+                self.next_index[replica] += len(entries)
+                if self.next_index[replica] >= len(self.context.entries):
+                    break
+        return self.commited()
+
+    def submit(self, replica, service, req):
+        self.in_flight[replica] += 1
+        self.pool.submit(self.send, replica, service, req)
+
+    def snapshot_chunk(self, replica):
+        offset = self.snapshot_offset[replica]
+        data = b""
+        size = 0
+        if os.path.exists(self.context.snapshot_file_name):
+            with open(self.context.snapshot_file_name, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                f.seek(offset)
+                data = f.read(SNAPSHOT_CHUNK_SIZE)
+        return {
+            "term": self.context.current_term,
+            "leader_id": self.context.name,
+            "snapshot_version": self.context.snapshot_version,
+            "snapshot_term": self.context.entries.base_term,
+            "offset": offset,
+            "data": data,
+            "done": offset + len(data) >= size,
+        }
+
+    def send(self, replica, service, req):
+        res = self.context.fetch(replica, service, req)
+        logger.debug(f"{replica} response {res}")
+        with self.context.lock:
+            self.in_flight[replica] -= 1
+            if self.is_shutdown:
+                return
+            try:
+                if service == "install_snapshot":
+                    again = self.on_snapshot_response(replica, req, res)
                 else:
-                    logger.debug(
-                        f"heartbeat/update data to {replica} {self.next_index[replica]}"
-                    )
-                    prev_log_index = self.next_index[replica] - 1
-                    prev_log_term = self.context.entries[prev_log_index]["term"]
-                    res = self.context.fetch(
-                        replica,
-                        "append_entries",
-                        {
-                            "term": self.context.current_term,
-                            "leader_id": self.context.name,
-                            "prev_log_index": prev_log_index,
-                            "prev_log_term": prev_log_term,
-                            "entries": self.context.entries[(prev_log_index + 1) :],
-                            "leader_commit": self.context.commit_index,
-                            "snapshot_version": self.context.snapshot_version,
-                        },
-                    )
-                    logger.debug(f"{replica} response {res}")
-                    if res is None:
-                        continue
-                    if res["success"]:
-                        self.next_index[replica] = len(self.context.entries)
-                        self.match_index[replica] = len(self.context.entries) - 1
-                        continue
-                    if (
-                        res.get("snapshot_version", self.context.snapshot_version)
-                        < self.context.snapshot_version
-                    ):
-                        self.next_index[replica] = 1
-                        self.match_index[replica] = 0
-                        self.snapshot_index[replica] = res.get(
-                            "snapshot_version", self.context.snapshot_version
-                        )
-                        continue
-                    self.next_index[replica] = max(self.next_index[replica] - 1, 1)
+                    again = self.on_response(replica, req, res)
+                self.commit(self.commited())
             except:
                 logger.exception(f"Replica response: {res}")
+                again = False
+            if again or self.queue:
+                self.queue_event.set()
+
+    def on_response(self, replica, req, res):
+        if req["snapshot_version"] != self.context.snapshot_version:
+            # indexes were re-based by a snapshot while the request was in flight
+            return True
+        if res is None:
+            # the batch may be lost, it is sent again
+            self.next_index[replica] = min(
+                self.next_index[replica], req["prev_log_index"] + 1
+            )
+            return False
+        if res["success"]:
+            match = req["prev_log_index"] + len(req["entries"])
+            self.match_index[replica] = max(self.match_index[replica], match)
+            self.next_index[replica] = max(
+                self.next_index[replica], self.match_index[replica] + 1
+            )
+            self.probing[replica] = False
+            return self.next_index[replica] < len(self.context.entries)
+        if (
+            res.get("snapshot_version", self.context.snapshot_version)
+            < self.context.snapshot_version
+        ):
+            self.next_index[replica] = 1
+            self.match_index[replica] = 0
+            self.snapshot_index[replica] = res.get(
+                "snapshot_version", self.context.snapshot_version
+            )
+            return True
+        if req["prev_log_index"] >= self.next_index[replica]:
+            # a later batch of a window that already failed
+            return True
+        self.probing[replica] = True
+        self.next_index[replica] = max(self.backtrack(req, res), 1)
+        return True
+
+    def backtrack(self, req, res):
+        # skip the whole conflicting term instead of one entry per round
+        if "conflict_index" not in res:
+            return req["prev_log_index"]
+        conflict_term = res.get("conflict_term")
+        if conflict_term is not None:
+            i = min(req["prev_log_index"], len(self.context.entries) - 1)
+            while i > 0 and self.context.entries.term(i) > conflict_term:
+                i -= 1
+            if i > 0 and self.context.entries.term(i) == conflict_term:
+                return i + 1
+        return min(res["conflict_index"], req["prev_log_index"])
+
+    def on_snapshot_response(self, replica, req, res):
+        if res is None or not res["success"]:
+            return False
+        if req["snapshot_version"] != self.context.snapshot_version:
+            return True
+        if res["snapshot_version"] >= self.context.snapshot_version:
+            self.next_index[replica] = 1
+            self.match_index[replica] = 0
+            self.probing[replica] = True
+            self.snapshot_index[replica] = res["snapshot_version"]
+            self.snapshot_offset[replica] = 0
+        else:
+            # the follower tells where to resume, it may have kept a partial transfer
+            self.snapshot_offset[replica] = res["offset"]
+        return True
 
+    def commited(self):
         commited_sorted_by_mayority = sort_by_mayority(self.match_index.values())
         logger.debug(f"commited: {commited_sorted_by_mayority}")
         for commited in commited_sorted_by_mayority:
             if commited <= self.context.commit_index:
                 break
-            if self.context.current_term == self.context.entries[commited]["term"]:
-                # TODO concurrency over context.commit_index
+            if self.context.current_term == self.context.entries.term(commited):
                 return commited
         return self.context.commit_index
 
     def append_entry(self, req):
-        self.last_timestamp = datetime.now()
-        entry_index = len(self.context.entries)
-        self.context.__append_entry__(
-            entry_index,
-            [
-                {
-                    "term": self.context.current_term,
-                    "data": req,
-                }
-            ],
-        )
-        commited = self.update_replicas()
-        if commited > self.context.commit_index:
-            self.context.__update_commit_index__(commited)
-
-        if commited == entry_index:
-            return {
-                "success": True,
-                "id": entry_index,
-            }
-        return {
-            "success": False,
-            "id": entry_index,
-        }
+        future = Future()
+        with self.queue_lock:
+            if self.is_shutdown:
+                return {"success": False, "redirect": self.context.voted_for}
+            self.queue.append((req, future))
+        self.queue_event.set()
+        return future
 
     def results(self, query):
         return {
@@ -357,8 +559,15 @@ class Leader:
         }
 
     def snapshot(self):
-        self.context.__snapshot__()
-        return {"success": True}
+        return self.context.__snapshot__()
+
+    def on_snapshot(self):
+        # followers are sent the snapshot, their indexes restart from it
+        for replica in self.context.replicas:
+            if replica != self.context.name:
+                self.next_index[replica] = 1
+                self.match_index[replica] = 0
+                self.snapshot_offset[replica] = 0
 
 
 class NopVM:
@@ -374,9 +583,16 @@ class NopVM:
                     snapshot = json.loads(line)
                     self.reset(context, snapshot)
 
-    def save_snapshot(self, file_name):
+    def save_snapshot(self, file_name, view=None):
         with open(file_name, "w+") as f:
-            json.dump(self.snapshot(), f)
+            json.dump(self.snapshot() if view is None else view, f)
+
+    def freeze(self):
+        # machines without copy-on-write hand out a copy of their state
+        return copy.deepcopy(self.snapshot())
+
+    def thaw(self):
+        return
 
     def reset(self, context, snapshot):
         return {}
@@ -393,15 +609,13 @@ class NopVM:
 
 class Raft:
     def __fix_backups__(self, base_path):
-        if os.path.exists(base_path + ".log.tmp"):
+        # the swap marker is written once every .tmp file is complete
+        if os.path.exists(base_path + ".swap"):
             if os.path.exists(base_path + ".conf.tmp"):
-                os.remove(base_path + ".conf")
-                os.rename(base_path + ".conf.tmp", base_path + ".conf")
+                swap(base_path + ".conf", base_path + ".conf.tmp")
             if os.path.exists(base_path + ".snapshot.tmp"):
-                os.remove(base_path + ".snapshot")
-                os.rename(base_path + ".snapshot.tmp", base_path + ".snapshot")
-            os.remove(base_path + ".log")
-            os.rename(base_path + ".log.tmp", base_path + ".log")
+                swap(base_path + ".snapshot", base_path + ".snapshot.tmp")
+            os.remove(base_path + ".swap")
         else:
             if os.path.exists(base_path + ".conf.tmp"):
                 os.remove(base_path + ".conf.tmp")
@@ -415,11 +629,21 @@ class Raft:
         machine=NopVM(),
         base_path="/tmp/raft",
         housekeep=False,
+        durability=None,
+        group=None,
+        transport=None,
     ) -> None:
         self.__fix_backups__(base_path)
+        start = time.monotonic()
+        self.durability = durability or Durability()
+        self.directory = os.path.dirname(base_path) or "."
 
         self.name = name
         self.replicas = replicas
+        # a node hosting several groups serves each one under /<group>
+        self.group = group or 0
+        self.path = "" if group is None else f"/{group}"
+        self.transport = transport
         self.machine = machine
         self.voted_for = None
         self.housekeep = housekeep
@@ -431,35 +655,48 @@ class Raft:
             conf = json.loads(line)
 
         self.commit_index = conf.get("commit_index", 0)
-        self.last_applied = conf.get("last_applied", 0)
         self.snapshot_version = conf.get("snapshot_version", 0)
         self.voted_for = conf.get("voted_for", None)
         self.current_term = conf.get("current_term", 0)
+        # a restarted node waits for the current leader instead of disrupting it
+        self.first_election = self.current_term == 0
 
         self.snapshot_file_name = base_path + ".snapshot"
-        self.machine.load_file(self, self.snapshot_file_name)
-
-        self.log = open(create_if_not_exists(base_path + ".log"), "r+")
-        self.log.seek(0, 0)
-        self.entries = [{"term": 0, "data": None}]
-        self.seek = [-1]
-        while True:
-            seek = self.log.tell()
-            line = self.log.readline()
-            if not line:
-                break
-            self.seek.append(seek)
-            self.entries.append(json.loads(line))
+        self.swap_file_name = base_path + ".swap"
+        self.checkpoint_file_name = base_path + ".checkpoint"
+
+        self.entries = SegmentedLog(
+            base_path + ".log.d",
+            self.snapshot_version,
+            conf.get("snapshot_term", 0),
+            self.durability,
+        )
 
-        if len(self.entries) > 1:
-            self.machine.run(self.entries[1 : self.commit_index + 1])
+        # only the committed tail after the newest checkpoint is replayed
+        applied = self.__load_checkpoint__()
+        if self.commit_index > applied:
+            self.__apply__(applied + 1, self.commit_index + 1)
+        self.last_applied = self.commit_index
+        self.replayed = self.commit_index - applied
 
         self.session = requests.session()
         self.lock = RLock()
-        self.scheduler = Scheduler()
+        self.dumping = Lock()
+        # one worker, the election timers of an instance never run at once
+        self.scheduler = Scheduler(workers=1)
         self.housekeeper = Scheduler()
         self.as_follower()
         self.reset_stats()
+        if self.durability.interval > 0:
+            self.schedule(self.durability.interval, self.sync, True)
+        if self.housekeep:
+            self.housekeeper.schedule(
+                timedelta(milliseconds=HOUSEKEEPING_TIMEOUT), self.checkpoint
+            )
+        self.restart_time = time.monotonic() - start
+        logger.info(
+            f"{self.name} restarted in {self.restart_time:.3f}s, replayed {self.replayed} entries"
+        )
 
     def get_stats(self):
         def avg(a):
@@ -468,11 +705,22 @@ class Raft:
             else:
                 return sum(a) / len(a)
 
+        timers = self.scheduler.stats()
         return {
             "truncate": self.stats["truncate"],
             "commit_time": avg(self.stats["commit_time"]),
             "snapshot_time": avg(self.stats["snapshot_time"]),
             "heartbeat_time": avg(self.stats["heartbeat_time"]),
+            "batch_size": self.stats["batched_entries"] / self.stats["batches"]
+            if self.stats["batches"] > 0
+            else None,
+            "durability": self.durability.policy,
+            "fsyncs": self.durability.syncs,
+            "fsync_time": self.durability.sync_time,
+            "restart_time": self.restart_time,
+            "timer_lag_avg": timers["lag_avg"],
+            "timer_lag_max": timers["lag_max"],
+            "replayed": self.replayed,
         }
 
     def reset_stats(self):
@@ -482,17 +730,29 @@ class Raft:
             "snapshot_time": [],
             "heartbeat_time": [],
             "commit_time": [],
+            "batches": 0,
+            "batched_entries": 0,
         }
         self.schedule(120000, self.reset_stats)
 
     def append_entry(self, req):
-        with self.lock:
-            return self.state.append_entry(req)
+        # the leader only enqueues, waiting for the commit happens off the lock
+        res = self.state.append_entry(req)
+        if isinstance(res, Future):
+            try:
+                return res.result(COMMIT_TIMEOUT / 1000)
+            except TimeoutError:
+                return {"success": False}
+        return res
 
     def append_entries(self, req):
         with self.lock:
             return self.state.append_entries(req)
 
+    def install_snapshot(self, req):
+        with self.lock:
+            return self.state.install_snapshot(req)
+
     def request_vote(self, req):
         with self.lock:
             return self.state.request_vote(req)
@@ -500,19 +760,13 @@ class Raft:
     def __append_entry__(self, start, reqs):
         if start < len(self.entries):
             self.stats["truncate"] += 1
-            self.log.truncate(self.seek[start])
-            self.entries = self.entries[:start]
-            self.seek = self.seek[:start]
-        self.entries.extend(reqs)
-        for req in reqs:
-            self.seek.append(self.log.tell())
-            write_json_line(self.log, req)
-        self.log.flush()
+        self.entries.write(start, reqs)
 
     def __vote__(self, voted_for, term):
         with self.lock:
             self.voted_for = voted_for
             self.current_term = term
+            self.save_config()
 
     def save_config(self):
         self.config.seek(0, 0)
@@ -521,25 +775,68 @@ class Raft:
             {
                 "commit_index": self.commit_index,
                 "snapshot_version": self.snapshot_version,
-                "last_index": self.last_applied,
+                "snapshot_term": self.entries.base_term,
+                "last_applied": self.last_applied,
                 "voted_for": self.voted_for,
                 "current_term": self.current_term,
             },
         )
         self.config.flush()
+        self.durability.written(self.config, lazy=True)
 
-    def __append_entries__(self, req):
-        snapshot = req.get("snapshot")
-        if snapshot is not None and req["snapshot_version"] >= self.snapshot_version:
-            if req["snapshot_version"] > self.snapshot_version:
-                logger.info("snapshot received")
-                self.machine.reset(self, snapshot)
-                self.save_snapshot(req["snapshot_version"], [])
+    def sync(self):
+        self.durability.sync()
+        self.schedule(self.durability.interval, self.sync, True)
+
+    def __install_snapshot__(self, req):
+        if req["snapshot_version"] <= self.snapshot_version:
             return {
                 "term": self.current_term,
                 "success": True,
                 "snapshot_version": self.snapshot_version,
             }
+        if req["term"] < self.current_term:
+            return {
+                "term": self.current_term,
+                "success": False,
+                "snapshot_version": self.snapshot_version,
+                "msg": "missmatch term",
+            }
+        # chunks land in a per version file, so a restarted follower resumes it
+        part_file_name = f"{self.snapshot_file_name}.{req['snapshot_version']}.part"
+        for stale in glob.glob(self.snapshot_file_name + ".*.part"):
+            if stale != part_file_name:
+                os.remove(stale)
+        received = 0
+        if os.path.exists(part_file_name):
+            received = os.path.getsize(part_file_name)
+        if req["offset"] == received:
+            with open(part_file_name, "ab") as f:
+                f.write(req["data"])
+                received = f.tell()
+                if req["done"]:
+                    self.durability.persist(f)
+            if req["done"]:
+                logger.info("snapshot received")
+                self.machine.load_file(self, part_file_name)
+                # the log restarts at the term of the last entry in the snapshot,
+                # the leader checks prev_log_term against it
+                snapshot_term = req.get("snapshot_term", self.current_term)
+                self.save_snapshot(
+                    req["snapshot_version"],
+                    snapshot_term,
+                    part_file_name,
+                    installed=True,
+                )
+                self.entries.reset(self.snapshot_version, snapshot_term)
+        return {
+            "term": self.current_term,
+            "success": True,
+            "snapshot_version": self.snapshot_version,
+            "offset": received,
+        }
+
+    def __append_entries__(self, req):
         if req["snapshot_version"] != self.snapshot_version:
             return {
                 "term": self.current_term,
@@ -560,26 +857,43 @@ class Raft:
                 "success": False,
                 "snapshot_version": self.snapshot_version,
                 "msg": "missmatch prev_log_index",
+                "conflict_index": len(self.entries),
             }
         else:
-            if self.entries[req["prev_log_index"]]["term"] != req["prev_log_term"]:
+            conflict_term = self.entries.term(req["prev_log_index"])
+            if conflict_term != req["prev_log_term"]:
+                # the leader skips back over the whole conflicting term
+                conflict_index = req["prev_log_index"]
+                while (
+                    conflict_index > 1
+                    and self.entries.term(conflict_index - 1) == conflict_term
+                ):
+                    conflict_index -= 1
                 return {
                     "term": self.current_term,
                     "success": False,
                     "snapshot_version": self.snapshot_version,
                     "msg": "missmatch prev_log_term",
+                    "conflict_term": conflict_term,
+                    "conflict_index": conflict_index,
                 }
 
-        if len(req["entries"]) > 0:
-            self.__append_entry__(req["prev_log_index"] + 1, req["entries"])
-
-        if req["leader_commit"] > self.commit_index:
-            self.__update_commit_index__(
-                min(
-                    req["leader_commit"],
-                    len(self.entries) - 1,
-                )
-            )
+        # entries already in the log are kept, a batch that arrives again or
+        # late must not truncate what later batches appended
+        start = req["prev_log_index"] + 1
+        skip = 0
+        while (
+            skip < len(req["entries"])
+            and start + skip < len(self.entries)
+            and self.entries.term(start + skip) == req["entries"][skip]["term"]
+        ):
+            skip += 1
+        if skip < len(req["entries"]):
+            self.__append_entry__(start + skip, req["entries"][skip:])
+
+        commited = min(req["leader_commit"], start + len(req["entries"]) - 1)
+        if commited > self.commit_index:
+            self.__update_commit_index__(commited)
 
         return {
             "term": self.current_term,
@@ -591,7 +905,7 @@ class Raft:
         logger.debug(f"request_vote: {req}")
 
         def upto_date(self, req):
-            last_log_term = self.entries[-1]["term"]
+            last_log_term = self.entries.term(-1)
             return (
                 last_log_term < req["last_log_term"]
                 or (
@@ -623,67 +937,188 @@ class Raft:
         with append_measure("commit_time", self.stats):
             prev_index = self.commit_index
             self.commit_index = commited
-            self.machine.run(self.entries[prev_index + 1 : commited + 1])
+            failed = self.__apply__(prev_index + 1, commited + 1)
+            self.last_applied = commited
             self.save_config()
+            return failed
+
+    def __apply__(self, start, end):
+        # entry by entry, a command the machine rejects fails alone, the same
+        # way on every replica, and the ones after it still apply
+        failed = {}
+        for (index, entry) in enumerate(self.entries[start:end], start):
+            try:
+                self.machine.run([entry])
+            except Exception as e:
+                logger.error(f"entry {index} rejected: {e}")
+                failed[self.snapshot_version + index] = str(e)
+        return failed
+
+    def __dump__(self, file_name):
+        # the machine is frozen under the lock and serialized without it, so
+        # commits go on while the dump is written
+        with self.lock:
+            base_version = self.snapshot_version
+            applied = self.last_applied
+            term = self.entries.term(applied)
+            view = self.machine.freeze()
+        try:
+            self.machine.save_snapshot(file_name, view)
+            with open(file_name, "rb+") as f:
+                self.durability.persist(f)
+        finally:
+            with self.lock:
+                self.machine.thaw()
+        return (base_version, applied, term)
 
     def __snapshot__(self):
-        with append_measure("snapshot_time", self.stats):
-            snapshot_version = self.snapshot_version + self.commit_index
-            entries = self.entries[self.commit_index + 1 :]
-            self.save_snapshot(snapshot_version, entries)
-
-    def save_snapshot(self, snapshot_version, entries):
-        logger.info("snapshot start")
-        self.machine.save_snapshot(self.snapshot_file_name + ".tmp")
-        logger.info("snaphot machine done")
+        if not self.dumping.acquire(blocking=False):
+            return {"success": False, "msg": "snapshot in progress"}
+        try:
+            with append_measure("snapshot_time", self.stats):
+                logger.info("snapshot start")
+                dump_file_name = self.snapshot_file_name + ".dump"
+                (base_version, applied, term) = self.__dump__(dump_file_name)
+                logger.info("snaphot machine done")
+                with self.lock:
+                    if self.snapshot_version != base_version:
+                        os.remove(dump_file_name)
+                        return {"success": False, "msg": "snapshot superseded"}
+                    snapshot_version = base_version + applied
+                    # the tail written during the dump stays in the log
+                    self.save_snapshot(snapshot_version, term, dump_file_name)
+                    self.entries.compact(snapshot_version, term)
+                    if isinstance(self.state, Leader):
+                        self.state.on_snapshot()
+                    return {"success": True}
+        finally:
+            self.dumping.release()
+
+    def save_snapshot(self, snapshot_version, snapshot_term, file_name, installed=False):
+        # file_name holds the machine at snapshot_version, an installed snapshot
+        # replaces the whole log while a local one keeps the entries after it
+        os.replace(file_name, self.snapshot_file_name + ".tmp")
+        if installed:
+            commit_index = 0
+        else:
+            commit_index = self.commit_index - (snapshot_version - self.snapshot_version)
         with open(self.config.name + ".tmp", "w+") as f:
             write_json_line(
                 f,
                 {
-                    "commit_index": 0,
+                    "commit_index": commit_index,
                     "snapshot_version": snapshot_version,
-                    "last_index": self.last_applied,
+                    "snapshot_term": snapshot_term,
+                    "last_applied": commit_index,
                     "voted_for": self.voted_for,
                     "current_term": self.current_term,
                 },
             )
+            self.durability.persist(f)
 
-        seek = []
-        with open(self.log.name + ".tmp", "w+") as f:
-            for e in entries:
-                seek.append(f.tell())
-                write_json_line(f, e)
-
+        open(self.swap_file_name, "w").close()
+        self.durability.created(self.directory)
         swap(
             self.snapshot_file_name,
             self.snapshot_file_name + ".tmp",
         )
+        self.config.close()
         self.config = swap(self.config.name, self.config.name + ".tmp", "r+")
-        self.log = swap(self.log.name, self.log.name + ".tmp", "r+")
+        self.durability.created(self.directory)
+        os.remove(self.swap_file_name)
 
         self.snapshot_version = snapshot_version
-        self.seek = [-1] + seek
-        self.entries = [{"term": self.current_term, "data": None}] + entries
-        self.commit_index = 0
-        self.last_applied = 0
+        self.commit_index = commit_index
+        self.last_applied = commit_index
+        # an installed snapshot replaces the log the checkpoints were taken from
+        self.drop_checkpoints(float("inf") if installed else snapshot_version)
         logger.info("Snapshot done")
 
+    def checkpoints(self):
+        found = []
+        for name in glob.glob(self.checkpoint_file_name + ".*"):
+            suffix = name.rsplit(".", 1)[1]
+            if suffix.isdigit():
+                found.append((int(suffix), name))
+        return sorted(found)
+
+    def drop_checkpoints(self, upto):
+        for (index, name) in self.checkpoints():
+            if index <= upto:
+                os.remove(name)
+
+    def __load_checkpoint__(self):
+        # a checkpoint is the machine at an applied (absolute) index past the
+        # snapshot, it is only usable while that entry is still in the log
+        applied = 0
+        for (index, name) in reversed(self.checkpoints()):
+            local = index - self.snapshot_version
+            if 0 < local < len(self.entries):
+                logger.info(f"loading checkpoint {index}")
+                self.machine.load_file(self, name)
+                self.commit_index = max(self.commit_index, local)
+                applied = local
+                break
+        else:
+            self.machine.load_file(self, self.snapshot_file_name)
+        for (index, name) in self.checkpoints():
+            if index != self.snapshot_version + applied:
+                os.remove(name)
+        return applied
+
+    def checkpoint(self):
+        applied = self.snapshot_version + self.last_applied
+        newest = max([self.snapshot_version] + [i for (i, _) in self.checkpoints()])
+        if applied - newest >= CHECKPOINT_ENTRIES and self.dumping.acquire(
+            blocking=False
+        ):
+            try:
+                tmp_file_name = self.checkpoint_file_name + ".tmp"
+                (base_version, applied, _) = self.__dump__(tmp_file_name)
+                with self.lock:
+                    if self.snapshot_version == base_version:
+                        logger.info(f"checkpoint {base_version + applied}")
+                        os.replace(
+                            tmp_file_name,
+                            f"{self.checkpoint_file_name}.{base_version + applied}",
+                        )
+                        self.durability.created(self.directory)
+                        self.drop_checkpoints(base_version + applied - 1)
+                    else:
+                        os.remove(tmp_file_name)
+            finally:
+                self.dumping.release()
+        self.housekeeper.schedule(
+            timedelta(milliseconds=HOUSEKEEPING_TIMEOUT), self.checkpoint
+        )
+
+    def __leave_state__(self):
+        if isinstance(getattr(self, "state", None), Follower):
+            self.state.timer.cancel()
+
     def as_candidate(self):
         logger.info(f"{self.name} as candidate")
+        self.__leave_state__()
         self.state = Candidate(self)
 
     def as_leader(self):
         logger.info(f"{self.name} as leader")
+        self.__leave_state__()
         self.state = Leader(self)
 
     def as_follower(self):
         logger.info(f"{self.name} as follower")
+        self.__leave_state__()
         self.state = Follower(self)
 
     def fetch(self, replica, service, data):
+        if self.transport is not None:
+            return self.transport.call(replica, self.group, service, data)
+        if service == "install_snapshot":
+            data = {**data, "data": base64.b64encode(data["data"]).decode("ascii")}
         try:
             response = self.session.post(
-                f"http://{replica}/{service}", json=data, timeout=(3, 9)
+                f"http://{replica}{self.path}/{service}", json=data, timeout=(3, 9)
             )
             if response.status_code == 200:
                 return response.json()
@@ -697,7 +1132,7 @@ class Raft:
             with self.lock:
                 func()
 
-        self.scheduler.schedule(
+        return self.scheduler.schedule(
             timedelta(milliseconds=delaymillis),
             wrapper if locking else func,
         )
@@ -705,6 +1140,16 @@ class Raft:
     def results(self, query):
         return self.state.results(query)
 
+    def close(self):
+        with self.lock:
+            if isinstance(self.state, Leader):
+                self.state.shutdown()
+            self.scheduler.shutdown()
+            self.housekeeper.shutdown()
+            self.entries.close()
+            self.config.close()
+
     def snapshot(self):
         with self.lock:
-            return self.state.snapshot()
+            state = self.state
+        return state.snapshot()
@@ -0,0 +1,398 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+SEGMENT_SIZE = int(os.environ.get("RAFT_SEGMENT_SIZE", 16)) * 1024 * 1024
+INDEX_INTERVAL = int(os.environ.get("RAFT_INDEX_INTERVAL", 64))
+# none: flush only, batch: fsync per group of entries (or every
+# RAFT_FSYNC_INTERVAL ms when set), always: fsync every entry
+DURABILITY = os.environ.get("RAFT_DURABILITY", "batch")
+FSYNC_INTERVAL = int(os.environ.get("RAFT_FSYNC_INTERVAL", 0))
+
+# payload length, crc32 of term + payload, term
+HEADER = struct.Struct("<IIQ")
+TERM = struct.Struct("<Q")
+# absolute index, offset in the segment
+INDEX_ENTRY = struct.Struct("<QQ")
+
+logger = logging.getLogger("raft")
+
+
+def sync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability:
+    def __init__(self, policy=DURABILITY, interval=FSYNC_INTERVAL):
+        if policy not in ("none", "batch", "always"):
+            raise ValueError(f"Unknown durability policy {policy}")
+        self.policy = policy
+        self.interval = interval
+        self.pending = {}
+        self.last_sync = time.monotonic()
+        self.syncs = 0
+        self.sync_time = 0
+
+    def fsync(self, f):
+        start = time.monotonic()
+        os.fsync(f.fileno())
+        self.syncs += 1
+        self.sync_time += time.monotonic() - start
+
+    def written(self, f, lazy=False):
+        # lazy files (the conf) ride along with the next fsync of the log
+        if self.policy == "none":
+            return
+        if self.policy == "always":
+            self.fsync(f)
+            return
+        self.pending[f.name] = f
+        if lazy:
+            return
+        if self.interval <= 0 or (
+            time.monotonic() - self.last_sync
+        ) * 1000 >= self.interval:
+            self.sync()
+
+    def sync(self):
+        pending, self.pending = self.pending, {}
+        for f in pending.values():
+            if not f.closed:
+                self.fsync(f)
+        self.last_sync = time.monotonic()
+
+    def persist(self, f):
+        # files that are renamed into place are synced unless durability is off
+        if self.policy == "none":
+            return
+        f.flush()
+        self.fsync(f)
+
+    def created(self, directory):
+        if self.policy != "none":
+            sync_dir(directory)
+
+
+def encode_record(entry):
+    payload = json.dumps(entry).encode("utf-8")
+    term = entry["term"]
+    crc = zlib.crc32(payload, zlib.crc32(TERM.pack(term)))
+    return HEADER.pack(len(payload), crc, term) + payload
+
+
+class Segment:
+    def __init__(self, directory, first, durability):
+        self.first = first
+        self.durability = durability
+        self.path = os.path.join(directory, f"{first:020d}.seg")
+        self.index_path = os.path.join(directory, f"{first:020d}.idx")
+        self.file = open(self.path, "a+b")
+        self.index_file = open(self.index_path, "a+b")
+        self.size = os.path.getsize(self.path)
+        self.count = 0
+        self.sparse = []
+        self.map = None
+        self.cursor = None
+
+    def last(self):
+        return self.first + self.count - 1
+
+    def load_index(self):
+        self.index_file.seek(0)
+        data = self.index_file.read()
+        for pos in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            index, offset = INDEX_ENTRY.unpack_from(data, pos)
+            if offset >= self.size:
+                break
+            self.sparse.append((index, offset))
+        if not self.sparse or self.sparse[0] != (self.first, 0):
+            self.sparse = []
+
+    def recover(self):
+        # only the active segment can hold a torn write, sealed ones are trusted
+        self.load_index()
+        if self.sparse:
+            index, offset = self.sparse[-1]
+        else:
+            index, offset = self.first, 0
+        while True:
+            record = self.read_at(offset, check=True)
+            if record is None:
+                break
+            if (index - self.first) % INDEX_INTERVAL == 0:
+                if not self.sparse or self.sparse[-1][0] < index:
+                    self.sparse.append((index, offset))
+            offset += HEADER.size + record[0]
+            index += 1
+        if offset < self.size:
+            logger.info("truncating torn tail of %s at %s", self.path, offset)
+            self.close_map()
+            self.file.truncate(offset)
+            self.size = offset
+            self.sparse = [(i, o) for (i, o) in self.sparse if o < offset]
+        self.count = index - self.first
+        self.write_index()
+
+    def seal(self, count):
+        self.count = count
+        self.load_index()
+        if not self.sparse:
+            self.recover()
+
+    def write_index(self):
+        self.index_file.truncate(0)
+        self.index_file.write(
+            b"".join(INDEX_ENTRY.pack(index, offset) for (index, offset) in self.sparse)
+        )
+        self.index_file.flush()
+
+    def mapped(self, end):
+        if self.map is None or len(self.map) < end:
+            self.close_map()
+            if self.size == 0:
+                return None
+            self.file.flush()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map
+
+    def close_map(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def read_at(self, offset, check=False):
+        if offset + HEADER.size > self.size:
+            return None
+        data = self.mapped(offset + HEADER.size)
+        length, crc, term = HEADER.unpack_from(data, offset)
+        end = offset + HEADER.size + length
+        if end > self.size:
+            return None
+        if check:
+            data = self.mapped(end)
+            payload = data[offset + HEADER.size : end]
+            if zlib.crc32(payload, zlib.crc32(TERM.pack(term))) != crc:
+                return None
+        return (length, term)
+
+    def locate(self, index):
+        pos = bisect.bisect_right(self.sparse, (index, float("inf"))) - 1
+        current, offset = self.sparse[pos]
+        if self.cursor is not None and current <= self.cursor[0] <= index:
+            current, offset = self.cursor
+        while current < index:
+            length, _ = self.read_at(offset)
+            offset += HEADER.size + length
+            current += 1
+        self.cursor = (current, offset)
+        return offset
+
+    def term(self, index):
+        return self.read_at(self.locate(index))[1]
+
+    def records(self, index, stop):
+        offset = self.locate(index)
+        while index < stop:
+            length, _ = self.read_at(offset)
+            start = offset + HEADER.size
+            data = self.mapped(start + length)
+            yield data[start : start + length]
+            offset = start + length
+            index += 1
+            self.cursor = (index, offset)
+
+    def read(self, index, stop):
+        for payload in self.records(index, stop):
+            yield json.loads(payload)
+
+    def append(self, records):
+        buffer = []
+        sparse = []
+        offset = self.size
+        index = self.first + self.count
+        for record in records:
+            if (index - self.first) % INDEX_INTERVAL == 0:
+                sparse.append((index, offset))
+            buffer.append(record)
+            offset += len(record)
+            index += 1
+        if self.durability.policy == "always":
+            for record in buffer:
+                self.file.write(record)
+                self.file.flush()
+                self.durability.written(self.file)
+        else:
+            self.file.write(b"".join(buffer))
+            self.file.flush()
+            self.durability.written(self.file)
+        if sparse:
+            self.index_file.write(
+                b"".join(INDEX_ENTRY.pack(index, offset) for (index, offset) in sparse)
+            )
+            self.index_file.flush()
+            self.sparse.extend(sparse)
+        self.size = offset
+        self.count = index - self.first
+
+    def truncate(self, index):
+        offset = self.locate(index)
+        self.close_map()
+        self.cursor = None
+        self.file.truncate(offset)
+        self.size = offset
+        self.count = index - self.first
+        self.sparse = [(i, o) for (i, o) in self.sparse if i < index]
+        self.write_index()
+
+    def close(self):
+        self.close_map()
+        self.file.close()
+        self.index_file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+        os.remove(self.index_path)
+
+
+# Local index 0 is the snapshot point (base), records keep their absolute index
+# so compaction drops whole segments and never rewrites the tail.
+class SegmentedLog:
+    def __init__(self, directory, base=0, base_term=0, durability=None):
+        self.directory = directory
+        self.durability = durability or Durability()
+        os.makedirs(directory, exist_ok=True)
+        self.base = base
+        self.base_term = base_term
+        firsts = sorted(
+            int(name[:-4]) for name in os.listdir(directory) if name.endswith(".seg")
+        )
+        self.segments = [
+            Segment(directory, first, self.durability) for first in firsts
+        ]
+        for (segment, following) in zip(self.segments, self.segments[1:]):
+            segment.seal(following.first - segment.first)
+        if self.segments:
+            self.segments[-1].recover()
+        self.compact(base, base_term)
+
+    def last(self):
+        if not self.segments:
+            return self.base
+        return max(self.segments[-1].last(), self.base)
+
+    def __len__(self):
+        return self.last() - self.base + 1
+
+    def size(self):
+        return sum(segment.size for segment in self.segments)
+
+    def segment(self, index):
+        pos = bisect.bisect_right([s.first for s in self.segments], index) - 1
+        return self.segments[pos]
+
+    def local(self, i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(f"log index {i} out of range")
+        return i
+
+    def term(self, i):
+        i = self.local(i)
+        if i == 0:
+            return self.base_term
+        index = self.base + i
+        return self.segment(index).term(index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self.read(*i.indices(len(self))[:2]))
+        i = self.local(i)
+        if i == 0:
+            return {"term": self.base_term, "data": None}
+        return next(self.read(i, i + 1))
+
+    def read(self, start, stop):
+        if start == 0 and stop > 0:
+            yield {"term": self.base_term, "data": None}
+            start = 1
+        index = self.base + start
+        stop = self.base + stop
+        while index < stop:
+            segment = self.segment(index)
+            end = min(stop, segment.last() + 1)
+            yield from segment.read(index, end)
+            index = end
+
+    def batch(self, start, max_bytes):
+        # entries from start on, as many as fit in max_bytes but at least one
+        entries = []
+        size = 0
+        index = self.base + max(start, 1)
+        stop = self.last() + 1
+        while index < stop:
+            segment = self.segment(index)
+            end = min(stop, segment.last() + 1)
+            for payload in segment.records(index, end):
+                size += len(payload)
+                if entries and size > max_bytes:
+                    return entries
+                entries.append(json.loads(payload))
+            index = end
+        return entries
+
+    def write(self, start, entries):
+        if start < len(self):
+            self.truncate(start)
+        records = [encode_record(entry) for entry in entries]
+        while records:
+            if not self.segments or self.segments[-1].size >= SEGMENT_SIZE:
+                self.segments.append(
+                    Segment(self.directory, self.last() + 1, self.durability)
+                )
+                self.durability.created(self.directory)
+            segment = self.segments[-1]
+            room = 0
+            size = segment.size
+            while room < len(records) and (room == 0 or size < SEGMENT_SIZE):
+                size += len(records[room])
+                room += 1
+            segment.append(records[:room])
+            records = records[room:]
+
+    def truncate(self, start):
+        index = self.base + max(start, 1)
+        while self.segments and self.segments[-1].first >= index:
+            self.segments.pop().remove()
+        if self.segments and self.segments[-1].last() >= index:
+            self.segments[-1].truncate(index)
+
+    def compact(self, base, base_term):
+        # whole segments covered by the snapshot are dropped, the tail is kept
+        self.base = base
+        self.base_term = base_term
+        while self.segments and self.segments[0].last() <= base:
+            self.segments.pop(0).remove()
+        if self.segments and self.segments[0].first > base + 1:
+            logger.info("log gap after snapshot %s, dropping tail", base)
+            self.reset(base, base_term)
+
+    def reset(self, base, base_term):
+        self.base = base
+        self.base_term = base_term
+        while self.segments:
+            self.segments.pop().remove()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
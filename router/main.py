@@ -2,7 +2,7 @@ from health_server import HealthServer, get_my_ip
 import pipe
 from pipe import Scatter
 import logging
-from factory import mapper
+from factory import mapper_sessions, sessions
 from dedup import Dedup
 from control_server import ControlClient
 
@@ -10,34 +10,35 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def consume_reviews(batch_id, dedup):
-    def funny(reviews):
-        return [
-            {
-                "funny": r["funny"],
-                "business_id": r["business_id"],
-            }
-            for r in reviews
-        ]
+def funny(reviews):
+    return [
+        {
+            "funny": r["funny"],
+            "business_id": r["business_id"],
+        }
+        for r in reviews
+    ]
 
-    def comment(reviews):
-        return [{"text": r["text"], "user_id": r["user_id"]} for r in reviews]
 
-    def users(reviews):
-        return [{"user_id": r["user_id"]} for r in reviews]
+def comment(reviews):
+    return [{"text": r["text"], "user_id": r["user_id"]} for r in reviews]
 
-    def stars5(reviews):
-        return [{"stars": r["stars"], "user_id": r["user_id"]} for r in reviews]
 
-    def histogram(reviews):
-        return [{"date": r["date"]} for r in reviews]
+def users(reviews):
+    return [{"user_id": r["user_id"]} for r in reviews]
 
-    mapper(
-        pipe_in=pipe.data_review(),
-        map_fn=lambda x: x,
-        batch_id=batch_id,
-        dedup=dedup,
-        pipe_out=Scatter(
+
+def stars5(reviews):
+    return [{"stars": r["stars"], "user_id": r["user_id"]} for r in reviews]
+
+
+def histogram(reviews):
+    return [{"date": r["date"]} for r in reviews]
+
+
+def reviews_sessions(dedup):
+    return mapper_sessions(
+        make_pipe_out=lambda: Scatter(
             [
                 pipe.Formatted(pipe.user_summary(), users),
                 pipe.Formatted(pipe.map_comment(), comment),
@@ -46,20 +47,19 @@ def consume_reviews(batch_id, dedup):
                 pipe.Formatted(pipe.map_stars5(), stars5),
             ]
         ),
+        map_fn=lambda x: x,
+        dedup=dedup,
     )
 
 
+def route_business(business):
+    return [{"city": b["city"], "business_id": b["business_id"]} for b in business]
 
 
-def consume_business(batch_id, dedup):
-    def route_business(business):
-        return [{"city": b["city"], "business_id": b["business_id"]} for b in business]
-
-    mapper(
-        pipe_in=pipe.data_business(),
+def business_sessions(dedup):
+    return mapper_sessions(
+        make_pipe_out=pipe.business_cities_summary,
         map_fn=route_business,
-        pipe_out=pipe.business_cities_summary(),
-        batch_id=batch_id,
         dedup=dedup,
     )
 
@@ -70,14 +70,18 @@ def main():
         dedupBussiness = Dedup(get_my_ip())
         controlClient = ControlClient()
         control = pipe.pub_sub_control()
-        for payload, ack in control.recv():
-            if not dedupBussiness.is_batch_processed(payload["session_id"]):
-                consume_business(payload["session_id"], dedupBussiness)
-                logger.info("batch %s", payload)
-            if not dedup.is_batch_processed(payload["session_id"]):
-                consume_reviews(payload["session_id"], dedup)
-            controlClient.batch_done(payload["session_id"], get_my_ip())
-            ack()
+
+        def done(session_id):
+            controlClient.batch_done(session_id, get_my_ip())
+
+        sessions(
+            control,
+            [
+                (pipe.data_business(), dedupBussiness, business_sessions(dedupBussiness)),
+                (pipe.data_review(), dedup, reviews_sessions(dedup)),
+            ],
+            done,
+        )
 
 
 if __name__ == "__main__":
@@ -1,48 +1,91 @@
-from threading import Thread, Event, RLock
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import os
+from threading import Thread, Event, Lock
 import time
 
+SCHEDULER_WORKERS = int(os.environ.get("SCHEDULER_WORKERS", 2))
+
+logger = logging.getLogger("scheduler")
+
+
+class Timer:
+    def __init__(self, deadline, func) -> None:
+        self.deadline = deadline
+        self.func = func
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
 
 class Scheduler:
-    def __init__(self) -> None:
+    def __init__(self, workers=SCHEDULER_WORKERS) -> None:
         self.thread = Thread(target=self.run)
         self.event = Event()
-        self.lock = RLock()
+        self.lock = Lock()
         self.is_shutdown = False
+        # (deadline, sequence, timer), the sequence keeps equal deadlines in order
         self.tasks = []
+        self.sequence = itertools.count()
+        # callbacks run on the pool, a slow one does not delay the other timers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lag_count = 0
+        self.lag_total = 0
+        self.lag_max = 0
         self.thread.start()
 
     def schedule(self, delta, func):
+        timer = Timer(time.monotonic() + delta.total_seconds(), func)
         with self.lock:
-            self.tasks.append([datetime.now() + delta, func])
-            self.tasks.sort(key=lambda it: it[0])
-        self.event.set()
+            heapq.heappush(self.tasks, (timer.deadline, next(self.sequence), timer))
+            first = self.tasks[0][2] is timer
+        if first:
+            self.event.set()
+        return timer
 
     def shutdown(self):
         self.is_shutdown = True
         self.event.set()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def execute(self, timer):
+        if timer.cancelled or self.is_shutdown:
+            return
+        # lag is how late the callback starts, waiting for a worker included
+        lag = time.monotonic() - timer.deadline
+        with self.lock:
+            self.lag_count += 1
+            self.lag_total += lag
+            self.lag_max = max(self.lag_max, lag)
+        try:
+            timer.func()
+        except Exception:
+            logger.exception("scheduled task failed")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "timers": len(self.tasks),
+                "lag_avg": self.lag_total / self.lag_count if self.lag_count else None,
+                "lag_max": self.lag_max,
+            }
 
     def run(self):
-        # basado en ThreadSchedulerExecutor de java
-        timeout = None
         while not self.is_shutdown:
-            self.event.wait(timeout)
             self.event.clear()
+            due = []
             with self.lock:
-                # need a lock because task list is re-assigned
-                remaining = []
-                for task in self.tasks:
-                    [deadline, func] = task
-                    if deadline <= datetime.now():
-                        func()
-                    else:
-                        remaining.append(task)
-
-                self.tasks = remaining
-                self.tasks.sort(key=lambda it: it[0])
-            timeout = None
-            if len(self.tasks) > 0:
-                timeout = max(
-                    0,
-                    (self.tasks[0][0] - datetime.now()).total_seconds(),
-                )
+                now = time.monotonic()
+                while self.tasks and self.tasks[0][0] <= now:
+                    due.append(heapq.heappop(self.tasks)[2])
+                timeout = self.tasks[0][0] - now if self.tasks else None
+            for timer in due:
+                if not timer.cancelled:
+                    try:
+                        self.pool.submit(self.execute, timer)
+                    except RuntimeError:
+                        return
+            self.event.wait(timeout)
@@ -1,37 +1,45 @@
 from health_server import HealthServer, get_my_ip
 import pipe
 import logging
-from factory import mapper
+from factory import mapper_sessions, sessions
 from dedup import Dedup
 from control_server import ControlClient
 
 logger = logging.getLogger(__name__)
 
 
-def main():
-    def map_stars(reviews):
-        return [
-            {"stars": r["stars"], "user_id": r["user_id"]}
-            for r in reviews
-            if r["stars"] == 5.0
-        ]
+def map_stars(reviews):
+    return [
+        {"stars": r["stars"], "user_id": r["user_id"]}
+        for r in reviews
+        if r["stars"] == 5.0
+    ]
+
 
+def main():
     with HealthServer():
         dedup = Dedup(get_my_ip())
         controlClient = ControlClient()
         control = pipe.pub_sub_control()
-        for payload, ack in control.recv():
-            if not dedup.is_batch_processed(payload["session_id"]):
-                logger.info("batch %s", payload)
-                mapper(
-                    pipe_in=pipe.map_stars5(),
-                    map_fn=map_stars,
-                    pipe_out=pipe.star5_summary(),
-                    batch_id=payload["session_id"],
-                    dedup=dedup,
+
+        def done(session_id):
+            controlClient.batch_done(session_id, get_my_ip())
+
+        sessions(
+            control,
+            [
+                (
+                    pipe.map_stars5(),
+                    dedup,
+                    mapper_sessions(
+                        make_pipe_out=pipe.star5_summary,
+                        map_fn=map_stars,
+                        dedup=dedup,
+                    ),
                 )
-            controlClient.batch_done(payload["session_id"], get_my_ip())
-            ack()
+            ],
+            done,
+        )
 
 
 if __name__ == "__main__":
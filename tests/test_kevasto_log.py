@@ -0,0 +1,41 @@
+import threading
+
+import kevasto
+from kevasto import KeyValueVM
+
+
+def command(op, **fields):
+    return {"data": {"store": "log", "bucket": "l", "op": op, **fields}}
+
+
+def test_reads_see_whole_drops(monkeypatch):
+    monkeypatch.setattr(kevasto, "LOG_CHUNK_SIZE", 4)
+    vm = KeyValueVM()
+    vm.run([command("append", val=i) for i in range(4000)])
+    errors = []
+    stop = threading.Event()
+
+    def read():
+        while not stop.is_set():
+            base = vm.data["log"]["l"]["base"]
+            try:
+                values = vm.results(
+                    {"store": "log", "bucket": "l", "start": base, "limit": 9}
+                )
+            except Exception as e:
+                # dropped meanwhile, anything else is a torn read
+                if "Illegal index" not in str(e):
+                    errors.append(repr(e))
+                continue
+            if values != list(range(base, base + len(values))):
+                errors.append(f"{base}: {values}")
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for start in range(1, 4000, 3):
+        vm.run([command("drop", start=start)])
+    stop.set()
+    for reader in readers:
+        reader.join()
+    assert errors == []
@@ -0,0 +1,59 @@
+import socket
+import threading
+import time
+
+import peer
+from peer import PeerServer, PeerTransport
+
+
+class Group:
+    def __init__(self, group, delay=0):
+        self.group = group
+        self.delay = delay
+
+    def request_vote(self, req):
+        time.sleep(self.delay)
+        return {"group": self.group}
+
+
+def test_hung_follower_fails_the_send(monkeypatch):
+    monkeypatch.setattr(peer, "PEER_TIMEOUT", 500)
+    # accepts connections but never reads from them
+    follower = socket.create_server(("127.0.0.1", 0))
+    address = follower.getsockname()
+    transport = PeerTransport(resolve=lambda replica: address)
+    try:
+        req = {
+            "term": 1,
+            "leader_id": "leader",
+            "snapshot_version": 1,
+            "snapshot_term": 1,
+            "offset": 0,
+            "data": b"x" * (64 * 1024 * 1024),
+            "done": False,
+        }
+        start = time.monotonic()
+        assert transport.call("follower", 0, "install_snapshot", req) is None
+        assert time.monotonic() - start < 5
+        assert transport.connections[("follower", 0)].socket is None
+    finally:
+        transport.close()
+        follower.close()
+
+
+def test_slow_group_does_not_hold_back_the_others():
+    server = PeerServer([Group(0, delay=2), Group(1)], port=0, host="127.0.0.1")
+    transport = PeerTransport(resolve=lambda replica: ("127.0.0.1", server.port))
+    try:
+        slow = threading.Thread(
+            target=transport.call, args=("node", 0, "request_vote", {})
+        )
+        slow.start()
+        time.sleep(0.2)
+        start = time.monotonic()
+        assert transport.call("node", 1, "request_vote", {}) == {"group": 1}
+        assert time.monotonic() - start < 1
+        slow.join()
+    finally:
+        transport.close()
+        server.shutdown()
@@ -0,0 +1,34 @@
+import time
+
+from kevasto import KeyValueVM
+from raft import Leader, Raft
+
+
+def leader(tmp_path):
+    raft = Raft("single", ["single"], KeyValueVM(), base_path=str(tmp_path / "raft"))
+    deadline = time.monotonic() + 10
+    while not isinstance(raft.state, Leader):
+        assert time.monotonic() < deadline, "no leader elected"
+        time.sleep(0.05)
+    return raft
+
+
+def append(raft, val):
+    return raft.append_entry({"store": "log", "bucket": "l", "op": "append", "val": val})
+
+
+def test_rejected_entry_fails_alone(tmp_path):
+    raft = leader(tmp_path)
+    try:
+        assert append(raft, "a")["success"]
+        # past the end of the log, the machine raises
+        res = raft.append_entry({"store": "log", "bucket": "l", "op": "drop", "start": 5})
+        assert not res["success"]
+        assert "Illegal index" in res["error"]
+        # the replicator is still running and the node still leads
+        assert append(raft, "b")["success"]
+        assert isinstance(raft.state, Leader)
+        res = raft.results({"store": "log", "bucket": "l", "start": 0})
+        assert res["data"] == ["a", "b"]
+    finally:
+        raft.close()
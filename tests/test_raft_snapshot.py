@@ -0,0 +1,47 @@
+import json
+
+from raft import NopVM, Raft
+
+
+def follower(tmp_path, term):
+    # a restarted node waits for the leader, no election while the test runs
+    base_path = str(tmp_path / "raft")
+    with open(base_path + ".conf", "w") as f:
+        f.write(json.dumps({"current_term": term}) + "\n")
+    return Raft("follower", ["leader", "follower"], NopVM(), base_path=base_path)
+
+
+def test_follower_with_higher_term_installs_lagging_snapshot(tmp_path):
+    raft = follower(tmp_path, 5)
+    try:
+        data = json.dumps({}).encode()
+        res = raft.install_snapshot(
+            {
+                "term": 5,
+                "leader_id": "leader",
+                "snapshot_version": 10,
+                "snapshot_term": 3,
+                "offset": 0,
+                "data": data,
+                "done": True,
+            }
+        )
+        assert res["success"]
+        assert raft.snapshot_version == 10
+        # log indexes restart at the snapshot, 0 is its last entry
+        assert raft.entries.term(0) == 3
+
+        res = raft.append_entries(
+            {
+                "term": 5,
+                "leader_id": "leader",
+                "prev_log_index": 0,
+                "prev_log_term": 3,
+                "entries": [],
+                "leader_commit": 0,
+                "snapshot_version": 10,
+            }
+        )
+        assert res["success"], res
+    finally:
+        raft.close()
@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+from filters import BOUNCE_ROUNDS, Cursor, Sessions
+
+
+class Dedup:
+    def __init__(self):
+        self.processed = set()
+
+    def is_batch_processed(self, batch_id):
+        return batch_id in self.processed
+
+
+class Session(Cursor):
+    def __init__(self, session_id, dedup):
+        self.session_id = session_id
+        self.dedup = dedup
+        self.chunks = []
+
+    def step(self, acc, payload):
+        self.chunks.append(payload["data"])
+        return acc
+
+    def end(self, acc, context):
+        self.dedup.processed.add(self.session_id)
+        self.is_done = True
+
+
+def test_announced_session_takes_int_keyed_chunks():
+    dedup = Dedup()
+    opened = {}
+    done = []
+
+    def make_cursor(session_id):
+        opened[session_id] = Session(session_id, dedup)
+        return opened[session_id]
+
+    mux = Sessions(make_cursor, dedup, done.append)
+    mux.setup(SimpleNamespace(pipe_in="in"))
+    accs = mux.start()
+    # the control server announces the id it got in its URL
+    mux.open("1")
+    accs = mux.idle(accs)
+    # the client sends its chunks with the id as an int
+    acked = []
+    accs = mux.submit(accs, {"session_id": 1, "data": [1]}, lambda: acked.append(1))
+    accs = mux.submit(accs, {"session_id": 1, "data": [2]}, lambda: acked.append(2))
+    assert list(mux.cursors) == ["1"]
+    assert opened["1"].chunks == [[1], [2]]
+
+    mux.submit_end(accs, {"session_id": 1, "data": None}, lambda: acked.append("eof"))
+    assert list(opened) == ["1"]
+    assert mux.cursors == {}
+    assert done == ["1"]
+    assert acked == [1, 2, "eof"]
+
+
+def test_duplicate_count_down_eof_stops_bouncing():
+    dedup = Dedup()
+    dedup.processed.add("1")
+    mux = Sessions(lambda session_id: Session(session_id, dedup), dedup)
+    sent = []
+    mux.setup(SimpleNamespace(pipe_in=SimpleNamespace(send=sent.append)))
+    accs = mux.start()
+    acked = []
+    eof = {"session_id": "1", "data": None, "count_down": 1}
+    # every replica ended the session, the EOF goes around them for a while
+    mux.submit_end(accs, {**eof, "bounces": 0}, lambda: acked.append(0))
+    assert [payload["bounces"] for payload in sent] == [1]
+    assert acked == [0]
+    mux.submit_end(accs, {**eof, "bounces": mux.replicas}, lambda: acked.append(1))
+    assert len(mux.bouncing) == 1
+    assert acked == [0]
+    # and is dropped once it went around them BOUNCE_ROUNDS times
+    rounds = {**eof, "bounces": mux.replicas * BOUNCE_ROUNDS}
+    mux.submit_end(accs, rounds, lambda: acked.append(2))
+    assert acked == [0, 2]
+    assert len(sent) == 1
+    mux.close()
@@ -0,0 +1,163 @@
+import argparse
+import atexit
+import itertools
+import json
+import os
+import socket
+import sys
+import time
+from collections import deque
+from threading import Lock
+
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", 10000))
+# spans are also appended as JSON lines to <TRACE_DIR>/<node>.jsonl when set
+TRACE_DIR = os.environ.get("TRACE_DIR")
+TRACE_FLUSH = int(os.environ.get("TRACE_FLUSH", 100))
+
+
+# Chunks carry {"id", "origin", "parent"} under "trace", every hop that
+# consumes one records a span and becomes the parent of what it sends
+class Tracer:
+    def __init__(self, node, directory=TRACE_DIR, size=TRACE_BUFFER) -> None:
+        self.node = node
+        self.spans = deque(maxlen=size)
+        self.lock = Lock()
+        self.ids = itertools.count()
+        self.pending = []
+        self.path = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.path = os.path.join(directory, f"{node}.jsonl")
+            atexit.register(self.flush)
+
+    def origin(self, session_id, chunk_id):
+        return {"id": f"{session_id}:{chunk_id}", "origin": time.time(), "parent": None}
+
+    def start(self, payload, hop):
+        trace = payload.get("trace")
+        if trace is None:
+            return None
+        span = {
+            "trace": trace["id"],
+            "span": f"{self.node}:{next(self.ids)}",
+            "parent": trace.get("parent"),
+            "origin": trace["origin"],
+            "hop": hop,
+            "node": self.node,
+            "session": payload.get("session_id"),
+            "eof": payload.get("data") is None,
+            "start": time.time(),
+        }
+        payload["trace"] = {**trace, "parent": span["span"]}
+        return span
+
+    def finish(self, span):
+        if span is None:
+            return
+        span["end"] = time.time()
+        with self.lock:
+            self.spans.append(span)
+            if self.path is None:
+                return
+            self.pending.append(span)
+            if len(self.pending) < TRACE_FLUSH:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            with open(self.path, "a") as f:
+                f.writelines(json.dumps(span) + "\n" for span in pending)
+
+    def dump(self):
+        with self.lock:
+            return list(self.spans)
+
+
+tracer = Tracer(os.environ.get("HOSTNAME", socket.gethostname()))
+
+
+def critical_path(spans):
+    # from the root follow the child that finished last
+    children = {}
+    for span in spans:
+        children.setdefault(span["parent"], []).append(span)
+    path = []
+    level = children.get(None, [])
+    while level:
+        span = max(level, key=lambda s: s["end"])
+        path.append(span)
+        level = children.get(span["span"], [])
+    return path
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def analyze(spans):
+    traces = {}
+    for span in spans:
+        traces.setdefault(span["trace"], []).append(span)
+    latencies = []
+    hops = {}
+    dominant = {}
+    for trace_spans in traces.values():
+        path = critical_path(trace_spans)
+        if not path:
+            continue
+        latencies.append(path[-1]["end"] - path[0]["origin"])
+        previous = path[0]["origin"]
+        costs = []
+        for span in path:
+            wait = span["start"] - previous
+            service = span["end"] - span["start"]
+            stats = hops.setdefault(span["hop"], {"wait": [], "service": []})
+            stats["wait"].append(wait)
+            stats["service"].append(service)
+            costs.append((wait + service, span["hop"]))
+            previous = span["end"]
+        hop = max(costs)[1]
+        dominant[hop] = dominant.get(hop, 0) + 1
+    return (latencies, hops, dominant)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per chunk latency and dominant hop from span files (JSON lines)"
+    )
+    parser.add_argument("files", nargs="+", help="span files, - for stdin")
+    args = parser.parse_args()
+
+    spans = []
+    for name in args.files:
+        f = sys.stdin if name == "-" else open(name)
+        spans.extend(json.loads(line) for line in f if line.strip())
+    (latencies, hops, dominant) = analyze(spans)
+    if not latencies:
+        print("no complete traces")
+        return
+    print(
+        f"{len(latencies)} chunks "
+        f"p50={percentile(latencies, 0.5) * 1000:.1f}ms "
+        f"p99={percentile(latencies, 0.99) * 1000:.1f}ms "
+        f"max={max(latencies) * 1000:.1f}ms"
+    )
+    print(f"{'hop':<24}{'spans':>8}{'wait p50':>12}{'service p50':>14}{'dominant':>10}")
+    for (hop, stats) in sorted(
+        hops.items(), key=lambda item: -sum(item[1]["wait"]) - sum(item[1]["service"])
+    ):
+        print(
+            f"{hop:<24}{len(stats['wait']):>8}"
+            f"{percentile(stats['wait'], 0.5) * 1000:>10.1f}ms"
+            f"{percentile(stats['service'], 0.5) * 1000:>12.1f}ms"
+            f"{dominant.get(hop, 0):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
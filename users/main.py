@@ -2,7 +2,7 @@ from health_server import HealthServer, get_my_ip
 import pipe
 from pipe import Send
 import logging
-from factory import reducer, count_key
+from factory import count_key, drop_state, reducer_sessions, session_name, sessions
 from dedup import AggregatorDedup
 from control_server import ControlClient
 
@@ -42,25 +42,28 @@ def main():
         control = pipe.pub_sub_control()
         dedup = AggregatorDedup("users")
         controlClient = ControlClient()
-        for payload, ack in control.recv():
-            if not dedup.is_batch_processed(payload["session_id"]):
-                logger.info("batch %s", payload)
-                reducer(
-                    pipe_in=pipe.user_summary(),
-                    step_fn=count_key("user_id"),
-                    pipe_out=UserSend(),
-                    batch_id=payload["session_id"],
-                    dedup=dedup,
+        bucket_name = get_my_ip()
+
+        def done(session_id):
+            drop_state(dedup.db, session_name(bucket_name, session_id))
+            controlClient.batch_done(session_id, bucket_name)
+
+        sessions(
+            control,
+            [
+                (
+                    pipe.user_summary(),
+                    dedup,
+                    reducer_sessions(
+                        make_pipe_out=UserSend,
+                        step_fn=count_key("user_id"),
+                        dedup=dedup,
+                        name=bucket_name,
+                    ),
                 )
-            bucket_name = get_my_ip()
-            dedup.db.log_drop(bucket_name + "_processed", None)
-            dedup.db.log_drop(bucket_name, None)
-            dedup.db.delete(
-                bucket_name,
-                "state",
-            )
-            controlClient.batch_done(payload["session_id"], bucket_name)
-            ack()
+            ],
+            done,
+        )
 
 
 if __name__ == "__main__":
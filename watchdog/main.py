@@ -1,4 +1,3 @@
-import requests
 import os
 import time
 from health_server import *
@@ -9,6 +8,8 @@ logging.basicConfig()
 logger = logging.getLogger("WatchdogSideCar")
 logger.setLevel(logging.INFO)
 
+WATCHDOG_INTERVAL = float(os.environ.get("WATCHDOG_INTERVAL", 20))
+
 
 def main():
     ips = []
@@ -35,20 +36,26 @@ def main():
     leaderServer = LeaderServer("watchdog")
     time.sleep(10)  # Le doy tiempo a los procesos para levantar el flask
     leaderServer.trigger_election()
+    next_round = time.monotonic()
     while True:
-        time.sleep(20)
+        next_round += WATCHDOG_INTERVAL
+        time.sleep(max(next_round - time.monotonic(), 0))
         leaderServer.wait_for_election_resolution()
         if leaderServer.i_am_leader():
-            leaderServer.healthcheck_workers()
-            # Start Leader stuff
-            for ip in ips:
-                try:
-                    requests.get(f"http://{ip}:80/health")
-                except:
-                    revive(ip)
-            # End Leader Stuff
+            # workers and pipeline processes are probed together
+            leaderServer.prober.probe(
+                leaderServer.get_worker_ips() + ips, on_failure=revive
+            )
+            latencies = {
+                host: stats["detection_latency"]
+                for (host, stats) in leaderServer.prober.stats().items()
+                if stats["detection_latency"] is not None
+            }
+            if latencies:
+                logger.info("failure detection latency %s", latencies)
         else:
             leaderServer.healthcheck_leader()
+        next_round = max(next_round, time.monotonic() - WATCHDOG_INTERVAL)
 
 
 if __name__ == "__main__":